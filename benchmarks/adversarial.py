@@ -0,0 +1,67 @@
+"""
+Adversarial inputs for the terminal regexes in smarty_grammar.
+
+Each case is converted at doubling sizes and the time per input byte is
+compared between the smallest and the largest size. Linear behaviour keeps
+that ratio near 1; anything that rescans the rest of the text per opening
+delimiter, or backtracks, makes it grow with the size.
+
+    python benchmarks/adversarial.py [--size N] [--max-ratio R]
+
+Exits with status 1 if a case grows faster than --max-ratio allows.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+# Use the smartytotwig of this checkout when run as a script.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from smartytotwig import parse_string  # noqa: E402
+from smartytotwig.twig_printer import TwigPrinter  # noqa: E402
+
+CASES = {
+    "unterminated comments": lambda n: "{* x " * n,
+    "unterminated literal blocks": lambda n: "{literal}x " * n,
+    "unclosed single quotes": lambda n: "{$a|b:'x " * n,
+    "unclosed double quotes": lambda n: '{$a|b:"x ' + "x " * n,
+    "unclosed variable strings": lambda n: '{"x $a ' * n,
+    "identifier with trailing operators": lambda n: "{$a" + "-" * (8 * n) + "}",
+    "backslashes in strings": lambda n: "{'" + "\\" * (8 * n) + "'}",
+    "long comment": lambda n: "{*" + " *" * (4 * n) + "*}",
+}
+
+
+def measure(text):
+    start = time.perf_counter()
+    parse_string(text).accept(TwigPrinter())
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--size", type=int, default=500, help="smallest repetition count")
+    parser.add_argument("--steps", type=int, default=3, help="number of doublings")
+    parser.add_argument("--max-ratio", type=float, default=2.5)
+    options = parser.parse_args()
+
+    failed = False
+    for name, make in CASES.items():
+        per_byte = []
+        for step in range(options.steps + 1):
+            text = make(options.size << step)
+            per_byte.append(min(measure(text) for _ in range(3)) / len(text))
+        ratio = per_byte[-1] / per_byte[0]
+        verdict = "ok" if ratio <= options.max_ratio else "NONLINEAR"
+        failed = failed or ratio > options.max_ratio
+        print(
+            "%-36s %8.2f us/KiB -> %8.2f us/KiB  x%.2f  %s"
+            % (name, per_byte[0] * 1024e6, per_byte[-1] * 1024e6, ratio, verdict)
+        )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+"""
+Scaling of batch conversion with the number of jobs, for each backend.
+
+A tree of generated templates is converted with 1, 2, 4 ... jobs of
+conversion processes and of conversion threads, and the speedup over a
+single job is printed. Threads only scale on a free-threaded Python; run
+this once with a regular build and once with a free-threaded one (such
+as python3.13t) to compare.
+
+    python benchmarks/scaling.py [--templates N] [--max-jobs J]
+"""
+
+import argparse
+import os
+import sys
+import sysconfig
+import tempfile
+import time
+
+# Use the smartytotwig of this checkout when run as a script.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from smartytotwig.batch import convert_tree  # noqa: E402
+from smartytotwig.pipeline import BACKENDS  # noqa: E402
+
+ROW = '<tr class="{cycle values="odd,even"}"><td>{$row.name|escape}</td><td>text</td></tr>\n'
+
+
+def make_tree(root, count, rows):
+    for i in range(count):
+        directory = os.path.join(root, "d%d" % (i % 10))
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, "%d.tpl" % i), "w") as f:
+            # Distinct templates, so none are skipped as duplicates.
+            f.write("{* template %d *}\n" % i)
+            f.write("{foreach from=$rows item=row}{if $row.visible}\n")
+            f.write(ROW * rows)
+            f.write("{/if}{/foreach}\n")
+
+
+def measure(source, target, jobs, backend):
+    start = time.perf_counter()
+    report = convert_tree(source, target, jobs=jobs, backend=backend)
+    elapsed = time.perf_counter() - start
+    assert not report.failed, report.failed
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--templates", type=int, default=200)
+    parser.add_argument("--rows", type=int, default=40, help="tags per template")
+    parser.add_argument("--max-jobs", type=int, default=os.cpu_count() or 1)
+    options = parser.parse_args()
+
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print(
+        "Python %s, %s build, GIL %s, %d CPUs"
+        % (
+            sys.version.split()[0],
+            "free-threaded" if sysconfig.get_config_var("Py_GIL_DISABLED") else "regular",
+            "enabled" if gil else "disabled",
+            os.cpu_count() or 1,
+        )
+    )
+    jobs = [1]
+    while jobs[-1] * 2 <= options.max_jobs:
+        jobs.append(jobs[-1] * 2)
+
+    with tempfile.TemporaryDirectory() as root:
+        source = os.path.join(root, "src")
+        make_tree(source, options.templates, options.rows)
+        for backend in BACKENDS:
+            base = None
+            for count in jobs:
+                # Each run writes a fresh tree, so every target is written.
+                target = os.path.join(root, "%s-%d" % (backend, count))
+                elapsed = measure(source, target, count, backend)
+                base = base or elapsed
+                print("%-10s %3d jobs %8.2fs  x%.2f" % (backend, count, elapsed, base / elapsed))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,80 @@
+"""
+Latency of starting conversion processes, for each way of starting them.
+
+A pool recycling its process after every task converts a small template
+again and again, so each task waits for a new process: the time per task
+is mostly the time to start one. Each start method runs in a fresh
+interpreter, as a fork server only takes its preloaded modules when it
+first starts:
+
+    spawn        a new interpreter imports everything per process
+    forkserver   processes forked from a bare fork server
+    preloaded    the pipeline's own fork server, warmed up by smartytotwig.preload
+
+    python benchmarks/spawn.py [--tasks N]
+"""
+
+import argparse
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# Use the smartytotwig of this checkout when run as a script.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from smartytotwig.pipeline import convert_templates, init_converter, process_context  # noqa: E402
+
+METHODS = ("spawn", "forkserver", "preloaded")
+
+TEMPLATE = b"{foreach from=$rows item=row}{$row.name|escape}{/foreach}"
+
+
+def make_context(method):
+    if method == "preloaded":
+        return process_context()
+    context = multiprocessing.get_context(method)
+    if method == "forkserver":
+        # Not even the default of this script's own modules.
+        context.set_forkserver_preload([])
+    return context
+
+
+def measure(method, tasks):
+    # The first task also starts the fork server, if there is one.
+    start = time.perf_counter()
+    with ProcessPoolExecutor(
+        1, make_context(method), initializer=init_converter, initargs=(None,), max_tasks_per_child=1
+    ) as pool:
+        pool.submit(convert_templates, [TEMPLATE]).result()
+        first = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(tasks):
+            pool.submit(convert_templates, [TEMPLATE]).result()
+        each = (time.perf_counter() - start) / tasks
+    return first, each
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--tasks", type=int, default=20)
+    parser.add_argument("--method", choices=METHODS, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.method:
+        print("%.6f %.6f" % measure(options.method, options.tasks))
+        return 0
+    for method in METHODS:
+        if method != "preloaded" and method not in multiprocessing.get_all_start_methods():
+            continue
+        command = [sys.executable, __file__, "--method", method, "--tasks", str(options.tasks)]
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        first, each = map(float, output.split())
+        print("%-10s first %7.1fms  then %7.1fms per process" % (method, first * 1000, each * 1000))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
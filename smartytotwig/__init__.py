@@ -1,20 +1,101 @@
-from typing import Any
+from collections.abc import Iterator
+from typing import Any, TextIO
 
-import pypeg2
+from . import stack_parser
+from .smarty_grammar import SmartyLanguageMain, SmartyLanguageMainOrEmpty, forget_terminators
+from .tag_cache import TagCache
+from .twig_printer import TwigPrinter
 
-from .smarty_grammar import SmartyLanguageMainOrEmpty
 
-
-def parse_file(file_name: str, language: type = SmartyLanguageMainOrEmpty) -> Any:
+def parse_file(
+    file_name: str,
+    language: type = SmartyLanguageMainOrEmpty,
+    tag_cache: TagCache | None = None,
+    interned: dict[tuple, Any] | None = None,
+) -> Any:
     """
     Parse a smarty template file.
     """
     with open(file_name, encoding="utf-8") as f:
-        return pypeg2.parse(f.read(), language, filename=file_name, whitespace="")
+        text = f.read()
+    return stack_parser.parse(
+        text,
+        language,
+        filename=file_name,
+        source_leaves=True,
+        tag_cache=tag_cache,
+        interned=interned,
+    )
+
+
+def parse_string(
+    text: str,
+    language: type = SmartyLanguageMainOrEmpty,
+    tag_cache: TagCache | None = None,
+    interned: dict[tuple, Any] | None = None,
+) -> Any:
+    """
+    Parse a Smarty template string. Pass a dict as *interned* to share
+    equal subtrees, see stack_parser.StackParser.
+    """
+    return stack_parser.parse(
+        text, language, source_leaves=True, tag_cache=tag_cache, interned=interned
+    )
+
+
+def iter_parse(
+    source_or_file: str | TextIO,
+    tag_cache: TagCache | None = None,
+    deadline: float | None = None,
+) -> Iterator[Any]:
+    """
+    Parse a Smarty template string or open file, yielding its top-level
+    statements one at a time.
+
+    Only the statement being parsed is kept by the parser, so nodes the
+    caller is done with can be freed while the rest is parsed. A file is
+    still read whole, the grammar needs to look ahead in the source.
+
+    Running past the time.monotonic() *deadline* or out of memory raises
+    stack_parser.OverBudgetError.
+    """
+    if isinstance(source_or_file, str):
+        text, filename = source_or_file, None
+    else:
+        text, filename = source_or_file.read(), getattr(source_or_file, "name", None)
+
+    parser = stack_parser.StackParser(
+        text, filename, source_leaves=True, tag_cache=tag_cache, deadline=deadline
+    )
+    # The ordered choice that SmartyLanguageMain repeats.
+    statement = SmartyLanguageMain.grammar[-1]
+    pos = 0
+    try:
+        while pos < len(text):
+            try:
+                result = parser.run(statement, pos)
+            except MemoryError:
+                # Dropping the memo makes room to report the error.
+                parser.forget()
+                raise parser.over_budget("out of memory") from None
+            if result is None or result[0] == pos:
+                raise parser.syntax_error()
+            pos, node = result
+            parser.forget()
+            yield node
+    finally:
+        forget_terminators()
 
 
-def parse_string(text: str, language: type = SmartyLanguageMainOrEmpty) -> Any:
+def iter_convert(
+    source_or_file: str | TextIO,
+    tag_cache: TagCache | None = None,
+    deadline: float | None = None,
+) -> Iterator[str]:
     """
-    Parse a Smarty template string.
+    Convert a Smarty template string or open file to Twig, yielding the
+    output of each top-level statement as soon as it is parsed.
     """
-    return pypeg2.parse(text, language, whitespace="")
+    printer = TwigPrinter()
+    for node in iter_parse(source_or_file, tag_cache, deadline):
+        yield printer.print(node)
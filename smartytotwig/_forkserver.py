@@ -0,0 +1,9 @@
+"""
+The preload of the fork server of preload.context(), imported by that
+server alone before it forks any conversion process.
+"""
+
+from . import pipeline  # noqa: F401  Imported for the conversion processes.
+from .preload import warm
+
+warm()
@@ -0,0 +1,105 @@
+"""
+Conversion from asyncio code.
+
+Parsing a large template takes long enough to stall an event loop, so
+convert_string_async() and convert_many_async() run conversions in an
+executor: the loop's default thread pool unless one is given. A
+ProcessPoolExecutor converts in parallel on any Python, threads only on a
+free-threaded one.
+
+Conversions are only handed to the executor as the caller's limits allow,
+so work waits in the caller rather than piling up in the executor, and
+cancelling the caller drops conversions not started yet. One already
+running goes on until it finishes or runs out of its timeout.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import deque
+from collections.abc import AsyncIterable, AsyncIterator, Iterable
+from concurrent.futures import Executor
+
+from . import iter_convert
+
+# How many conversions convert_many_async() has in the executor by default.
+DEFAULT_CONCURRENCY = 8
+
+
+def _convert(text: str, timeout: float | None) -> str:
+    # The budget starts when the conversion does, not when it was queued.
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    return "".join(iter_convert(text, deadline=deadline))
+
+
+async def convert_string_async(
+    text: str,
+    executor: Executor | None = None,
+    limiter: asyncio.Semaphore | None = None,
+    timeout: float | None = None,
+) -> str:
+    """
+    Convert the Smarty template *text* to Twig in *executor*.
+
+    Callers sharing a *limiter* have at most its value of conversions in
+    the executor at a time; the others wait for a turn. A conversion
+    taking more than *timeout* seconds raises stack_parser.OverBudgetError.
+    """
+    loop = asyncio.get_running_loop()
+    if limiter is None:
+        return await loop.run_in_executor(executor, _convert, text, timeout)
+    async with limiter:
+        return await loop.run_in_executor(executor, _convert, text, timeout)
+
+
+async def convert_many_async(
+    texts: Iterable[str] | AsyncIterable[str],
+    executor: Executor | None = None,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    timeout: float | None = None,
+    return_exceptions: bool = False,
+) -> AsyncIterator[str | Exception]:
+    """
+    Convert each Smarty template of *texts* in *executor*, yielding the
+    outputs in the same order.
+
+    At most *concurrency* conversions are in the executor or waiting to be
+    yielded, and the next template is only taken from *texts* when one
+    leaves, so a slow consumer or a saturated executor holds back the
+    producer. Templates failing, or taking more than *timeout* seconds,
+    raise their error, or yield it with *return_exceptions*. Closing the
+    iterator early cancels the conversions not started yet.
+    """
+    if concurrency < 1:
+        raise ValueError("concurrency must be at least 1")
+    loop = asyncio.get_running_loop()
+    pending: deque[asyncio.Future[str]] = deque()
+    try:
+        async for text in _iterate(texts):
+            pending.append(loop.run_in_executor(executor, _convert, text, timeout))
+            if len(pending) >= concurrency:
+                yield await _result(pending.popleft(), return_exceptions)
+        while pending:
+            yield await _result(pending.popleft(), return_exceptions)
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+async def _iterate(texts: Iterable[str] | AsyncIterable[str]) -> AsyncIterator[str]:
+    if isinstance(texts, AsyncIterable):
+        async for text in texts:
+            yield text
+    else:
+        for text in texts:
+            yield text
+
+
+async def _result(future: asyncio.Future[str], return_exceptions: bool) -> str | Exception:
+    try:
+        return await future
+    except Exception as e:
+        if not return_exceptions:
+            raise
+        return e
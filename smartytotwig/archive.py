@@ -0,0 +1,156 @@
+"""
+Conversion of template archives.
+
+convert_archive() reads a tar or zip archive member by member and writes
+a new archive of the same kind as it goes, with each .tpl member replaced
+by its converted .twig member. Other members are copied through without
+being decoded, so nothing is extracted to disk, as are templates that
+fail to convert, under their .tpl names, so the target is missing nothing
+the report does not list as failed. Tar archives are read and written as
+streams, compressed or not.
+"""
+
+from __future__ import annotations
+
+import copy
+import io
+import os
+import shutil
+import tarfile
+import time
+import zipfile
+
+from .batch import ERRORS, BatchReport, convert_bytes, dependencies, is_verbatim, twig_path
+from .tag_cache import TagCache
+
+# Modes of the tar streams written, by suffix.
+_TAR_MODES = [
+    ((".tar.gz", ".tgz"), "w|gz"),
+    ((".tar.bz2", ".tbz2"), "w|bz2"),
+    ((".tar.xz", ".txz"), "w|xz"),
+    ((".tar",), "w|"),
+]
+
+
+def convert_archive(
+    source: str,
+    target: str,
+    tag_cache: TagCache | None = None,
+    timeout: float | None = None,
+) -> BatchReport:
+    """
+    Convert the templates of the archive *source* into the archive
+    *target*, giving each *timeout* seconds. A zip archive is written as a
+    zip archive; a tar archive is compressed as the suffix of *target*
+    says: .tar, .tar.gz, .tar.bz2 or .tar.xz.
+
+    Raises ValueError for archives that cannot be read or written. The
+    target is only replaced once written whole.
+    """
+    report = BatchReport()
+    partial = target + ".part"
+    try:
+        if zipfile.is_zipfile(source):
+            if not target.endswith(".zip"):
+                raise ValueError("%s is not a .zip file, as %s is" % (target, source))
+            with zipfile.ZipFile(source) as archive, zipfile.ZipFile(partial, "w") as out:
+                _convert_zip(archive, out, tag_cache, timeout, report)
+        else:
+            mode = _tar_mode(target)
+            with tarfile.open(source, "r|*") as archive, tarfile.open(partial, mode) as out:
+                _convert_tar(archive, out, tag_cache, timeout, report)
+    except BaseException as e:
+        if os.path.exists(partial):
+            os.unlink(partial)
+        if isinstance(e, (tarfile.TarError, zipfile.BadZipFile)):
+            raise ValueError("%s: %s" % (source, e)) from e
+        raise
+    os.replace(partial, target)
+    report.failed.sort()
+    return report
+
+
+def _tar_mode(target: str) -> str:
+    for suffixes, mode in _TAR_MODES:
+        if target.endswith(suffixes):
+            return mode
+    raise ValueError("%s is not a .tar, .tar.gz, .tar.bz2 or .tar.xz file" % target)
+
+
+def _convert_zip(
+    archive: zipfile.ZipFile,
+    out: zipfile.ZipFile,
+    tag_cache: TagCache | None,
+    timeout: float | None,
+    report: BatchReport,
+) -> None:
+    for info in archive.infolist():
+        if info.is_dir() or not info.filename.endswith(".tpl"):
+            with archive.open(info) as f, out.open(copy.copy(info), "w") as dst:
+                shutil.copyfileobj(f, dst)
+            continue
+
+        data = archive.read(info)
+        output = _convert(info.filename, data, tag_cache, timeout, report)
+        info = copy.copy(info)
+        if output is None:
+            out.writestr(info, data)
+        else:
+            info.filename = twig_path(info.filename)
+            out.writestr(info, output)
+
+
+def _convert_tar(
+    archive: tarfile.TarFile,
+    out: tarfile.TarFile,
+    tag_cache: TagCache | None,
+    timeout: float | None,
+    report: BatchReport,
+) -> None:
+    for member in archive:
+        if not member.name.endswith(".tpl"):
+            out.addfile(member, archive.extractfile(member) if member.isreg() else None)
+            continue
+
+        converted = copy.copy(member)
+        converted.name = twig_path(member.name)
+        if not member.isreg():
+            # Links to templates follow them to their .twig names.
+            if member.linkname.endswith(".tpl"):
+                converted.linkname = twig_path(member.linkname)
+            out.addfile(converted)
+            continue
+
+        f = archive.extractfile(member)
+        assert f is not None
+        data = f.read()
+        output = _convert(member.name, data, tag_cache, timeout, report)
+        if output is None:
+            out.addfile(member, io.BytesIO(data))
+        else:
+            converted.size = len(output)
+            out.addfile(converted, io.BytesIO(output))
+
+
+def _convert(
+    name: str,
+    data: bytes,
+    tag_cache: TagCache | None,
+    timeout: float | None,
+    report: BatchReport,
+) -> bytes | None:
+    # Returns None when the template fails, to be copied as it is.
+    found = dependencies(data)
+    if found:
+        report.dependencies[name] = found
+    try:
+        if is_verbatim(data):
+            report.copied += 1
+            return data
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        output = b"".join(convert_bytes(data, tag_cache, deadline))
+    except ERRORS as e:
+        report.failed.append((name, "%s: %s" % (type(e).__name__, e)))
+        return None
+    report.converted += 1
+    return output
@@ -0,0 +1,690 @@
+"""
+Conversion of whole template trees.
+
+convert_tree() converts every .tpl file under a directory into a .twig
+file at the same relative path under the target directory. Files without
+any "{" cannot hold a Smarty tag and convert to themselves, so they are
+copied byte for byte, in the kernel where the platform allows it, or hard
+linked when asked to, without being decoded.
+
+Targets that already hold the output are not written at all, so their
+mtime only changes when their content does.
+
+A tree can be split into shards converted on different machines, each
+saving its BatchReport as JSON for merge() to combine.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import heapq
+import json
+import mmap
+import os
+import re
+import shutil
+import time
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+from typing import BinaryIO
+
+from . import iter_convert
+from .journal import CONVERTED, COPIED, FAILED, Journal, digest
+from .mapped import convert_buffer
+from .profiling import Profiles, profiling
+from .stack_parser import OverBudgetError
+from .stats import DUPLICATE, StatsLog, TemplateStats, trace
+from .tag_cache import TagCache
+
+# The errors that fail a single template without stopping a batch.
+ERRORS = (OSError, OverBudgetError, RecursionError, SyntaxError, UnicodeDecodeError)
+
+# Include and extends tags naming a template by a string literal.
+_DEPENDENCY = re.compile(rb"\{[ \t\n]*(?:include|extends)[ \t\n]+file=([\"'])([^\"'{}]*)\1")
+
+# Templates this large are converted from a memory map.
+MAPPED_SIZE = 1 << 22
+
+# Bytes of a target compared with its source at a time.
+_COMPARE_BLOCK = 1 << 20
+
+# What sharding counts a file as weighing on top of its size.
+_FILE_WEIGHT = 4096
+
+
+class BatchReport:
+    """
+    What a batch run did.
+    """
+
+    converted: int
+    copied: int
+    unchanged: int
+    # Templates with the same content as one converted before, whose
+    # output was reused.
+    duplicates: int
+    # Templates a resumed run found done already, see journal.Journal.
+    resumed: int
+    failed: list[tuple[str, str]]
+    elapsed: float | None
+    # Time from the first conversion process running out of work to the
+    # end of a parallel run.
+    tail_latency: float | None
+    # The templates each template includes or extends.
+    dependencies: dict[str, list[str]]
+    # The (index, count) of the shard converted, see select_shard().
+    shard: tuple[int, int] | None
+
+    def __init__(self) -> None:
+        self.converted = 0
+        self.copied = 0
+        self.unchanged = 0
+        self.duplicates = 0
+        self.resumed = 0
+        self.failed = []
+        self.elapsed = None
+        self.tail_latency = None
+        self.dependencies = {}
+        self.shard = None
+
+    def summary(self) -> str:
+        summary = "%d templates converted, %d copied verbatim, %d unchanged, %d failed" % (
+            self.converted,
+            self.copied,
+            self.unchanged,
+            len(self.failed),
+        )
+        if self.duplicates:
+            summary += ", %d duplicates skipped" % self.duplicates
+        if self.resumed:
+            summary += ", %d done before resuming" % self.resumed
+        if self.elapsed is not None and self.tail_latency is not None:
+            summary += " in %.2fs, %.2fs of it with idle workers" % (
+                self.elapsed,
+                self.tail_latency,
+            )
+        return summary
+
+    def save(self, file_name: str, root: str | None = None) -> None:
+        """
+        Write the report to a JSON file, with template paths relative to
+        *root* when given.
+        """
+
+        def path(source: str) -> str:
+            if root is not None:
+                source = os.path.relpath(source, root)
+            return source.replace(os.sep, "/")
+
+        report = {
+            "shard": list(self.shard) if self.shard else None,
+            "converted": self.converted,
+            "copied": self.copied,
+            "unchanged": self.unchanged,
+            "duplicates": self.duplicates,
+            "resumed": self.resumed,
+            "elapsed": self.elapsed,
+            "tail_latency": self.tail_latency,
+            "failed": {path(source): error for source, error in self.failed},
+            "dependencies": {
+                path(source): dependencies
+                for source, dependencies in sorted(self.dependencies.items())
+            },
+        }
+        with open(file_name, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=1)
+
+    @classmethod
+    def load(cls, file_name: str) -> BatchReport:
+        """
+        Read a report written by save().
+        """
+        with open(file_name, encoding="utf-8") as f:
+            data = json.load(f)
+        report = cls()
+        if data["shard"]:
+            index, count = data["shard"]
+            report.shard = (index, count)
+        report.converted = data["converted"]
+        report.copied = data["copied"]
+        report.unchanged = data["unchanged"]
+        report.duplicates = data.get("duplicates", 0)
+        report.resumed = data.get("resumed", 0)
+        report.elapsed = data["elapsed"]
+        report.tail_latency = data["tail_latency"]
+        report.failed = sorted(data["failed"].items())
+        report.dependencies = data["dependencies"]
+        return report
+
+    @classmethod
+    def merge(cls, reports: list[BatchReport]) -> BatchReport:
+        """
+        Combine the reports of the shards of one run.
+
+        Raises ValueError unless there is exactly one report per shard. The
+        run took as long as its slowest shard, and had idle machines from
+        the time the fastest one finished.
+        """
+        merged = cls()
+        shards = sorted(report.shard for report in reports if report.shard)
+        counts = {count for _, count in shards}
+        if len(shards) != len(reports) or len(counts) != 1:
+            raise ValueError("reports are not from the shards of one run")
+        (count,) = counts
+        missing = sorted(set(range(1, count + 1)) - {index for index, _ in shards})
+        if missing:
+            raise ValueError("missing shards %s" % ", ".join("%d/%d" % (k, count) for k in missing))
+        if len(shards) != count:
+            raise ValueError("duplicate shard reports")
+
+        for report in reports:
+            merged.converted += report.converted
+            merged.copied += report.copied
+            merged.unchanged += report.unchanged
+            merged.duplicates += report.duplicates
+            merged.resumed += report.resumed
+            merged.failed.extend(report.failed)
+            merged.dependencies.update(report.dependencies)
+        merged.failed.sort()
+        elapsed = [report.elapsed for report in reports if report.elapsed is not None]
+        if len(elapsed) == len(reports):
+            merged.elapsed = max(elapsed)
+            merged.tail_latency = max(elapsed) - min(elapsed)
+        return merged
+
+
+def twig_path(source: str) -> str:
+    """
+    Return the name of the Twig file for the template *source*.
+    """
+    if source.endswith(".tpl"):
+        source = source[: -len(".tpl")]
+    return source + ".twig"
+
+
+def iter_templates(source_dir: str) -> list[str]:
+    """
+    Return the paths of the templates under *source_dir*, relative to it.
+    """
+    templates = []
+    for dir_path, dir_names, file_names in os.walk(source_dir):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            if file_name.endswith(".tpl"):
+                templates.append(os.path.relpath(os.path.join(dir_path, file_name), source_dir))
+    return templates
+
+
+def select_shard(templates: list[tuple[str, int]], index: int, count: int) -> list[str]:
+    """
+    Return the templates of shard *index* of *count*, counting from 1, out
+    of *templates*, given as ``(path, size)``.
+
+    Every machine given the same templates picks the same shards: the
+    largest templates are dealt out first, each to the lightest shard so
+    far, with ties in size ordered by a hash of the path.
+    """
+    if not 1 <= index <= count:
+        raise ValueError("shard %d/%d does not exist" % (index, count))
+
+    def order(template: tuple[str, int]) -> tuple[int, str]:
+        path, size = template
+        digest = hashlib.sha1(path.replace(os.sep, "/").encode("utf-8")).hexdigest()
+        return -size, digest
+
+    shards = [(0, shard) for shard in range(1, count + 1)]
+    selected = []
+    for path, size in sorted(templates, key=order):
+        load, shard = heapq.heappop(shards)
+        heapq.heappush(shards, (load + size + _FILE_WEIGHT, shard))
+        if shard == index:
+            selected.append(path)
+    return sorted(selected)
+
+
+def dependencies(data: bytes | mmap.mmap) -> list[str]:
+    """
+    Return the templates a template includes or extends by name.
+    """
+    return [name.decode("utf-8", "replace") for _, name in _DEPENDENCY.findall(data)]
+
+
+def remove_partial(target: str) -> None:
+    """
+    Remove the side file of *target*, left if writing it was cut short.
+    """
+    try:
+        os.unlink(target + ".part")
+    except FileNotFoundError:
+        pass
+
+
+class ChangedFileWriter:
+    """
+    Writes a file atomically, and only if its content changes.
+
+    Data written is compared with the existing file as it comes. Nothing
+    goes to disk until the two differ, then the matching part is copied to
+    a side file that replaces the file on close(). If they never differ
+    the file is left untouched, mtime included.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._partial: BinaryIO | None = None
+        self._matched = 0
+        try:
+            self._old: BinaryIO | None = open(path, "rb")
+        except FileNotFoundError:
+            self._old = None
+            try:
+                self._diverge()
+            except BaseException:
+                self.abort()
+                raise
+
+    def write(self, data: bytes) -> None:
+        if self._partial is None:
+            assert self._old is not None
+            if self._old.read(len(data)) == data:
+                self._matched += len(data)
+                return
+            self._diverge()
+        assert self._partial is not None
+        self._partial.write(data)
+
+    def close(self) -> bool:
+        """
+        Finish the file, returning whether it was written.
+        """
+        try:
+            if self._partial is None:
+                assert self._old is not None
+                if self._old.read(1):
+                    # The old file is longer.
+                    self._diverge()
+                else:
+                    self._old.close()
+                    return False
+            assert self._partial is not None
+            self._partial.close()
+            if self._old is not None:
+                self._old.close()
+            os.replace(self.path + ".part", self.path)
+        except BaseException:
+            self.abort()
+            raise
+        return True
+
+    def abort(self) -> None:
+        """
+        Give up, leaving the file as it was.
+        """
+        if self._old is not None:
+            self._old.close()
+        if self._partial is not None:
+            self._partial.close()
+            remove_partial(self.path)
+
+    def _diverge(self) -> None:
+        # A leftover side file may be a hard link to the source, so it is
+        # removed and created afresh rather than written through. Set
+        # before anything is written, so abort() removes it however far
+        # this gets.
+        remove_partial(self.path)
+        self._partial = open(self.path + ".part", "xb")
+        if self._old is not None:
+            self._old.seek(0)
+            self._partial.write(self._old.read(self._matched))
+
+
+def convert_file(
+    source: str,
+    target: str,
+    link: bool = False,
+    tag_cache: TagCache | None = None,
+    timeout: float | None = None,
+) -> tuple[bool, bool]:
+    """
+    Convert the template *source* into *target*, in at most *timeout*
+    seconds.
+
+    Returns whether the file had no tags and was copied or linked verbatim,
+    and whether the target was written, which it is not when it already
+    holds the output.
+
+    Templates of MAPPED_SIZE bytes or more are memory-mapped and only
+    their tags decoded, see read_template().
+    """
+    # The side file of a conversion killed while writing it.
+    remove_partial(target)
+    with read_template(source) as data:
+        return convert_data(source, target, data, link, tag_cache, timeout)
+
+
+@contextmanager
+def read_template(source: str) -> Iterator[bytes | mmap.mmap]:
+    """
+    Yield the content of the template *source*, memory-mapped if it is
+    MAPPED_SIZE bytes or more, so that it is never read whole.
+    """
+    with open(source, "rb") as f:
+        if os.fstat(f.fileno()).st_size < MAPPED_SIZE:
+            yield f.read()
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+
+
+def convert_data(
+    source: str,
+    target: str,
+    data: bytes | mmap.mmap,
+    link: bool = False,
+    tag_cache: TagCache | None = None,
+    timeout: float | None = None,
+    stats: TemplateStats | None = None,
+) -> tuple[bool, bool]:
+    """
+    Convert the template *source*, whose content is *data*, like
+    convert_file(), measuring the conversion into *stats*.
+
+    Of mapped content, see read_template(), only the tags are decoded, by
+    mapped.convert_buffer(), and the conversion is not measured.
+    """
+    if is_verbatim(data):
+        return True, copy_template(source, target, data, link)
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    if isinstance(data, mmap.mmap):
+        return False, write_output(target, convert_buffer(data, tag_cache, deadline))
+    return False, write_converted(target, data, tag_cache, deadline, stats)
+
+
+def is_verbatim(data: bytes | mmap.mmap) -> bool:
+    """
+    Tell whether a template converts to itself.
+    """
+    # Converting would also turn \r\n into \n, so those files do not.
+    return b"{" not in data and b"\r" not in data
+
+
+def convert_bytes(
+    data: bytes,
+    tag_cache: TagCache | None = None,
+    deadline: float | None = None,
+    stats: TemplateStats | None = None,
+) -> Iterator[bytes]:
+    """
+    Convert a UTF-8 encoded template, yielding the encoded output.
+
+    Parsing past the time.monotonic() *deadline* raises OverBudgetError.
+    Given *stats*, the conversion is measured into it.
+    """
+    text = data.decode("utf-8")
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    if stats is None:
+        fragments = iter_convert(text, tag_cache, deadline)
+    else:
+        fragments = stats.convert(text, tag_cache, deadline)
+    for fragment in fragments:
+        if os.linesep != "\n":
+            fragment = fragment.replace("\n", os.linesep)
+        yield fragment.encode("utf-8")
+
+
+def write_converted(
+    target: str,
+    data: bytes,
+    tag_cache: TagCache | None = None,
+    deadline: float | None = None,
+    stats: TemplateStats | None = None,
+) -> bool:
+    """
+    Convert the template *data* into *target* with convert_bytes(),
+    returning whether it was written.
+    """
+    if stats is None:
+        return write_output(target, convert_bytes(data, tag_cache, deadline))
+    started = time.perf_counter()
+    written = write_output(target, convert_bytes(data, tag_cache, deadline, stats))
+    elapsed = (time.perf_counter() - started) * 1000
+    stats.write_ms = elapsed - stats.parse_ms - stats.print_ms
+    return written
+
+
+def write_output(target: str, fragments: Iterable[bytes]) -> bool:
+    """
+    Write *fragments* to *target*, returning whether it was written.
+    """
+    # A side file is renamed over the target, so a failure leaves the
+    # target alone and a hard linked target never gets written through.
+    writer = ChangedFileWriter(target)
+    try:
+        for fragment in fragments:
+            writer.write(fragment)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.close()
+
+
+def copy_template(source: str, target: str, data: bytes | mmap.mmap, link: bool = False) -> bool:
+    """
+    Copy or link the template *source*, whose content is *data*, to
+    *target* unless it already holds that, returning whether it was written.
+    """
+    if _same_content(target, source, data):
+        return False
+    with open(source, "rb") as f:
+        _copy(f, source, target, link)
+    return True
+
+
+def _same_content(target: str, source: str, data: bytes | mmap.mmap) -> bool:
+    try:
+        stat = os.stat(target)
+    except FileNotFoundError:
+        return False
+    if stat.st_size != len(data):
+        return False
+    if os.path.samefile(target, source):
+        return True
+    # Block by block, as mapped content is not to be read whole.
+    with open(target, "rb") as f:
+        for offset in range(0, len(data), _COMPARE_BLOCK):
+            if f.read(_COMPARE_BLOCK) != data[offset : offset + _COMPARE_BLOCK]:
+                return False
+    return True
+
+
+def _copy(src: BinaryIO, source: str, target: str, link: bool) -> None:
+    # A side file left by a run killed after linking it would be the
+    # source itself: written through, it would truncate the source.
+    remove_partial(target)
+    partial = target + ".part"
+    if link:
+        try:
+            os.link(source, partial)
+        except OSError:
+            # Another file system, or links not supported: copy instead.
+            pass
+        else:
+            os.replace(partial, target)
+            return
+
+    # Created afresh, never opened through a link to another file.
+    dst = open(partial, "xb")
+    try:
+        with dst:
+            size = os.fstat(src.fileno()).st_size
+            _copy_range(src, dst, size)
+    except BaseException:
+        os.unlink(partial)
+        raise
+    os.replace(partial, target)
+
+
+def _copy_range(src: BinaryIO, dst: BinaryIO, size: int) -> None:
+    offset = 0
+    try:
+        while offset < size:
+            copied = os.copy_file_range(src.fileno(), dst.fileno(), size - offset, offset, offset)
+            if copied == 0:
+                break
+            offset += copied
+        return
+    except (AttributeError, OSError):
+        pass
+
+    try:
+        while offset < size:
+            dst.seek(offset)
+            copied = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+            if copied == 0:
+                break
+            offset += copied
+        return
+    except (AttributeError, OSError):
+        pass
+
+    src.seek(offset)
+    dst.seek(offset)
+    shutil.copyfileobj(src, dst)
+
+
+def convert_tree(
+    source_dir: str,
+    target_dir: str,
+    link: bool = False,
+    tag_cache: TagCache | None = None,
+    jobs: int = 1,
+    shard: tuple[int, int] | None = None,
+    timeout: float | None = None,
+    memory_limit: int | None = None,
+    recycle: int | None = None,
+    journal: Journal | None = None,
+    templates: list[str] | None = None,
+    backend: str = "processes",
+    stats: StatsLog | None = None,
+    profiles: Profiles | None = None,
+) -> BatchReport:
+    """
+    Convert every template under *source_dir* into *target_dir*, in *jobs*
+    processes, or only *templates*, given relative to *source_dir*. With
+    the "threads" *backend*, jobs are threads, see pipeline.Pipeline. The
+    tag cache is only used by threads of this process.
+
+    Given a *shard* ``(index, count)``, only the templates select_shard()
+    picks for it are converted. Templates taking more than *timeout*
+    seconds fail. A *memory_limit* or *recycle* count, see Pipeline, runs
+    conversions in separate processes even for a single job. Templates
+    are recorded in the *journal*, and skipped if it has them done, and
+    measured into *stats*. Conversions are profiled into *profiles*.
+
+    Templates with the same content are converted once, the output being
+    written to each target.
+    """
+    if templates is None:
+        templates = iter_templates(source_dir)
+    if shard is not None:
+        sizes = []
+        for template in templates:
+            try:
+                size = os.stat(os.path.join(source_dir, template)).st_size
+            except OSError:
+                size = 0
+            sizes.append((template, size))
+        templates = select_shard(sizes, *shard)
+    files = [
+        (os.path.join(source_dir, template), os.path.join(target_dir, twig_path(template)))
+        for template in templates
+    ]
+    # Side files of a run killed while writing them.
+    for _, target in files:
+        remove_partial(target)
+    if jobs > 1 or memory_limit or recycle:
+        from .pipeline import Pipeline
+
+        report = Pipeline(
+            jobs,
+            link,
+            timeout=timeout,
+            memory_limit=memory_limit,
+            recycle=recycle,
+            journal=journal,
+            backend=backend,
+            tag_cache=tag_cache if backend == "threads" else None,
+            stats=stats,
+            profiles=profiles,
+        ).run(files)
+        report.shard = shard
+        return report
+
+    report = BatchReport()
+    report.shard = shard
+    # The target converted, or the error, of each content converted.
+    outputs: dict[str, str] = {}
+    errors: dict[str, str] = {}
+    with trace(stats is not None and stats.memory), profiling(profiles):
+        for source, target in files:
+            source_digest = None
+            size = None
+            try:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with read_template(source) as data:
+                    size = len(data)
+                    found = dependencies(data)
+                    if found:
+                        report.dependencies[source] = found
+                    source_digest = digest(data)
+                    if journal is not None and journal.is_done(source, source_digest, target):
+                        report.resumed += 1
+                        continue
+                    if source_digest in errors:
+                        report.failed.append((source, errors[source_digest]))
+                        if journal is not None:
+                            journal.record(source, source_digest, FAILED)
+                        if stats is not None:
+                            stats.record(source, FAILED, size)
+                        continue
+                    measured = None
+                    if source_digest in outputs:
+                        with open(outputs[source_digest], "rb") as f:
+                            written = write_output(target, [f.read()])
+                        copied = False
+                        status = DUPLICATE
+                        report.duplicates += 1
+                    else:
+                        if stats is not None and not isinstance(data, mmap.mmap):
+                            measured = TemplateStats()
+                        copied, written = convert_data(
+                            source, target, data, link, tag_cache, timeout, measured
+                        )
+                        if not copied:
+                            outputs[source_digest] = target
+                            status = CONVERTED
+                            report.converted += 1
+                        else:
+                            measured = None
+                            status = COPIED
+                            report.copied += 1
+                if journal is not None:
+                    journal.record(source, source_digest, COPIED if copied else CONVERTED, target)
+                if stats is not None:
+                    stats.record(source, status, size, measured)
+                if not written:
+                    report.unchanged += 1
+            except ERRORS as e:
+                error = "%s: %s" % (type(e).__name__, e)
+                report.failed.append((source, error))
+                if source_digest is not None:
+                    # Duplicates fail the same way, unless the error was in
+                    # reading or writing files.
+                    if not isinstance(e, OSError) and source_digest not in outputs:
+                        errors[source_digest] = error
+                    if journal is not None:
+                        journal.record(source, source_digest, FAILED)
+                if stats is not None:
+                    stats.record(source, FAILED, size)
+    return report
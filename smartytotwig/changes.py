@@ -0,0 +1,148 @@
+"""
+Templates changed in a git repository, for converting only those.
+
+changed_templates() asks git for the templates added, modified or renamed
+since a revision, or staged for commit, and follows {include} and
+{extends} tags back to the templates depending on them, since their
+output may change too, deleted and renamed templates included.
+Candidates for depending on a template are found with git grep on its
+file name, so the rest of the tree is not read: in the work tree,
+untracked files included, or in the index for staged changes alone.
+"""
+
+from __future__ import annotations
+
+import os
+import posixpath
+import subprocess
+
+from .batch import dependencies
+
+# The templates git is asked about.
+_PATHSPEC = "*.tpl"
+
+
+def _git(source_dir: str, *args: str, input: str | None = None) -> list[str]:
+    # Runs from source_dir, so paths come relative to it, "/" separated.
+    result = subprocess.run(
+        ["git", "-C", source_dir, *args], input=input, capture_output=True, text=True
+    )
+    # git grep exits with 1 when nothing matches.
+    if result.returncode and (args[0] != "grep" or result.returncode != 1 or result.stderr):
+        raise subprocess.CalledProcessError(
+            result.returncode, result.args, result.stdout, result.stderr
+        )
+    return [path for path in result.stdout.split("\0") if path]
+
+
+def _diff(source_dir: str, since: str | None, staged: bool, *options: str) -> set[str]:
+    # Outside a repository git diff would compare files instead.
+    _git(source_dir, "rev-parse", "--git-dir")
+    diff = ["diff", "--name-only", "-z", "--relative", *options]
+    paths = set()
+    if staged:
+        paths.update(_git(source_dir, *diff, "--cached", "--", _PATHSPEC))
+    if since is not None:
+        paths.update(_git(source_dir, *diff, since, "--", _PATHSPEC))
+    return paths
+
+
+def git_changes(source_dir: str, since: str | None = None, staged: bool = False) -> list[str]:
+    """
+    Return the templates under *source_dir* that were added, modified or
+    renamed in the work tree since the revision *since*, or staged for
+    commit, relative to *source_dir*. Untracked templates count as added
+    since a revision.
+    """
+    changed = _diff(source_dir, since, staged, "-M", "--diff-filter=ACMR")
+    if since is not None:
+        changed.update(
+            _git(source_dir, "ls-files", "-z", "--others", "--exclude-standard", "--", _PATHSPEC)
+        )
+    return sorted(path for path in changed if os.path.isfile(os.path.join(source_dir, path)))
+
+
+def git_removals(source_dir: str, since: str | None = None, staged: bool = False) -> list[str]:
+    """
+    Return the templates under *source_dir* that were deleted or renamed
+    away like git_changes() finds changes, relative to *source_dir*.
+    """
+    # Without rename detection, a rename is the deletion of its source.
+    return sorted(_diff(source_dir, since, staged, "--no-renames", "--diff-filter=D"))
+
+
+def _resolve(template: str, name: str) -> str:
+    """
+    Return the path of the template *name* included from *template*.
+    """
+    if name.startswith(("./", "../")):
+        name = posixpath.join(posixpath.dirname(template), name)
+    return posixpath.normpath(name)
+
+
+def _read(source_dir: str, template: str, cached: bool) -> bytes:
+    if not cached:
+        with open(os.path.join(source_dir, template), "rb") as f:
+            return f.read()
+    result = subprocess.run(
+        ["git", "-C", source_dir, "show", ":./" + template], capture_output=True
+    )
+    if result.returncode:
+        raise OSError("%s is not in the index" % template)
+    return result.stdout
+
+
+def dependents(source_dir: str, templates: list[str], cached: bool = False) -> list[str]:
+    """
+    Return the templates under *source_dir* that include or extend any of
+    *templates*, directly or not, as they are in the work tree, or in the
+    index if *cached*.
+    """
+    found = set(templates)
+    frontier = set(templates)
+    where = "--cached" if cached else "--untracked"
+    while frontier:
+        names = sorted({posixpath.basename(template) for template in frontier})
+        candidates = _git(
+            source_dir,
+            "grep",
+            where,
+            "-l",
+            "-z",
+            "-F",
+            "-f",
+            "-",
+            "--",
+            _PATHSPEC,
+            input="\n".join(names) + "\n",
+        )
+        reached = set()
+        for candidate in candidates:
+            if candidate in found:
+                continue
+            try:
+                data = _read(source_dir, candidate, cached)
+            except OSError:
+                continue
+            if any(_resolve(candidate, name) in frontier for name in dependencies(data)):
+                reached.add(candidate)
+        found |= reached
+        frontier = reached
+    return sorted(found - set(templates))
+
+
+def changed_templates(source_dir: str, since: str | None = None, staged: bool = False) -> list[str]:
+    """
+    Return the templates git_changes() finds along with their dependents
+    and those of the templates git_removals() finds, relative to
+    *source_dir*. Staged changes alone are followed in the index.
+    """
+    changed = git_changes(source_dir, since, staged)
+    removed = git_removals(source_dir, since, staged)
+    if not changed and not removed:
+        return []
+    found = dependents(source_dir, changed + removed, cached=since is None)
+    # Those in the index may be gone from the work tree.
+    found = [path for path in found if os.path.isfile(os.path.join(source_dir, path))]
+    templates = sorted(set(changed + found) - set(removed))
+    return [template.replace("/", os.sep) for template in templates]
@@ -0,0 +1,362 @@
+"""
+A compact encoding of the AST for tools that keep many templates parsed.
+
+Instead of one Python object per node, a CompactTree keeps its nodes in
+parallel arrays indexed by node number, in pre-order: node type code,
+parent, first child, next sibling and source start/end offsets. Leaf
+values are codes into a StringTable, which can be shared by any number of
+trees so that identifiers, class names and other repeated text is stored
+once per corpus.
+
+Cursor points at one node of a tree and is walked like the object AST:
+it has children, child and value, and its kind is the node class it
+stands for. accept() calls the visitor with the same arguments
+Rule.accept() would, for a node object of that class holding its direct
+children, so TwigPrinter prints it unchanged.
+
+Tags looked up in a TagCache are kept as CachedStatement nodes, with
+their tag, cache and output in a side list.
+"""
+
+from __future__ import annotations
+
+from array import array
+from typing import Any
+
+from . import smarty_grammar
+from .smarty_grammar import (
+    EmptyLeafRule,
+    LeafRule,
+    Rule,
+    SmartyLanguageMainOrEmpty,
+    SourceLeafRule,
+    UnaryRule,
+)
+from .stack_parser import StackParser
+from .tag_cache import CachedStatement, TagCache
+
+# Node classes by type code, in the order smarty_grammar defines them,
+# then those the parser builds for a tag cache.
+NODE_TYPES: list[type] = [
+    cls
+    for cls in vars(smarty_grammar).values()
+    if isinstance(cls, type) and issubclass(cls, (Rule, UnaryRule, LeafRule, EmptyLeafRule))
+] + [CachedStatement]
+_type_codes = {cls: code for code, cls in enumerate(NODE_TYPES)}
+
+# How the children of each node type are stored, by type code.
+_RULE = 0
+_UNARY = 1
+_LEAF = 2
+_EMPTY = 3
+_shapes = [
+    _RULE
+    if issubclass(cls, Rule)
+    else _UNARY
+    if issubclass(cls, UnaryRule)
+    else _LEAF
+    if issubclass(cls, LeafRule)
+    else _EMPTY
+    for cls in NODE_TYPES
+]
+# What accept() strips from leaf values, see SourceLeafRule.body.
+_delimiters = [cls.delimiters if issubclass(cls, SourceLeafRule) else (0, 0) for cls in NODE_TYPES]
+
+# Value codes that are not string table codes.
+_NO_VALUE = -1
+_FIRST_SEQUENCE = -2
+
+
+class StringTable:
+    """
+    Interned strings, each stored once and referred to by its code.
+    """
+
+    strings: list[str]
+
+    def __init__(self) -> None:
+        self.strings = []
+        self._codes: dict[str, int] = {}
+
+    def add(self, string: str) -> int:
+        """
+        Return the code of *string*, adding it if it is new.
+        """
+        code = self._codes.get(string)
+        if code is None:
+            code = self._codes[string] = len(self.strings)
+            self.strings.append(string)
+        return code
+
+    def __getitem__(self, code: int) -> str:
+        return self.strings[code]
+
+    def __len__(self) -> int:
+        return len(self.strings)
+
+
+class CompactTree:
+    """
+    An AST stored as parallel arrays, see the module docstring.
+
+    Node 0 is the root. Missing links and unknown offsets are -1.
+    """
+
+    types: array[int]
+    parents: array[int]
+    first_children: array[int]
+    next_siblings: array[int]
+    starts: array[int]
+    ends: array[int]
+    values: array[int]
+    strings: StringTable
+    sequences: list[tuple[int, ...]]
+    cached: list[tuple[str, TagCache, str | None]]
+
+    def __init__(self, strings: StringTable | None = None) -> None:
+        self.types = array("B")
+        self.parents = array("i")
+        self.first_children = array("i")
+        self.next_siblings = array("i")
+        self.starts = array("i")
+        self.ends = array("i")
+        self.values = array("i")
+        self.strings = strings if strings is not None else StringTable()
+        # Leaf values that are lists of strings, such as Text.
+        self.sequences = []
+        # The tag, cache and output of CachedStatement nodes, by value.
+        self.cached = []
+
+    @classmethod
+    def from_ast(
+        cls,
+        root: Any,
+        spans: dict[int, tuple[int, int]] | None = None,
+        strings: StringTable | None = None,
+    ) -> CompactTree:
+        """
+        Encode the object AST under *root*.
+
+        *spans* maps node ids to source offsets, as recorded by StackParser.
+        """
+        tree = cls(strings)
+        last_children = array("i")
+        stack = [(root, -1)]
+        while stack:
+            node, parent = stack.pop()
+            code = _type_codes.get(type(node))
+            if code is None:
+                raise TypeError("not an AST node: %r" % (node,))
+
+            index = len(tree.types)
+            tree.types.append(code)
+            tree.parents.append(parent)
+            tree.first_children.append(-1)
+            tree.next_siblings.append(-1)
+            last_children.append(-1)
+            start, end = spans.get(id(node), (-1, -1)) if spans else (-1, -1)
+            tree.starts.append(start)
+            tree.ends.append(end)
+            if parent != -1:
+                if last_children[parent] == -1:
+                    tree.first_children[parent] = index
+                else:
+                    tree.next_siblings[last_children[parent]] = index
+                last_children[parent] = index
+
+            shape = _shapes[code]
+            if shape == _LEAF:
+                tree.values.append(tree._encode(node.value))
+            elif type(node) is CachedStatement:
+                tree.values.append(len(tree.cached))
+                tree.cached.append((node.tag, node.cache, node.output))
+                stack.extend((child, index) for child in reversed(node.children))
+            else:
+                tree.values.append(_NO_VALUE)
+                if shape == _RULE:
+                    stack.extend((child, index) for child in reversed(node.children))
+                elif shape == _UNARY:
+                    stack.append((node.child, index))
+        return tree
+
+    def to_ast(self, index: int = 0) -> Any:
+        """
+        Decode the subtree under node *index* back into node objects.
+        """
+        # Pre-order keeps every subtree contiguous, so building from the
+        # back finds the children of each node already built.
+        built: dict[int, Any] = {}
+        for current in range(self._subtree_end(index) - 1, index - 1, -1):
+            cls = NODE_TYPES[self.types[current]]
+            shape = _shapes[self.types[current]]
+            if cls is CachedStatement:
+                children = [built.pop(child) for child in self._child_indexes(current)]
+                node = cls(children, *self.cached[self.values[current]])
+            elif shape == _RULE:
+                node = cls([built.pop(child) for child in self._child_indexes(current)])
+            elif shape == _UNARY:
+                node = cls(built.pop(self.first_children[current]))
+            elif shape == _LEAF:
+                node = cls(self._decode(self.values[current]))
+            else:
+                node = cls()
+            built[current] = node
+        return built[index]
+
+    @property
+    def root(self) -> Cursor:
+        return Cursor(self, 0)
+
+    def __len__(self) -> int:
+        return len(self.types)
+
+    def _encode(self, value: Any) -> int:
+        if value is None:
+            return _NO_VALUE
+        if isinstance(value, str):
+            return self.strings.add(value)
+        if isinstance(value, list):
+            self.sequences.append(tuple(self.strings.add(item) for item in value))
+            return _FIRST_SEQUENCE - (len(self.sequences) - 1)
+        raise TypeError("cannot encode leaf value %r" % (value,))
+
+    def _decode(self, code: int) -> Any:
+        if code >= 0:
+            return self.strings[code]
+        if code == _NO_VALUE:
+            return None
+        return [self.strings[item] for item in self.sequences[_FIRST_SEQUENCE - code]]
+
+    def _stand_in(self, index: int) -> Any:
+        # A node object of the class of node *index* for visitors: its
+        # children are bare objects of their classes, which is as far as
+        # visitors look.
+        code = self.types[index]
+        cls = NODE_TYPES[code]
+        shape = _shapes[code]
+        if shape == _LEAF:
+            return cls(self._decode(self.values[index]))
+        node = cls.__new__(cls)
+        if shape == _RULE:
+            node.children = [self._bare(child) for child in self._child_indexes(index)]
+        elif shape == _UNARY:
+            node.child = self._bare(self.first_children[index])
+        if cls is CachedStatement:
+            node.tag, node.cache, node.output = self.cached[self.values[index]]
+        return node
+
+    def _bare(self, index: int) -> Any:
+        cls = NODE_TYPES[self.types[index]]
+        return cls.__new__(cls)
+
+    def _child_indexes(self, index: int) -> list[int]:
+        children = []
+        child = self.first_children[index]
+        while child != -1:
+            children.append(child)
+            child = self.next_siblings[child]
+        return children
+
+    def _subtree_end(self, index: int) -> int:
+        while index != -1:
+            if self.next_siblings[index] != -1:
+                return self.next_siblings[index]
+            index = self.parents[index]
+        return len(self.types)
+
+
+class Cursor:
+    """
+    A node of a CompactTree, standing in for the node object of class kind.
+    """
+
+    __slots__ = ("tree", "index", "kind")
+
+    tree: CompactTree
+    index: int
+    kind: type
+
+    def __init__(self, tree: CompactTree, index: int) -> None:
+        self.tree = tree
+        self.index = index
+        self.kind = NODE_TYPES[tree.types[index]]
+
+    @property
+    def children(self) -> list[Cursor]:
+        return [Cursor(self.tree, child) for child in self.tree._child_indexes(self.index)]
+
+    @property
+    def child(self) -> Cursor:
+        return Cursor(self.tree, self.tree.first_children[self.index])
+
+    @property
+    def value(self) -> Any:
+        return self.tree._decode(self.tree.values[self.index])
+
+    @property
+    def parent(self) -> Cursor | None:
+        parent = self.tree.parents[self.index]
+        return Cursor(self.tree, parent) if parent != -1 else None
+
+    @property
+    def start(self) -> int:
+        return self.tree.starts[self.index]
+
+    @property
+    def end(self) -> int:
+        return self.tree.ends[self.index]
+
+    def accept(self, visitor: Any) -> Any:
+        """
+        Visit the subtree bottom up like Rule.accept(), without recursion.
+        """
+        tree = self.tree
+        results: list[Any] = []
+        # Entries are (index, child count), the count is -1 until the
+        # children of the node have been pushed.
+        stack = [(self.index, -1)]
+        while stack:
+            index, count = stack.pop()
+            shape = _shapes[tree.types[index]]
+            if count == -1 and shape in (_RULE, _UNARY):
+                children = tree._child_indexes(index)
+                stack.append((index, len(children)))
+                stack.extend((child, -1) for child in reversed(children))
+                continue
+
+            node = tree._stand_in(index)
+            if shape == _LEAF:
+                value = node.value
+                opening, closing = _delimiters[tree.types[index]]
+                if opening or closing:
+                    value = value[opening : len(value) - closing]
+                results.append(visitor.visit(node, value))
+            elif shape == _EMPTY:
+                results.append(visitor.visit(node))
+            else:
+                arguments = results[len(results) - count :]
+                del results[len(results) - count :]
+                results.append(visitor.visit(node, *arguments))
+        return results[0]
+
+    def __eq__(self, other: object) -> bool:
+        return type(other) is Cursor and self.tree is other.tree and self.index == other.index
+
+    def __hash__(self) -> int:
+        return hash((id(self.tree), self.index))
+
+    def __repr__(self) -> str:
+        return "<%s node %d>" % (self.kind.__name__, self.index)
+
+
+def parse_compact(
+    text: str,
+    language: type = SmartyLanguageMainOrEmpty,
+    strings: StringTable | None = None,
+) -> CompactTree:
+    """
+    Parse a Smarty template string straight into a CompactTree.
+    """
+    spans: dict[int, tuple[int, int]] = {}
+    node = StackParser(text, spans=spans).parse(language)
+    return CompactTree.from_ast(node, spans, strings)
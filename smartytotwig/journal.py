@@ -0,0 +1,114 @@
+"""
+A checkpoint journal for resuming interrupted batch runs.
+
+Each template a run finishes is appended to the journal as a line of
+JSON: its source path, the SHA-1 of its content and of its output, and
+its status. A resumed run skips templates whose source and output still
+hash to what the journal says, so only what was left, or changed since,
+is converted again. Failed templates are always tried again.
+
+Lines are flushed as they are written, after the output is in place, so a
+run killed at any point leaves at worst a torn last line, which is
+ignored.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import mmap
+import threading
+from typing import TextIO
+
+CONVERTED = "converted"
+COPIED = "copied"
+FAILED = "failed"
+
+
+def digest(data: bytes | mmap.mmap) -> str:
+    """
+    Return the digest the journal keeps of *data*.
+    """
+    return hashlib.sha1(data).hexdigest()
+
+
+class Journal:
+    """
+    The journal of a batch run, see the module docstring.
+
+    Unless *resume* is set, the journal starts out empty.
+    """
+
+    file_name: str
+    # Output digests of finished templates by source path and digest.
+    finished: dict[tuple[str, str], str]
+
+    def __init__(self, file_name: str, resume: bool = False) -> None:
+        self.file_name = file_name
+        self.finished = {}
+        torn = resume and self._load()
+        self._file: TextIO = open(file_name, "a" if resume else "w", encoding="utf-8")
+        if torn:
+            self._file.write("\n")
+        self._lock = threading.Lock()
+
+    def is_done(self, source: str, source_digest: str, target: str) -> bool:
+        """
+        Tell whether *source*, whose content hashes to *source_digest*, was
+        converted into *target* and the output is still there.
+        """
+        output_digest = self.finished.get((source, source_digest))
+        if output_digest is None:
+            return False
+        try:
+            with open(target, "rb") as f:
+                return hashlib.file_digest(f, "sha1").hexdigest() == output_digest
+        except OSError:
+            return False
+
+    def record(
+        self, source: str, source_digest: str, status: str, target: str | None = None
+    ) -> None:
+        """
+        Append a template to the journal. The output is read back from
+        *target*, unless the template was copied.
+        """
+        output_digest = None
+        if status == COPIED:
+            output_digest = source_digest
+        elif target is not None:
+            with open(target, "rb") as f:
+                output_digest = hashlib.file_digest(f, "sha1").hexdigest()
+        entry = {
+            "path": source,
+            "source": source_digest,
+            "output": output_digest,
+            "status": status,
+        }
+        with self._lock:
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+    def _load(self) -> bool:
+        # Returns whether the last line was torn by the end of the
+        # interrupted run.
+        try:
+            f = open(self.file_name, encoding="utf-8")
+        except FileNotFoundError:
+            return False
+        line = "\n"
+        with f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                key = (entry["path"], entry["source"])
+                if entry["status"] == FAILED:
+                    self.finished.pop(key, None)
+                else:
+                    self.finished[key] = entry["output"]
+        return not line.endswith("\n")
@@ -1,8 +1,16 @@
 import optparse
+import os
+import subprocess
 import sys
 
-from . import parse_file
-from .twig_printer import TwigPrinter
+from .archive import convert_archive
+from .batch import BatchReport, convert_file, convert_tree
+from .changes import changed_templates
+from .journal import Journal
+from .pipeline import BACKENDS
+from .profiling import Profiles, profiling
+from .stats import StatsLog, load, summarize
+from .tag_cache import TagCache
 
 
 def main() -> None:
@@ -26,25 +34,359 @@ def main() -> None:
         help="The extension that should be used when including files in Twig.",
     )
 
+    opt5 = optparse.make_option(
+        "-c",
+        "--tag-cache",
+        action="store",
+        dest="tag_cache",
+        help="JSON file memoising the Twig output of tags, created if missing.",
+    )
+
+    opt6 = optparse.make_option(
+        "-d",
+        "--smarty-dir",
+        action="store",
+        dest="source_dir",
+        help="Convert every .tpl file under this directory.",
+    )
+
+    opt7 = optparse.make_option(
+        "-o",
+        "--twig-dir",
+        action="store",
+        dest="target_dir",
+        help="Where to write the Twig files of --smarty-dir, defaults to next to the sources.",
+    )
+
+    opt8 = optparse.make_option(
+        "--hard-link",
+        action="store_true",
+        dest="link",
+        default=False,
+        help="Hard link templates without tags instead of copying them.",
+    )
+
+    opt9 = optparse.make_option(
+        "-j",
+        "--jobs",
+        action="store",
+        type="int",
+        dest="jobs",
+        default=1,
+        help="Number of processes converting templates for --smarty-dir.",
+    )
+
+    opt10 = optparse.make_option(
+        "--shard",
+        action="store",
+        dest="shard",
+        help="Only convert shard K/N of the templates of --smarty-dir, K counting from 1.",
+    )
+
+    opt11 = optparse.make_option(
+        "--report",
+        action="store",
+        dest="report",
+        help="Write a JSON report of the --smarty-dir run, or of merge-reports.",
+    )
+
+    opt12 = optparse.make_option(
+        "--timeout",
+        action="store",
+        type="float",
+        dest="timeout",
+        help="Fail templates that take longer than this many seconds to convert.",
+    )
+
+    opt13 = optparse.make_option(
+        "--memory-limit",
+        action="store",
+        type="int",
+        dest="memory_limit",
+        help="Megabytes of memory each conversion process may use, on Unix.",
+    )
+
+    opt14 = optparse.make_option(
+        "--recycle",
+        action="store",
+        type="int",
+        dest="recycle",
+        help="Replace conversion processes after this many templates.",
+    )
+
+    opt15 = optparse.make_option(
+        "--journal",
+        action="store",
+        dest="journal",
+        help="Record the templates --smarty-dir finishes in this file.",
+    )
+
+    opt16 = optparse.make_option(
+        "--resume",
+        action="store_true",
+        dest="resume",
+        default=False,
+        help="Skip templates the --journal has done and unchanged since.",
+    )
+
+    opt17 = optparse.make_option(
+        "--since",
+        action="store",
+        dest="since",
+        help="Only convert --smarty-dir templates changed in git since this revision,"
+        " and those including them.",
+    )
+
+    opt18 = optparse.make_option(
+        "--staged",
+        action="store_true",
+        dest="staged",
+        default=False,
+        help="Only convert --smarty-dir templates staged in git, and those including them.",
+    )
+
+    opt19 = optparse.make_option(
+        "--smarty-archive",
+        action="store",
+        dest="source_archive",
+        help="Convert the templates of this tar or zip archive.",
+    )
+
+    opt20 = optparse.make_option(
+        "--twig-archive",
+        action="store",
+        dest="target_archive",
+        help="The archive to write for --smarty-archive, such as themes.tar.gz.",
+    )
+
+    opt21 = optparse.make_option(
+        "--backend",
+        action="store",
+        type="choice",
+        choices=list(BACKENDS),
+        dest="backend",
+        default="processes",
+        help="What the --jobs are: processes (the default), or threads, which run in"
+        " parallel on a free-threaded Python.",
+    )
+
+    opt22 = optparse.make_option(
+        "--stats",
+        action="store",
+        dest="stats",
+        help="Write JSON lines of what each template of --smarty-dir took to convert.",
+    )
+
+    opt23 = optparse.make_option(
+        "--top",
+        action="store",
+        type="int",
+        dest="top",
+        default=10,
+        help="How many of the slowest templates summarize-stats lists.",
+    )
+
+    opt24 = optparse.make_option(
+        "--stats-memory",
+        action="store_true",
+        dest="stats_memory",
+        default=False,
+        help="Also record the peak memory of each template in --stats, which makes"
+        " converting several times slower.",
+    )
+
+    opt25 = optparse.make_option(
+        "--profile-out",
+        action="store",
+        dest="profile_out",
+        help="Profile the conversion with cProfile, writing pstats to this file and"
+        " collapsed stacks for flame graphs next to it, with a .collapsed suffix.",
+    )
+
     parser = optparse.OptionParser(
-        usage="smartytotwig --smarty-file=<SOURCE TEMPLATE> --twig-file=<OUTPUT TEMPLATE>"
+        usage="smartytotwig --smarty-file=<SOURCE TEMPLATE> --twig-file=<OUTPUT TEMPLATE>\n"
+        "       smartytotwig --smarty-dir=<SOURCE DIR> [--twig-dir=<OUTPUT DIR>]"
+        " [--shard=K/N --report=<REPORT>]\n"
+        "       smartytotwig --smarty-archive=<SOURCE ARCHIVE> --twig-archive=<OUTPUT ARCHIVE>\n"
+        "       smartytotwig merge-reports [--report=<REPORT>] <SHARD REPORT>...\n"
+        "       smartytotwig summarize-stats [--top=N] <STATS>..."
     )
     parser.add_option(opt1)
     parser.add_option(opt2)
     parser.add_option(opt3)
     parser.add_option(opt4)
+    parser.add_option(opt5)
+    parser.add_option(opt6)
+    parser.add_option(opt7)
+    parser.add_option(opt8)
+    parser.add_option(opt9)
+    parser.add_option(opt10)
+    parser.add_option(opt11)
+    parser.add_option(opt12)
+    parser.add_option(opt13)
+    parser.add_option(opt14)
+    parser.add_option(opt15)
+    parser.add_option(opt16)
+    parser.add_option(opt17)
+    parser.add_option(opt18)
+    parser.add_option(opt19)
+    parser.add_option(opt20)
+    parser.add_option(opt21)
+    parser.add_option(opt22)
+    parser.add_option(opt23)
+    parser.add_option(opt24)
+    parser.add_option(opt25)
     options, dummy_args = parser.parse_args(sys.argv)
 
+    if dummy_args[1:2] == ["merge-reports"]:
+        merge_reports(dummy_args[2:], options.report)
+        return
+    if dummy_args[1:2] == ["summarize-stats"]:
+        summarize_stats(dummy_args[2:], options.top)
+        return
+
+    shard = None
+    if options.shard:
+        try:
+            index, count = (int(part) for part in options.shard.split("/"))
+        except ValueError:
+            parser.error("--shard takes K/N, such as 1/4")
+        if not 1 <= index <= count:
+            parser.error("--shard %s does not exist" % options.shard)
+        shard = (index, count)
+
+    if not options.source and not options.source_dir and not options.source_archive:
+        return
+    if options.source_archive and not options.target_archive:
+        parser.error("--smarty-archive needs a --twig-archive")
+    processes = options.memory_limit or options.recycle
+    if processes and options.backend == "threads":
+        parser.error("--memory-limit and --recycle need --backend=processes")
+    if options.tag_cache and (processes or options.jobs > 1 and options.backend == "processes"):
+        parser.error("--tag-cache only works with jobs in this process, see --backend")
+    if options.resume and not options.journal:
+        parser.error("--resume needs a --journal")
+    if options.profile_out and options.jobs > 1 and options.backend == "threads":
+        parser.error("--profile-out needs --backend=processes")
+
+    tag_cache = None
+    if options.tag_cache:
+        if os.path.exists(options.tag_cache):
+            tag_cache = TagCache.load(options.tag_cache)
+        else:
+            tag_cache = TagCache()
+
+    profiles = Profiles() if options.profile_out else None
+    failed = False
     if options.source:
         if not options.target:
             options.target = "%s.twig" % options.source.replace(".tpl", "")
 
-        ast = parse_file(options.source)
-        out = ast.accept(TwigPrinter())
-        with open(options.target, "w", encoding="utf-8") as f:
-            f.write(out)
+        with profiling(profiles):
+            _, written = convert_file(
+                options.source, options.target, options.link, tag_cache, options.timeout
+            )
+        if written:
+            print("Template outputted to %s" % options.target)
+        else:
+            print("Template %s is unchanged" % options.target)
+    elif options.source_archive:
+        try:
+            with profiling(profiles):
+                report = convert_archive(
+                    options.source_archive, options.target_archive, tag_cache, options.timeout
+                )
+        except (OSError, ValueError) as e:
+            sys.exit("smartytotwig: %s" % e)
+        for member, error in report.failed:
+            print("%s: %s" % (member, error), file=sys.stderr)
+        print(report.summary())
+        failed = bool(report.failed)
+    else:
+        templates = None
+        if options.since or options.staged:
+            try:
+                templates = changed_templates(options.source_dir, options.since, options.staged)
+            except (OSError, subprocess.CalledProcessError) as e:
+                message = getattr(e, "stderr", None) or str(e)
+                sys.exit("smartytotwig: git failed: %s" % message.strip())
+
+        journal = Journal(options.journal, options.resume) if options.journal else None
+        stats = StatsLog(options.stats, options.stats_memory) if options.stats else None
+        try:
+            report = convert_tree(
+                options.source_dir,
+                options.target_dir or options.source_dir,
+                options.link,
+                tag_cache,
+                options.jobs,
+                shard,
+                options.timeout,
+                options.memory_limit * 1024 * 1024 if options.memory_limit else None,
+                options.recycle,
+                journal,
+                templates,
+                options.backend,
+                stats,
+                profiles,
+            )
+        finally:
+            if journal is not None:
+                journal.close()
+            if stats is not None:
+                stats.close()
+        for source, error in report.failed:
+            print("%s: %s" % (source, error), file=sys.stderr)
+        print(report.summary())
+        if options.report:
+            report.save(options.report, options.source_dir)
+        failed = bool(report.failed)
+
+    if profiles is not None:
+        profiles.save(options.profile_out)
+        print("Profile written to %s and %s.collapsed" % (options.profile_out, options.profile_out))
+
+    if tag_cache is not None:
+        tag_cache.save(options.tag_cache)
+        print(
+            "Tag cache: %d hits, %d misses (%.1f%%)"
+            % (tag_cache.hits, tag_cache.misses, 100 * tag_cache.hit_rate)
+        )
+
+    if failed:
+        sys.exit(1)
+
+
+def merge_reports(file_names: list[str], output: str | None) -> None:
+    """
+    Combine the JSON reports of the shards of a run, printing the summary
+    and failures of the whole run and writing its report to *output*.
+    """
+    try:
+        report = BatchReport.merge([BatchReport.load(file_name) for file_name in file_names])
+    except (OSError, ValueError, KeyError) as e:
+        sys.exit("merge-reports: %s" % e)
+
+    for source, error in report.failed:
+        print("%s: %s" % (source, error), file=sys.stderr)
+    print(report.summary())
+    if output:
+        report.save(output)
+    if report.failed:
+        sys.exit(1)
+
 
-        print("Template outputted to %s" % options.target)
+def summarize_stats(file_names: list[str], top: int) -> None:
+    """
+    Print the *top* slowest templates and the throughput percentiles of
+    the statistics written by --stats.
+    """
+    try:
+        entries = load(file_names)
+    except OSError as e:
+        sys.exit("summarize-stats: %s" % e)
+    for line in summarize(entries, top):
+        print(line)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,237 @@
+"""
+Conversion of memory-mapped templates.
+
+Most of a large template is Content, which converts to itself. Instead
+of decoding the whole file, convert_buffer() scans its bytes for the
+regions a tag can span: a comment, a literal block, a tag up to its
+closing "}" outside quotes, or a block tag up to its matching closing
+tag. Only those are decoded and parsed; the Content between them is
+written through as bytes, after the same newline handling as
+batch.convert_bytes(), so the output is byte for byte the same.
+
+The scanner errs on the long side: a region it cannot close runs to the
+end of the file. The parser then decides how much of it is a statement,
+so a "{" starting no tag costs a scan and converts to itself. Should the
+parser still look past the end of a region, the region is doubled until
+it does not.
+"""
+
+from __future__ import annotations
+
+import codecs
+import mmap
+import os
+import re
+import time
+from collections.abc import Iterator
+
+from . import stack_parser
+from .smarty_grammar import SmartyLanguageMain, forget_terminators
+from .stack_parser import OverBudgetError
+from .tag_cache import TagCache
+from .twig_printer import TwigPrinter
+
+# Content is written in chunks of this many bytes.
+_CHUNK = 1 << 20
+
+_BLOCKS = rb"(?:if|foreach|block|capture)"
+_BLOCK_OPEN = re.compile(rb"\{[ \t\n\r]*+" + _BLOCKS + rb"(?![A-Za-z0-9_])")
+_BLOCK_CLOSE = re.compile(rb"\{/" + _BLOCKS + rb"\}")
+_LITERAL = b"{literal}"
+_TAG_TOKEN = re.compile(rb"[{}\"']")
+_QUOTED = {
+    # Backquoted expressions in double quotes may hold quotes of their own.
+    ord('"'): re.compile(rb'"(?:[^"\\`]++|\\.|`[^`]*+`)*+"', re.DOTALL),
+    ord("'"): re.compile(rb"'[^']*+'"),
+}
+_NEWLINES = re.compile(rb"\r\n?+")
+# Follows each region but the last while it is parsed. It holds the
+# terminators of the grammar, so a construct left open by the end of the
+# region reaches into it rather than failing short of it.
+_SENTINEL = "\0\"'`*}{/literal}"
+
+
+def convert_mapped(
+    file_name: str, tag_cache: TagCache | None = None, deadline: float | None = None
+) -> Iterator[bytes]:
+    """
+    Convert the UTF-8 encoded template *file_name* by memory-mapping it,
+    yielding the encoded output like batch.convert_bytes().
+    """
+    with open(file_name, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield from convert_buffer(data, tag_cache, deadline)
+
+
+def convert_buffer(
+    data: bytes | mmap.mmap, tag_cache: TagCache | None = None, deadline: float | None = None
+) -> Iterator[bytes]:
+    """
+    Convert the UTF-8 encoded template *data*, decoding only its tags, see
+    the module docstring.
+
+    Parsing past the time.monotonic() *deadline* raises OverBudgetError,
+    with an offset in bytes.
+    """
+    printer = TwigPrinter()
+    # The ordered choice that SmartyLanguageMain repeats.
+    statement = SmartyLanguageMain.grammar[-1]
+    pos = 0
+    while pos < len(data):
+        brace = data.find(b"{", pos)
+        if brace == -1:
+            brace = len(data)
+        if brace > pos:
+            yield from _content(data, pos, brace)
+            pos = brace
+            continue
+
+        if deadline is not None and time.monotonic() > deadline:
+            raise OverBudgetError("timeout", pos, len(data))
+        stop = _region_end(data, pos)
+        try:
+            while True:
+                raw = data[pos:stop]
+                text = _normalize(raw).decode("utf-8")
+                whole = stop == len(data)
+                parser = stack_parser.StackParser(
+                    text if whole else text + _SENTINEL,
+                    source_leaves=True,
+                    tag_cache=tag_cache,
+                    deadline=deadline,
+                )
+                try:
+                    result = parser.run(statement, 0)
+                except MemoryError:
+                    parser.forget()
+                    raise OverBudgetError("out of memory", pos, len(data)) from None
+                except OverBudgetError as e:
+                    offset = pos + _raw_offset(raw, len(text[: e.offset].encode("utf-8")))
+                    raise OverBudgetError(e.reason, offset, len(data)) from None
+                if result is None or result[0] == 0:
+                    raise parser.syntax_error()
+                if whole or (parser.farthest < len(text) and result[0] <= len(text)):
+                    break
+                # The parser looked past the region: try one twice as long.
+                brace = data.find(b"{", pos + 2 * len(raw))
+                stop = len(data) if brace == -1 else _region_end(data, brace)
+        finally:
+            forget_terminators()
+
+        end, node = result
+        yield _encode(printer.print(node))
+        if end == len(text):
+            pos += len(raw)
+        else:
+            pos += _raw_offset(raw, len(text[:end].encode("utf-8")))
+
+
+def _region_end(data: bytes | mmap.mmap, start: int) -> int:
+    """
+    Return where the statement starting with the "{" at *start* can end
+    at the latest.
+    """
+    if not _BLOCK_OPEN.match(data, start):
+        return _tag_end(data, start)
+
+    # Closing tags of any kind count, the parser gives up on a mismatch.
+    depth = 0
+    pos = start
+    while True:
+        close = _BLOCK_CLOSE.match(data, pos)
+        if close is not None:
+            depth -= 1
+            pos = close.end()
+        else:
+            if _BLOCK_OPEN.match(data, pos):
+                depth += 1
+            pos = _tag_end(data, pos)
+        if depth == 0:
+            return pos
+        pos = data.find(b"{", pos)
+        if pos == -1:
+            return len(data)
+
+
+def _tag_end(data: bytes | mmap.mmap, start: int) -> int:
+    """
+    Return the end of the comment, literal block or tag starting at
+    *start*, a tag ending with its "}" outside quotes and nested braces.
+    """
+    if data[start : start + 2] == b"{*":
+        return _after(data, b"*}", start + 2)
+    if data[start : start + len(_LITERAL)] == _LITERAL:
+        return _after(data, b"{/literal}", start + len(_LITERAL))
+
+    depth = 0
+    pos = start
+    while True:
+        match = _TAG_TOKEN.search(data, pos)
+        if match is None:
+            return len(data)
+        pos = match.end()
+        token = data[match.start()]
+        if token == ord("{"):
+            depth += 1
+        elif token == ord("}"):
+            depth -= 1
+            if depth == 0:
+                return pos
+        else:
+            quoted = _QUOTED[token].match(data, match.start())
+            if quoted is None:
+                return len(data)
+            pos = quoted.end()
+
+
+def _after(data: bytes | mmap.mmap, delimiter: bytes, start: int) -> int:
+    found = data.find(delimiter, start)
+    return len(data) if found == -1 else found + len(delimiter)
+
+
+def _content(data: bytes | mmap.mmap, start: int, stop: int) -> Iterator[bytes]:
+    """
+    Yield the Content between *start* and *stop* as output, checking that
+    it is UTF-8 as decoding it would.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    while start < stop:
+        end = min(start + _CHUNK, stop)
+        # A "\r\n" is not split, it turns into a single newline.
+        if data[end - 1] == ord("\r") and end < stop:
+            end += 1
+        chunk = data[start:end]
+        decoder.decode(chunk, end == stop)
+        yield _encode_newlines(_normalize(chunk))
+        start = end
+
+
+def _normalize(raw: bytes) -> bytes:
+    if b"\r" in raw:
+        raw = raw.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+    return raw
+
+
+def _encode(fragment: str) -> bytes:
+    if os.linesep != "\n":
+        fragment = fragment.replace("\n", os.linesep)
+    return fragment.encode("utf-8")
+
+
+def _encode_newlines(chunk: bytes) -> bytes:
+    if os.linesep != "\n":
+        chunk = chunk.replace(b"\n", os.linesep.encode())
+    return chunk
+
+
+def _raw_offset(raw: bytes, offset: int) -> int:
+    """
+    Map an *offset* into the normalized bytes of *raw* back to *raw*.
+    """
+    for newline in _NEWLINES.finditer(raw):
+        if newline.start() >= offset:
+            break
+        offset += len(newline.group()) - 1
+    return offset
@@ -0,0 +1,764 @@
+"""
+A pipelined executor for batch conversion.
+
+Templates flow through stages that run at the same time: a few threads
+read files, and a pool of processes, or of threads, converts them and
+writes the outputs, sending back only whether each was written. Files
+tagless enough to be copied verbatim never leave the read stage, nor do
+files with the same content as one read before: that one is converted
+once and its output copied for each of them by a few more threads. The
+bytes of files between being read and written are capped, so memory
+stays flat however large the tree is: reading waits while the cap is
+reached.
+
+Each template can be given a time budget, checked by the parser and
+backed by a watchdog thread that kills a conversion process still on a
+template KILL_GRACE seconds past it, and conversion processes can be
+capped in memory. A process that dies takes the templates it was
+converting with it; those are tried again one at a time, so only the
+template to blame fails, with the offset its parser last reported.
+"""
+
+from __future__ import annotations
+
+import heapq
+import mmap
+import os
+import signal
+import threading
+import time
+import tracemalloc
+from collections.abc import Callable
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any
+
+from . import preload
+from .batch import (
+    ERRORS,
+    BatchReport,
+    convert_bytes,
+    copy_template,
+    dependencies,
+    is_verbatim,
+    read_template,
+    remove_partial,
+    write_converted,
+    write_output,
+)
+from .journal import CONVERTED, COPIED, FAILED, Journal, digest
+from .mapped import convert_buffer
+from .profiling import Profiles, run_profiled
+from .stack_parser import OverBudgetError, set_progress
+from .stats import DUPLICATE, StatsLog, TemplateStats, trace
+from .tag_cache import TagCache
+
+try:
+    import resource
+except ImportError:
+    # Not on Windows, where processes are not limited.
+    resource = None
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# Conversion cost of a "{" in bytes of content, see estimate_cost().
+BRACE_COST = 10000
+
+# Templates estimated to cost less than this are converted in chunks.
+DEFAULT_CHUNK_COST = 100 * BRACE_COST
+
+# What converts templates: "processes" or, see Pipeline, "threads".
+BACKENDS = ("processes", "threads")
+
+# Seconds past its timeout a template gets before the watchdog kills the
+# process converting it, for when the parser cannot check the deadline.
+KILL_GRACE = 5
+
+# Seconds between the watchdog's looks at the conversions running.
+WATCH_INTERVAL = 0.5
+
+# A conversion slot is this many floats of a shared array, one slot per
+# task sent to conversion processes: the pid of the process converting it,
+# the time.time() it started its current template, 0 between templates,
+# the index of that template in the task and the farthest offset its
+# parser reported, -1 before the first report.
+_PID = 0
+_STARTED = 1
+_INDEX = 2
+_OFFSET = 3
+_SLOT_SIZE = 4
+
+_KILL = getattr(signal, "SIGKILL", signal.SIGTERM)
+
+# Bytes of a mapped template whose braces are counted at a time.
+_COUNT_BLOCK = 1 << 20
+
+
+class ByteBudget:
+    """
+    Counts bytes in flight and makes acquire() wait while over a limit.
+    """
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.used = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, size: int) -> int:
+        """
+        Wait until *size* bytes fit and take them, returning the amount to
+        release later. A file larger than the limit waits for an empty
+        pipeline and is charged the whole limit.
+        """
+        size = min(size, self.limit)
+        with self._condition:
+            while self.used and self.used + size > self.limit:
+                self._condition.wait()
+            self.used += size
+        return size
+
+    def release(self, size: int) -> None:
+        with self._condition:
+            self.used -= size
+            self._condition.notify_all()
+
+
+def process_context() -> Any:
+    """
+    The multiprocessing context for conversion processes.
+
+    The pipeline has threads running when processes start, which a plain
+    fork could copy mid-operation, so processes start from a fork server
+    of their own where there is one, see preload.context().
+    """
+    return preload.context()
+
+
+def estimate_cost(data: bytes | mmap.mmap | str) -> int:
+    """
+    Estimate the work of converting a template, in bytes of plain content.
+
+    Passthrough content costs little next to parsing a tag: each "{" is
+    counted as BRACE_COST bytes, about what a typical tag takes to parse.
+    A template given by its path is mapped, see batch.read_template().
+    """
+    if isinstance(data, str):
+        with read_template(data) as content:
+            return estimate_cost(content)
+    if isinstance(data, mmap.mmap):
+        return _mapped_cost(data)
+    return len(data) + BRACE_COST * data.count(b"{")
+
+
+def _mapped_cost(data: mmap.mmap) -> int:
+    braces = 0
+    for offset in range(0, len(data), _COUNT_BLOCK):
+        braces += data[offset : offset + _COUNT_BLOCK].count(b"{")
+    return len(data) + BRACE_COST * braces
+
+
+# In a conversion process, the conversion slots shared with the pipeline
+# and the slot of the task being converted.
+_slots: Any = None
+_slot: int | None = None
+
+
+def init_converter(memory_limit: int | None, trace_memory: bool = False, slots: Any = None) -> None:
+    """
+    Set up a conversion process, capping its address space at
+    *memory_limit* bytes, and tracing memory for the peaks TemplateStats
+    records if *trace_memory* is set. Conversions are reported in the
+    shared array of *slots*, see Pipeline.
+    """
+    global _slots
+    if slots is not None:
+        _slots = slots
+        set_progress(_report_offset)
+    if trace_memory:
+        tracemalloc.start()
+    if memory_limit and resource is not None:
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        if hard != resource.RLIM_INFINITY:
+            memory_limit = min(memory_limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, hard))
+
+
+def _report_offset(offset: int) -> None:
+    if _slot is not None:
+        _slots[_slot * _SLOT_SIZE + _OFFSET] = offset
+
+
+def _last_offset() -> int | None:
+    if _slot is None:
+        return None
+    offset = int(_slots[_slot * _SLOT_SIZE + _OFFSET])
+    return offset if offset >= 0 else None
+
+
+def convert_templates(
+    templates: list[bytes | str],
+    timeout: float | None = None,
+    tag_cache: TagCache | None = None,
+    targets: list[str] | None = None,
+    measure: bool = False,
+    slot: int | None = None,
+) -> list[bytes | bool | tuple[bool, TemplateStats] | Exception]:
+    """
+    Convert a chunk of templates in a conversion process or thread,
+    returning the output or the error of each, giving each *timeout*
+    seconds. Templates of batch.MAPPED_SIZE bytes or more are given by their
+    path and mapped here, see batch.read_template(), and not measured.
+
+    Given *targets*, each output is written to its target as it is
+    converted, and only whether the target was written is returned, so
+    outputs are never sent back. To *measure* conversions, that comes with
+    their TemplateStats.
+
+    In a process set up by init_converter(), each template is reported in
+    conversion *slot* while it is converted.
+    """
+    global _slot
+    slots = _slots
+    _slot = slot if slots is not None else None
+    results: list[bytes | bool | tuple[bool, TemplateStats] | Exception] = []
+    for i, data in enumerate(templates):
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        if slots is not None and _slot is not None:
+            base = _slot * _SLOT_SIZE
+            slots[base + _PID] = os.getpid()
+            slots[base + _INDEX] = i
+            slots[base + _OFFSET] = -1
+            slots[base + _STARTED] = time.time()
+        try:
+            if isinstance(data, str):
+                with read_template(data) as content:
+                    fragments = convert_buffer(content, tag_cache, deadline)
+                    if targets is None:
+                        results.append(b"".join(fragments))
+                    else:
+                        results.append(write_output(targets[i], fragments))
+            elif targets is None:
+                results.append(b"".join(convert_bytes(data, tag_cache, deadline)))
+            elif measure:
+                stats = TemplateStats()
+                written = write_converted(targets[i], data, tag_cache, deadline, stats)
+                results.append((written, stats))
+            else:
+                results.append(write_converted(targets[i], data, tag_cache, deadline))
+        except MemoryError:
+            size = os.path.getsize(data) if isinstance(data, str) else len(data)
+            results.append(OverBudgetError("out of memory", _last_offset(), size))
+        except ERRORS as e:
+            results.append(e)
+        if slots is not None and _slot is not None:
+            slots[_slot * _SLOT_SIZE + _STARTED] = 0
+    _slot = None
+    return results
+
+
+class Pipeline:
+    """
+    One pipelined batch run, see the module docstring.
+
+    Templates are read largest first and queued for conversion by
+    estimated cost, so the slowest ones start first instead of being left
+    for the end of the run. Templates cheaper than *chunk_cost* are sent
+    to conversion processes in chunks. The report records how long the
+    run went on once the first process ran out of work.
+
+    Each template gets *timeout* seconds, and each conversion process
+    *memory_limit* bytes of address space, interpreter included. Processes
+    are replaced after converting *recycle* templates, sent one per task
+    then, so long runs do not keep fragmented heaps.
+
+    Templates are recorded in the *journal*, and skipped if it has them
+    done, and measured into *stats*. Each conversion task is profiled
+    where it runs and the profiles merged into *profiles*.
+
+    With the "threads" *backend*, templates are converted by threads of
+    this process instead, which only run in parallel on a free-threaded
+    Python, but need no process start-up nor pickling and can share a
+    *tag_cache*. Memory limits, recycling, killing a conversion stuck past
+    its timeout and profiling need processes.
+    """
+
+    def __init__(
+        self,
+        jobs: int,
+        link: bool = False,
+        read_threads: int = 4,
+        write_threads: int = 4,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        chunk_cost: int = DEFAULT_CHUNK_COST,
+        timeout: float | None = None,
+        memory_limit: int | None = None,
+        recycle: int | None = None,
+        journal: Journal | None = None,
+        backend: str = "processes",
+        tag_cache: TagCache | None = None,
+        stats: StatsLog | None = None,
+        profiles: Profiles | None = None,
+    ) -> None:
+        if backend not in BACKENDS:
+            raise ValueError("unknown backend %r" % backend)
+        if profiles is not None and backend != "processes":
+            # From Python 3.12 only one cProfile profiler can be enabled
+            # at a time, whichever thread it is in.
+            raise ValueError("profiling needs the processes backend")
+        self.jobs = jobs
+        self.link = link
+        self.read_threads = read_threads
+        self.write_threads = write_threads
+        self.chunk_cost = chunk_cost
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.recycle = recycle
+        self.journal = journal
+        self.backend = backend
+        self.tag_cache = tag_cache
+        self.stats = stats
+        self.profiles = profiles
+        self.budget = ByteBudget(max_bytes)
+        self.report = BatchReport()
+        self._lock = threading.RLock()
+        self._pending = 0
+        self._idle = threading.Condition(self._lock)
+        # Templates waiting for conversion, as a heap of
+        # (-cost, order, source, target, data, charge), data being the
+        # source again for mapped templates, see _take().
+        self._queue: list[tuple[int, int, str, str, bytes | str, int]] = []
+        self._queued = 0
+        # Templates sent to a conversion process that died, as
+        # (source, target, data, charge), and whether one of them is being
+        # converted on its own.
+        self._suspects: list[tuple[str, str, bytes | str, int]] = []
+        self._isolated = False
+        # The conversion slots shared with conversion processes, those not
+        # in use, and those whose process the watchdog killed.
+        self._slots: Any = None
+        self._free_slots: list[int] = []
+        self._killed: set[int] = set()
+        self._unread = 0
+        self._converting = 0
+        self._idle_at: float | None = None
+        # Content digests and sizes of the templates in flight, by source.
+        self._digests: dict[str, str] = {}
+        self._sizes: dict[str, int] = {}
+        # By content digest: the source of the template being converted
+        # and the (source, target, data, charge) of templates with the
+        # same content waiting for its output, then the target it was
+        # written to or the error it failed with.
+        self._duplicates: dict[str, tuple[str, list[tuple[str, str, bytes | str, int]]]] = {}
+        self._outputs: dict[str, str] = {}
+        self._errors: dict[str, BaseException] = {}
+
+    def run(self, files: list[tuple[str, str]]) -> BatchReport:
+        """
+        Convert each ``(source, target)`` of *files*.
+        """
+        started = time.perf_counter()
+        sized = []
+        for source, target in files:
+            try:
+                size = os.stat(source).st_size
+                os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+            except OSError as e:
+                self._failed(source, e)
+                continue
+            sized.append((size, source, target))
+        sized.sort(key=lambda file: -file[0])
+
+        watched = threading.Event()
+        if self.backend == "processes":
+            count = 2 * self.jobs
+            self._slots = process_context().Array("d", count * _SLOT_SIZE, lock=False)
+            self._free_slots = list(range(count))
+            if self.timeout is not None:
+                threading.Thread(
+                    target=self._watch, args=(watched,), name="watchdog", daemon=True
+                ).start()
+        self._converters = self._start_converters()
+        try:
+            with (
+                trace(self.backend == "threads" and self.stats is not None and self.stats.memory),
+                ThreadPoolExecutor(self.read_threads, "read") as self._readers,
+                ThreadPoolExecutor(self.write_threads, "write") as self._writers,
+            ):
+                self._pending = self._unread = len(sized)
+                for size, source, target in sized:
+                    charge = self.budget.acquire(size)
+                    self._readers.submit(self._guard, source, charge, self._read, source, target)
+
+                # Stages hand files on to each other, so the executors may
+                # only shut down once every file is through.
+                with self._idle:
+                    while self._pending:
+                        self._idle.wait()
+        finally:
+            watched.set()
+            self._converters.shutdown()
+
+        finished = time.perf_counter()
+        self.report.elapsed = finished - started
+        self.report.tail_latency = finished - (self._idle_at or finished)
+        self.report.failed.sort()
+        return self.report
+
+    def _read(self, source: str, target: str, charge: int) -> None:
+        try:
+            with read_template(source) as data:
+                self._take(source, target, data, charge)
+        finally:
+            with self._lock:
+                self._unread -= 1
+                self._dispatch()
+
+    def _take(self, source: str, target: str, data: bytes | mmap.mmap, charge: int) -> None:
+        # Mapped templates are sent for conversion by path, not content.
+        queued = data if isinstance(data, bytes) else source
+        found = dependencies(data)
+        if found:
+            with self._lock:
+                self.report.dependencies[source] = found
+
+        source_digest = digest(data)
+        if self.journal is not None and self.journal.is_done(source, source_digest, target):
+            with self._lock:
+                self.report.resumed += 1
+            self._finish(charge)
+            return
+        with self._lock:
+            self._digests[source] = source_digest
+            self._sizes[source] = len(data)
+
+        if is_verbatim(data):
+            written = copy_template(source, target, data, self.link)
+            self._done(source, target, charge, copied=True, written=written)
+            return
+
+        # Mapped templates take a scan, kept out of the lock.
+        cost = estimate_cost(data)
+        with self._lock:
+            original = self._outputs.get(source_digest)
+            error = self._errors.get(source_digest)
+            if original is None and error is None:
+                if source_digest in self._duplicates:
+                    self._duplicates[source_digest][1].append((source, target, queued, charge))
+                else:
+                    self._duplicates[source_digest] = (source, [])
+                    self._enqueue(source, target, queued, charge, cost)
+                return
+        if error is not None:
+            self._failed(source, error)
+            self._finish(charge)
+            return
+        assert original is not None
+        self._write_duplicate(source, target, original, charge)
+
+    def _enqueue(self, source: str, target: str, data: bytes | str, charge: int, cost: int) -> None:
+        # The *cost* is estimated by the caller, before taking the lock.
+        with self._lock:
+            self._queued += 1
+            item = (-cost, self._queued, source, target, data, charge)
+            heapq.heappush(self._queue, item)
+            self._dispatch()
+
+    def _start_converters(self) -> Executor:
+        if self.backend == "threads":
+            return ThreadPoolExecutor(self.jobs, "convert")
+        return ProcessPoolExecutor(
+            self.jobs,
+            process_context(),
+            initializer=init_converter,
+            initargs=(
+                self.memory_limit,
+                self.stats is not None and self.stats.memory,
+                self._slots,
+            ),
+            max_tasks_per_child=self.recycle,
+        )
+
+    def _dispatch(self) -> None:
+        # Called with the lock held.
+        # Templates whose process died are converted one at a time with
+        # nothing else running, so that if the process dies again it is
+        # known which template killed it. One that could not be sent
+        # leaves nothing running either.
+        while self._suspects and not self._converting:
+            self._isolated = True
+            self._submit([self._suspects.pop()])
+        if self._isolated and not self._converting:
+            self._isolated = False
+        if self._suspects or self._isolated:
+            return
+
+        # Keeping a task queued per process means no process waits for the
+        # next one to be sent. Recycled processes count templates, so
+        # those are sent one per task.
+        while self._queue and self._converting < 2 * self.jobs:
+            chunk = [heapq.heappop(self._queue)]
+            cost = -chunk[0][0]
+            while (
+                self._queue and self.recycle is None and cost - self._queue[0][0] <= self.chunk_cost
+            ):
+                chunk.append(heapq.heappop(self._queue))
+                cost -= chunk[-1][0]
+            self._submit([item[2:] for item in chunk])
+
+        if (
+            self._idle_at is None
+            and not self._unread
+            and not self._queue
+            and not self._suspects
+            and self._converting < self.jobs
+        ):
+            self._idle_at = time.perf_counter()
+
+    def _submit(self, files: list[tuple[str, str, bytes | str, int]]) -> None:
+        converters = self._converters
+        slot = None
+        if self._free_slots:
+            slot = self._free_slots.pop()
+            base = slot * _SLOT_SIZE
+            self._slots[base : base + _SLOT_SIZE] = [0, 0, 0, -1]
+        args = (
+            [data for _, _, data, _ in files],
+            self.timeout,
+            self.tag_cache,
+            [target for _, target, _, _ in files],
+            self.stats is not None,
+            slot,
+        )
+        try:
+            if self.profiles is None:
+                future = converters.submit(convert_templates, *args)
+            else:
+                future = converters.submit(run_profiled, convert_templates, *args)
+        except BrokenProcessPool:
+            self._broken(converters, files, self._release(slot))
+            return
+        except Exception as e:
+            self._release(slot)
+            for source, _, _, charge in files:
+                self._failed(source, e)
+                self._finish(charge)
+            return
+        self._converting += 1
+        future.add_done_callback(
+            lambda future: self._writers.submit(self._write, files, future, converters, slot)
+        )
+
+    def _release(self, slot: int | None) -> tuple[str, int | None, int]:
+        # Called with the lock held once the task of *slot* is over,
+        # returning what to blame if its process died: the reason, the
+        # offset its parser last reported and the index of its template.
+        if slot is None:
+            return "conversion process died", None, 0
+        base = slot * _SLOT_SIZE
+        _, started, index, offset = self._slots[base : base + _SLOT_SIZE]
+        if slot in self._killed:
+            self._killed.discard(slot)
+            reason = "timeout"
+        elif self.memory_limit:
+            reason = "out of memory"
+        else:
+            reason = "conversion process died"
+        self._free_slots.append(slot)
+        return reason, int(offset) if started and offset >= 0 else None, int(index)
+
+    def _broken(
+        self,
+        converters: Executor,
+        files: list[tuple[str, str, bytes | str, int]],
+        death: tuple[str, int | None, int] = ("conversion process died", None, 0),
+    ) -> None:
+        # Called with the lock held when a conversion process died, killed
+        # for going over budget or crashed, breaking its pool and failing
+        # every task sent to it. The template the watchdog killed a process
+        # for, or one converted on its own, fails with the *death* that
+        # _release() found; the others are suspects.
+        if converters is self._converters:
+            converters.shutdown(wait=False)
+            self._converters = self._start_converters()
+        reason, offset, index = death
+        if self._isolated:
+            self._isolated = False
+            blamed = files
+        elif reason == "timeout":
+            blamed = files[index : index + 1]
+            self._suspects.extend(files[:index] + files[index + 1 :])
+        else:
+            self._suspects.extend(files)
+            return
+        for source, target, data, charge in blamed:
+            # The process may have died writing the target.
+            remove_partial(target)
+            size = self._sizes.get(source, len(data))
+            self._failed(source, OverBudgetError(reason, offset, size))
+            self._finish(charge)
+
+    def _watch(self, stop: threading.Event) -> None:
+        # Runs in a thread for the whole run, as conversion processes only
+        # check their deadline while parsing.
+        while not stop.wait(WATCH_INTERVAL):
+            self._kill_stuck()
+
+    def _kill_stuck(self) -> None:
+        assert self.timeout is not None
+        limit = time.time() - self.timeout - KILL_GRACE
+        with self._lock:
+            for slot in range(len(self._slots) // _SLOT_SIZE):
+                base = slot * _SLOT_SIZE
+                pid, started = self._slots[base + _PID], self._slots[base + _STARTED]
+                if slot in self._free_slots or slot in self._killed or not 0 < started < limit:
+                    continue
+                self._killed.add(slot)
+                try:
+                    os.kill(int(pid), _KILL)
+                except OSError:
+                    # Gone already.
+                    pass
+
+    def _write(
+        self,
+        files: list[tuple[str, str, bytes | str, int]],
+        future: Future,
+        converters: Executor,
+        slot: int | None,
+    ) -> None:
+        try:
+            results = future.result()
+            if self.profiles is not None:
+                results, profile = results
+                self.profiles.add(profile)
+        except BrokenProcessPool:
+            with self._lock:
+                self._converting -= 1
+                self._broken(converters, files, self._release(slot))
+                self._dispatch()
+            return
+        except Exception as e:
+            results = [e] * len(files)
+        with self._lock:
+            self._converting -= 1
+            self._release(slot)
+            self._dispatch()
+
+        for (source, target, _, charge), result in zip(files, results, strict=True):
+            if isinstance(result, Exception):
+                self._failed(source, result)
+                self._finish(charge)
+            elif isinstance(result, tuple):
+                self._converted(source, target, result[0], charge, result[1])
+            else:
+                self._converted(source, target, bool(result), charge)
+
+    def _converted(
+        self,
+        source: str,
+        target: str,
+        written: bool,
+        charge: int,
+        stats: TemplateStats | None = None,
+    ) -> None:
+        with self._lock:
+            source_digest = self._digests[source]
+            _, waiting = self._duplicates.pop(source_digest)
+            self._outputs[source_digest] = target
+        self._done(source, target, charge, copied=False, written=written, stats=stats)
+        for duplicate, duplicate_target, _, duplicate_charge in waiting:
+            self._guard(
+                duplicate,
+                duplicate_charge,
+                self._write_duplicate,
+                duplicate,
+                duplicate_target,
+                target,
+            )
+
+    def _write_duplicate(self, source: str, target: str, original: str, charge: int) -> None:
+        # The output of the same content, read back from where the
+        # conversion wrote it.
+        with open(original, "rb") as f:
+            output = f.read()
+        written = write_output(target, [output])
+        self._done(source, target, charge, copied=False, written=written, duplicate=True)
+
+    def _guard(self, source: str, charge: int, stage: Callable, *args: Any) -> None:
+        # Nothing waits on these threads to re-raise errors, so every error
+        # is recorded against its file.
+        try:
+            stage(*args, charge)
+        except Exception as e:
+            self._failed(source, e)
+            self._finish(charge)
+
+    def _done(
+        self,
+        source: str,
+        target: str,
+        charge: int,
+        copied: bool,
+        written: bool,
+        duplicate: bool = False,
+        stats: TemplateStats | None = None,
+    ) -> None:
+        with self._lock:
+            source_digest = self._digests.pop(source)
+            size = self._sizes.pop(source)
+        if self.journal is not None:
+            self.journal.record(source, source_digest, COPIED if copied else CONVERTED, target)
+        if self.stats is not None:
+            status = COPIED if copied else DUPLICATE if duplicate else CONVERTED
+            self.stats.record(source, status, size, stats)
+        with self._lock:
+            if copied:
+                self.report.copied += 1
+            elif duplicate:
+                self.report.duplicates += 1
+            else:
+                self.report.converted += 1
+            if not written:
+                self.report.unchanged += 1
+        self._finish(charge)
+
+    def _failed(self, source: str, error: BaseException) -> None:
+        waiting: list[tuple[str, str, bytes | str, int]] = []
+        requeued = None
+        with self._lock:
+            self.report.failed.append((source, "%s: %s" % (type(error).__name__, error)))
+            source_digest = self._digests.pop(source, None)
+            size = self._sizes.pop(source, None)
+            converted = None
+            if source_digest is not None:
+                converted = self._duplicates.get(source_digest)
+            if converted is not None and converted[0] == source:
+                del self._duplicates[source_digest]
+                waiting = converted[1]
+                if isinstance(error, OSError):
+                    # Reading or writing files failed, not converting: the
+                    # next template with the content is converted instead.
+                    if waiting:
+                        first, *waiting = waiting
+                        self._duplicates[source_digest] = (first[0], waiting)
+                        requeued = first
+                    waiting = []
+                else:
+                    self._errors[source_digest] = error
+        if requeued is not None:
+            self._enqueue(*requeued, estimate_cost(requeued[2]))
+        if self.journal is not None and source_digest is not None:
+            self.journal.record(source, source_digest, FAILED)
+        if self.stats is not None:
+            self.stats.record(source, FAILED, size)
+        for duplicate, _, _, charge in waiting:
+            self._failed(duplicate, error)
+            self._finish(charge)
+
+    def _finish(self, charge: int) -> None:
+        self.budget.release(charge)
+        with self._idle:
+            self._pending -= 1
+            self._idle.notify_all()
@@ -0,0 +1,113 @@
+"""
+Warm-up for the fork server that starts conversion processes.
+
+context() is the multiprocessing context conversion processes start from.
+Where there is a fork server it has one of its own, so the fork server of
+multiprocessing and its preload setting are left to the application.
+Before it forks any process, that server imports the grammar, the printer
+and the pipeline and calls warm(), which converts a sample template so
+that the parser's plans for the grammar are made. Every conversion
+process then starts with all of that in place, however often processes
+are recycled.
+
+warm() then freezes the objects out of the garbage collector, whose
+collections would otherwise write to every one of them and so copy the
+pages a forked process shares with the fork server.
+"""
+
+import gc
+import multiprocessing
+import threading
+import types
+from typing import Any
+
+from .batch import convert_bytes
+
+try:
+    from multiprocessing import forkserver, popen_forkserver
+    from multiprocessing.context import ForkServerContext, ForkServerProcess
+except ImportError:
+    # No fork server, as on Windows: processes are spawned.
+    popen_forkserver = None
+
+# What the fork server of context() imports before forking.
+PRELOAD = ["smartytotwig._forkserver"]
+
+# Touches every kind of statement, so that the plans for the whole grammar
+# are made rather than only those of a few tags.
+SAMPLE = b"""{* c *}{literal}{x}{/literal}{ldelim}{rdelim}
+{extends file="base.tpl"}{block name=a}{include file='a.tpl' x=1}{/block}
+{if $a > 1 and !$b || $c->d[0].e}x{elseif $c eq 'x'}y{else}z{/if}
+{foreach from=$items key=k item=item name=n}{$item.name|escape:'html'|default:"-"}{foreachelse}-{/foreach}
+{foreach $items as $k => $v}{$v@index}{/foreach}
+{capture name=c assign=x}{"a $b `$c.d` e"}{/capture}{assign var=x value=$y+1}{$x = [1, 'a' => 2]}
+{cycle values="a,b"}{func a=1 b=true c=null}{$smarty.get.x}{#conf#}{$a ? $b : $c}{-1*(2+3)%4}
+"""
+
+
+def warm() -> None:
+    """
+    Make the parser's plans and freeze everything allocated so far.
+
+    Frozen objects are never collected, so this is only for a process
+    that forks others, such as the fork server of context().
+    """
+    b"".join(convert_bytes(SAMPLE))
+    gc.collect()
+    gc.freeze()
+
+
+_context: Any = None
+_context_lock = threading.Lock()
+
+
+def context() -> Any:
+    """
+    The multiprocessing context for conversion processes, see the module
+    docstring.
+    """
+    global _context
+    if (
+        popen_forkserver is None
+        or not _swappable
+        or "forkserver" not in multiprocessing.get_all_start_methods()
+    ):
+        return multiprocessing.get_context("spawn")
+    with _context_lock:
+        if _context is None:
+            _context = _Context()
+    return _context
+
+
+if popen_forkserver is not None:
+    # The fork server of context(), started when it first forks.
+    _server = forkserver.ForkServer()
+    _server.set_forkserver_preload(PRELOAD)
+
+    # popen_forkserver.Popen._launch() starts a process from the fork
+    # server that forkserver.connect_to_new_process() belongs to. Rather
+    # than a copy, _Popen runs its very code with a forkserver module in
+    # which that is _server's: if the code ever looks the server up some
+    # other way, context() spawns processes instead.
+    _launch_code = popen_forkserver.Popen._launch.__code__
+    _looked_up = {"forkserver", "connect_to_new_process"}
+    _swappable = not _launch_code.co_freevars and _looked_up <= set(_launch_code.co_names)
+    _server_module = types.SimpleNamespace(**vars(forkserver))
+    _server_module.connect_to_new_process = _server.connect_to_new_process
+
+    class _Popen(popen_forkserver.Popen):
+        if _swappable:
+            _launch = types.FunctionType(
+                _launch_code, {**vars(popen_forkserver), "forkserver": _server_module}
+            )
+
+    class _Process(ForkServerProcess):
+        @staticmethod
+        def _Popen(process_obj: Any) -> Any:
+            return _Popen(process_obj)
+
+    class _Context(ForkServerContext):
+        Process = _Process
+
+        def set_forkserver_preload(self, module_names: list[str]) -> None:
+            _server.set_forkserver_preload(module_names)
@@ -0,0 +1,141 @@
+"""
+cProfile profiles of whole conversion runs.
+
+Profiles collects the cProfile statistics of a run: of the calling thread
+for a single template or a sequential batch, and of every task of the
+conversion processes of a parallel one, each task being profiled where it
+runs by run_profiled() and its statistics merged in with its results. They
+are saved in the format of pstats, which reads them back, and as collapsed
+stacks, one line of ";" separated frames and microseconds per stack, which
+speedscope and flamegraph.pl take.
+
+cProfile only records which function called which, not whole stacks, so
+the stacks are rebuilt from the root functions down, sharing out the time
+of each function among its callers in proportion to the time it spent
+under each. Calls back into a function already on the stack are folded
+into the outermost one.
+"""
+
+from __future__ import annotations
+
+import cProfile
+import marshal
+import os
+import pstats
+import threading
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from typing import Any
+
+# cProfile's key of a function: (file name, line number, function name).
+Function = tuple[str, int, str]
+
+# Stacks of less than this share of the total time are left out of the
+# collapsed stacks.
+MIN_SHARE = 1e-5
+
+
+def run_profiled(function: Callable, *args: Any) -> tuple[Any, dict]:
+    """
+    Call *function* under cProfile in a conversion process or thread,
+    returning its result and the statistics for Profiles.add().
+    """
+    profile = cProfile.Profile()
+    result = profile.runcall(function, *args)
+    profile.create_stats()
+    return result, profile.stats
+
+
+class Profiles:
+    """
+    The merged profiles of a run, see the module docstring.
+    """
+
+    # In the format of pstats: by function, its primitive and total call
+    # counts, its own and cumulative time and the same by caller.
+    stats: dict[Function, tuple]
+
+    def __init__(self) -> None:
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def add(self, stats: dict[Function, tuple]) -> None:
+        """
+        Merge in the statistics of a profile.
+        """
+        with self._lock:
+            for function, entry in stats.items():
+                if function in self.stats:
+                    entry = pstats.add_func_stats(self.stats[function], entry)
+                self.stats[function] = entry
+
+    def save(self, file_name: str) -> None:
+        """
+        Write the statistics to *file_name*, for pstats.Stats() to read,
+        and the collapsed stacks to *file_name* with a ".collapsed" suffix.
+        """
+        with open(file_name, "wb") as f:
+            marshal.dump(self.stats, f)
+        with open(file_name + ".collapsed", "w", encoding="utf-8") as f:
+            for stack, microseconds in sorted(self.collapsed().items()):
+                f.write("%s %d\n" % (stack, microseconds))
+
+    def collapsed(self) -> dict[str, int]:
+        """
+        Rebuild the stacks the time was spent in, returning the
+        microseconds spent in each stack's last frame by stack.
+        """
+        callees: dict[Function, list[tuple[Function, float]]] = {}
+        roots = []
+        for function, (_, _, _, _, callers) in self.stats.items():
+            if not callers:
+                roots.append(function)
+            for caller, (_, _, _, edge_time) in callers.items():
+                callees.setdefault(caller, []).append((function, edge_time))
+        total = sum(self.stats[root][3] for root in roots)
+
+        stacks: dict[str, int] = {}
+        # (function, its frames on the stack, the share of its calls there)
+        pending = [(root, (root,), 1.0) for root in roots]
+        while pending:
+            function, path, share = pending.pop()
+            _, _, own_time, _, _ = self.stats[function]
+            if own_time * share >= 1e-6:
+                stack = ";".join(map(_frame, path))
+                stacks[stack] = stacks.get(stack, 0) + round(own_time * share * 1e6)
+            for callee, edge_time in callees.get(function, ()):
+                spent = edge_time * share
+                if callee in path or spent <= total * MIN_SHARE:
+                    continue
+                # Calls from a recursion can count more time than the callee.
+                callee_share = spent / max(self.stats[callee][3], spent)
+                pending.append((callee, path + (callee,), callee_share))
+        return stacks
+
+
+@contextmanager
+def profiling(profiles: Profiles | None) -> Iterator[None]:
+    """
+    Profile the calling thread into *profiles*, if any.
+    """
+    if profiles is None:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.create_stats()
+        profiles.add(profile.stats)
+
+
+def _frame(function: Function) -> str:
+    file_name, line, name = function
+    if file_name == "~":
+        # Built-in functions have no file.
+        frame = name
+    else:
+        frame = "%s (%s:%d)" % (name, os.path.basename(file_name), line)
+    return frame.replace(";", ",")
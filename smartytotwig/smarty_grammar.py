@@ -3,9 +3,10 @@
 from __future__ import annotations
 
 import re
+import threading
 from typing import TYPE_CHECKING, Any
 
-from pypeg2 import Keyword, Literal, maybe_some, omit, optional, some
+from pypeg2 import Keyword, Literal, RegEx, maybe_some, omit, optional, some
 
 if TYPE_CHECKING:
     from .twig_printer import TwigPrinter
@@ -21,7 +22,13 @@ class Rule:
         return visitor.visit(self, *[arg.accept(visitor) for arg in self.children])
 
     def __eq__(self, other: object) -> bool:
-        return type(self) is type(other) and self.children == getattr(other, "args", None)
+        return type(self) is type(other) and self.children == getattr(other, "children", None)
+
+    def intern_key(self) -> tuple:
+        """
+        Identify the structure of this node, given interned children.
+        """
+        return (type(self), *map(id, self.children))
 
     def __repr__(self) -> str:
         return "%s(%s)" % (self.__class__.__name__, repr(self.children))
@@ -39,6 +46,9 @@ class UnaryRule:
     def __eq__(self, other: object) -> bool:
         return type(self) is type(other) and self.child == getattr(other, "child", None)
 
+    def intern_key(self) -> tuple:
+        return type(self), id(self.child)
+
     def __repr__(self) -> str:
         return "%s(%s)" % (self.__class__.__name__, repr(self.child))
 
@@ -55,10 +65,103 @@ class LeafRule:
     def __eq__(self, other: object) -> bool:
         return type(self) is type(other) and self.value == getattr(other, "value", None)
 
+    def intern_key(self) -> tuple:
+        value = self.value
+        return type(self), tuple(value) if type(value) is list else value
+
     def __repr__(self) -> str:
         return "%s(%s)" % (self.__class__.__name__, repr(self.value))
 
 
+class SourceLeafRule(LeafRule):
+    """
+    A leaf whose value is copied verbatim from the template source.
+
+    Built with from_source() the node only keeps a reference to the source
+    and its offsets in it, and its value is sliced out when asked for.
+    accept() hands visitors the text between the delimiters the class
+    declares, sliced straight from the source.
+    """
+
+    delimiters: tuple[int, int] = (0, 0)
+    source: str | None = None
+    start = 0
+    end = 0
+
+    def __init__(self, value: Any) -> None:
+        self._value = value
+
+    @classmethod
+    def from_source(cls, source: str, start: int, end: int) -> Any:
+        node = cls.__new__(cls)
+        node._value = None
+        node.source = source
+        node.start = start
+        node.end = end
+        return node
+
+    @property
+    def value(self) -> Any:
+        if self.source is None:
+            return self._value
+        return self.source[self.start : self.end]
+
+    @property
+    def body(self) -> str:
+        """
+        The value without its delimiters.
+        """
+        opening, closing = self.delimiters
+        if self.source is None:
+            return self._value[opening : len(self._value) - closing]
+        return self.source[self.start + opening : self.end - closing]
+
+    def accept(self, visitor: TwigPrinter) -> str:
+        return visitor.visit(self, self.body)
+
+
+# The text each thread is parsing and the last occurrence in it of each
+# terminator, see TerminatedRegEx.
+_terminators = threading.local()
+
+
+def forget_terminators() -> None:
+    """
+    Drop what TerminatedRegEx remembers of the text this thread parsed,
+    which would otherwise be kept alive until the next parse.
+    """
+    _terminators.__dict__.clear()
+
+
+class TerminatedRegEx(RegEx):
+    """
+    A regular expression for a construct that cannot match unless
+    *terminator* occurs further on in the text.
+
+    When the terminator does not occur after the current position any more
+    the match fails straight away, instead of scanning to the end of the
+    text again for every opening delimiter of an unterminated construct.
+    The last occurrence is remembered per thread, for the text that thread
+    is parsing, until forget_terminators() is called once it is done.
+    """
+
+    def __init__(self, value: str, terminator: str) -> None:
+        super().__init__(value)
+        self.terminator = terminator
+        self.match = self._match
+
+    def _match(self, text: str, pos: int = 0) -> re.Match[str] | None:
+        found = getattr(_terminators, "found", None)
+        if found is None or found[0] is not text:
+            found = _terminators.found = (text, {})
+        last = found[1].get(self.terminator)
+        if last is None:
+            last = found[1][self.terminator] = text.rfind(self.terminator)
+        if last < pos:
+            return None
+        return self.regex.match(text, pos)
+
+
 class EmptyLeafRule:
     def accept(self, visitor: TwigPrinter) -> str:
         return visitor.visit(self)
@@ -66,36 +169,61 @@ class EmptyLeafRule:
     def __eq__(self, other: object) -> bool:
         return type(self) is type(other)
 
+    def intern_key(self) -> tuple:
+        return (type(self),)
+
     def __repr__(self) -> str:
         return self.__class__.__name__
 
 
+class TokenChoice:
+    """
+    An ordered choice between EmptyLeafRule classes matched by one regex.
+
+    nodes maps each literal to the class it stands for, in the order the
+    choice tried them; the matched text decides which node gets built.
+    """
+
+    grammar: re.Pattern[str]
+    nodes: dict[str, type[EmptyLeafRule]]
+
+    def __init_subclass__(cls) -> None:
+        cls.grammar = re.compile("(?>%s)" % "|".join(re.escape(literal) for literal in cls.nodes))
+
+    def __new__(cls, value: str) -> Any:
+        return cls.nodes[value]()
+
+
 """
 Misc.
 """
 
 
-class Content(LeafRule):
-    grammar = re.compile(r"[^{]+")
+class Content(SourceLeafRule):
+    grammar = re.compile(r"[^{]++")
 
 
-class CommentStatement(LeafRule):
-    grammar = re.compile(r"{\*.*?\*}", re.S)
+class CommentStatement(SourceLeafRule):
+    delimiters = (len("{*"), len("*}"))
+    grammar = TerminatedRegEx(r"\{\*(?:[^*]++|\*(?!\}))*+\*\}", "*}")
 
 
-class LiteralStatement(LeafRule):
-    grammar = re.compile("{literal}.*?{/literal}", re.S)
+class LiteralStatement(SourceLeafRule):
+    delimiters = (len("{literal}"), len("{/literal}"))
+    grammar = TerminatedRegEx(r"\{literal\}(?:[^{]++|\{(?!/literal\}))*+\{/literal\}", "{/literal}")
 
 
 class Whitespace:
-    grammar = maybe_some([Literal(" "), Literal("\n"), Literal("\t")])
+    grammar = re.compile(r"[ \n\t]*+")
+
 
+_ = omit(Whitespace.grammar)
 
-_ = omit(Whitespace)
+_quote = omit(re.compile(r"[\"']?+"))
 
 
 class Identifier(LeafRule):
-    grammar = re.compile(r"[\w\-\+\*\/]*\w")
+    grammar = re.compile(r"(?:[\-\+\*\/]*+\w)++")
 
 
 """
@@ -147,18 +275,29 @@ class LeftParen(EmptyLeafRule):
     grammar = Literal("(")
 
 
+class OperatorToken(TokenChoice):
+    nodes = {
+        "and": AndOperator,
+        "&&": AndOperator,
+        "==": EqOperator,
+        "eq": EqOperator,
+        ">=": GteOperator,
+        "<=": LteOperator,
+        "<": LtOperator,
+        "lt": LtOperator,
+        ">": GtOperator,
+        "gt": GtOperator,
+        "!=": NeOperator,
+        "neq": NeOperator,
+        "ne": NeOperator,
+        "or": OrOperator,
+        "||": OrOperator,
+        "instanceof": IsOperator,
+    }
+
+
 class Operator(UnaryRule):
-    grammar = [
-        AndOperator,
-        EqOperator,
-        GteOperator,
-        LteOperator,
-        LtOperator,
-        GtOperator,
-        NeOperator,
-        OrOperator,
-        IsOperator,
-    ]
+    grammar = OperatorToken
 
 
 """
@@ -167,11 +306,11 @@ Smarty variables.
 
 
 class SingleQuotedString(LeafRule):
-    grammar = "'", re.compile(r"([^']|\\.)*"), "'"
+    grammar = "'", TerminatedRegEx(r"[^']*+", "'"), "'"
 
 
 class DoubleQuotedString(LeafRule):
-    grammar = '"', re.compile(r'([^"\$]|\\.)*'), '"'
+    grammar = '"', TerminatedRegEx(r'[^"$]*+', '"'), '"'
 
 
 class String(UnaryRule):
@@ -179,7 +318,7 @@ class String(UnaryRule):
 
 
 class Text(LeafRule):
-    grammar = some([re.compile(r'[^$`"\\]+'), re.compile(r"\\.")])
+    grammar = some([TerminatedRegEx(r'[^$`"\\]++', '"'), re.compile(r"\\.")])
 
 
 class NotOperator(EmptyLeafRule):
@@ -194,16 +333,24 @@ class EmptyOperator(EmptyLeafRule):
     grammar = Literal("")
 
 
+class SymbolPrefix(TokenChoice):
+    nodes = {"!": NotOperator, "@": AtOperator, "": EmptyOperator}
+
+
+class ModifierPrefix(TokenChoice):
+    nodes = {"@": AtOperator, "": EmptyOperator}
+
+
 class Variable(UnaryRule):
     grammar = Literal("$"), Identifier
 
 
 class Symbol(Rule):
-    grammar = ([NotOperator, AtOperator, EmptyOperator], [Variable, Identifier])
+    grammar = (SymbolPrefix, [Variable, Identifier])
 
 
 class DollarSymbol(Rule):
-    grammar = [NotOperator, AtOperator, EmptyOperator], Variable
+    grammar = SymbolPrefix, Variable
 
 
 class Expression(UnaryRule):
@@ -231,7 +378,7 @@ class ModifierParameters(Rule):
 
 
 class ModifierElement(Rule):
-    grammar = ("|", [AtOperator, EmptyOperator], Identifier, optional(ModifierParameters))
+    grammar = ("|", ModifierPrefix, Identifier, optional(ModifierParameters))
 
 
 class ModifierRight(Rule):
@@ -295,25 +442,19 @@ class FunctionStatement(Rule):
 
 
 class ForFrom(UnaryRule):
-    grammar = (
-        Keyword("from"),
-        "=",
-        omit(optional(['"', "'"])),
-        Expression,
-        omit(optional(['"', "'"])),
-    )
+    grammar = omit(re.compile(r"from=[\"']?+")), Expression, _quote
 
 
 class ForItem(UnaryRule):
-    grammar = Keyword("item"), "=", omit(optional(['"', "'"])), Symbol, omit(optional(['"', "'"]))
+    grammar = omit(re.compile(r"item=[\"']?+")), Symbol, _quote
 
 
 class ForName(UnaryRule):
-    grammar = Keyword("name"), "=", omit(optional(['"', "'"])), Symbol, omit(optional(['"', "'"]))
+    grammar = omit(re.compile(r"name=[\"']?+")), Symbol, _quote
 
 
 class ForKey(UnaryRule):
-    grammar = Keyword("key"), "=", omit(optional(['"', "'"])), Symbol, omit(optional(['"', "'"]))
+    grammar = omit(re.compile(r"key=[\"']?+")), Symbol, _quote
 
 
 class IfCondition(Rule):
@@ -369,12 +510,16 @@ class DivOperator(EmptyLeafRule):
     grammar = "/"
 
 
+class ArithmeticOperatorToken(TokenChoice):
+    nodes = {"+": AddOperator, "-": SubOperator, "*": MultOperator, "/": DivOperator}
+
+
 class ArithmeticOperator(UnaryRule):
-    grammar = [AddOperator, SubOperator, MultOperator, DivOperator]
+    grammar = ArithmeticOperatorToken
 
 
 class Number(LeafRule):
-    grammar = re.compile(r"\d+")
+    grammar = re.compile(r"\d++")
 
 
 class ForExpression(Rule):
@@ -382,7 +527,7 @@ class ForExpression(Rule):
 
 
 class ForVariableIdentifier(LeafRule):
-    grammar = re.compile(r"\w+")
+    grammar = re.compile(r"\w++")
 
 
 class ForVariable(Rule):
@@ -414,7 +559,7 @@ class ForStatement(Rule):
 
 
 class IsLink(LeafRule):
-    grammar = Literal("quoted="), re.compile("true|false")
+    grammar = Literal("quoted="), re.compile("(?>true|false)")
 
 
 class TranslationStatement(Rule):
@@ -475,7 +620,7 @@ class CaptureStatement(Rule):
 
 
 class BlockName(LeafRule):
-    grammar = re.compile(r"\w+")
+    grammar = re.compile(r"\w++")
 
 
 class BlockStatement(Rule):
@@ -496,7 +641,7 @@ class BlockStatement(Rule):
 
 
 class SimpleTag(LeafRule):
-    grammar = "{", _, re.compile("|".join(["init_time", "process_time"])), _, "}"
+    grammar = "{", _, re.compile("(?>%s)" % "|".join(["init_time", "process_time"])), _, "}"
 
 
 """
@@ -0,0 +1,537 @@
+"""
+A parsing engine for the pypeg2 grammar in smarty_grammar that keeps
+its own explicit stack.
+
+pypeg2 descends into nested rules with ordinary Python recursion, several
+frames per grammar level, so deeply nested templates (an {if} inside a
+{foreach} inside an {if} ...) run into the interpreter recursion limit.
+This module interprets the same grammar objects with the same PEG
+semantics (ordered choice, greedy repetition, packrat memoisation of rule
+classes) and builds the same node objects, but every compound rule is a
+generator driven by a trampoline: nesting depth only grows a Python list,
+never the Python stack.
+
+It also matches terminals in place with ``pattern.match(text, pos)``
+instead of slicing the remaining text at every step as pypeg2 does.
+"""
+
+from __future__ import annotations
+
+import bisect
+import os
+import re
+import threading
+import time
+from collections.abc import Callable, Generator
+from types import FunctionType, GeneratorType
+from typing import Any
+
+import pypeg2
+
+from .smarty_grammar import forget_terminators
+
+_RegEx = type(re.compile(""))
+
+# Cardinality markers used in pypeg2 tuples, see pypeg2.some() and friends.
+_OMIT = -6
+_SEPARATED = -5
+_CONTIGUOUS = -4
+_INDENT = -3
+_SOME = -2
+_MAYBE_SOME = -1
+_OPTIONAL = 0
+
+# How a grammar element is matched, decided once per element by _plan().
+_EMPTY = 0
+_KEYWORD = 1
+_LITERAL = 2
+_REGEX = 3
+_SEQUENCE = 4
+_CHOICE = 5
+_TOKEN_RULE = 6
+_RULE = 7
+_FOREIGN = 8
+
+# Memo keys pack a rule number and a text position into one int.
+_RULE_LIMIT = 1 << 16
+
+# Leaves shorter than this are cheaper to copy than to reference with offsets.
+_SOURCE_LEAF_MIN = 64
+
+# How many nested rules are started between checks of the deadline.
+_DEADLINE_STEPS = 4096
+
+# A parse result is ``(end, value)``; ``None`` means the rule did not match.
+Result = tuple[int, Any] | None
+
+# Compound rules are generators that yield sub-parses and are sent results.
+Parse = Generator[Any, Result, Result]
+
+# id(thing) -> (kind, payload, thing); thing is kept so the id stays valid.
+# Plans are made under the lock, so parsers in several threads agree on
+# rule numbers; once made they are only read.
+_plans: dict[int, tuple[int, Any, Any]] = {}
+_rule_numbers: dict[type, int] = {}
+_plans_lock = threading.RLock()
+
+# Told the farthest position of every parser of this process at each
+# check of the deadline, see set_progress().
+_progress: Callable[[int], None] | None = None
+
+
+def _plan(thing: Any) -> tuple[int, Any, Any]:
+    """
+    Classify a grammar element and precompute what matching it needs.
+    """
+    try:
+        return _plans[id(thing)]
+    except KeyError:
+        pass
+    with _plans_lock:
+        try:
+            return _plans[id(thing)]
+        except KeyError:
+            return _make_plan(thing)
+
+
+def _make_plan(thing: Any) -> tuple[int, Any, Any]:
+    if thing is None or type(thing) is FunctionType:
+        plan = _EMPTY, None, thing
+    elif isinstance(thing, pypeg2.Symbol):
+        plan = _KEYWORD, (type(thing).regex.match, str(thing)), thing
+    elif isinstance(thing, (str, pypeg2.Literal)):
+        plan = _LITERAL, str(thing), thing
+    elif isinstance(thing, (_RegEx, pypeg2.RegEx)):
+        plan = _REGEX, thing.match, thing
+    elif isinstance(thing, (tuple, pypeg2.Concat)):
+        plan = _SEQUENCE, (_prefix(thing), _steps(thing), pypeg2.how_many(thing) > 1), thing
+    elif isinstance(thing, list):
+        plan = _CHOICE, (_prefix(thing), thing), thing
+    elif isinstance(thing, type):
+        number = _rule_numbers.setdefault(thing, len(_rule_numbers))
+        if number >= _RULE_LIMIT:
+            raise pypeg2.GrammarValueError("too many rules in grammar")
+        grammar = getattr(thing, "grammar", pypeg2.word)
+        if (
+            hasattr(thing, "parse")
+            or issubclass(thing, (pypeg2.Symbol, pypeg2.Namespace, list))
+            or isinstance(grammar, pypeg2.attr.Class)
+        ):
+            # Constructs this engine does not interpret are left to pypeg2.
+            plan = _FOREIGN, number, thing
+        elif isinstance(grammar, (_RegEx, pypeg2.RegEx)):
+            plan = _TOKEN_RULE, (number, grammar.match, getattr(thing, "from_source", None)), thing
+        else:
+            plan = _RULE, (number, _prefix(grammar), grammar, pypeg2.how_many(grammar)), thing
+    else:
+        raise pypeg2.GrammarTypeError("in grammar: " + repr(thing))
+
+    _plans[id(thing)] = plan
+    return plan
+
+
+def _prefix(thing: Any) -> str:
+    """
+    Return text that every match of *thing* starts with, possibly "".
+    """
+    if isinstance(thing, (str, pypeg2.Literal)):
+        return str(thing)
+    if isinstance(thing, (tuple, pypeg2.Concat)):
+        steps = _steps(thing)
+        if steps and steps[0][1] > 0:
+            return _prefix(steps[0][0])
+        return ""
+    if isinstance(thing, list):
+        return os.path.commonprefix([_prefix(alternative) for alternative in thing])
+    if isinstance(thing, type) and not hasattr(thing, "parse"):
+        return _prefix(getattr(thing, "grammar", None))
+    return ""
+
+
+def _steps(elements: tuple) -> list[tuple[Any, int, int, bool]]:
+    """
+    Fold the cardinality markers of a pypeg2 tuple into its elements, as
+    ``(element, minimum, maximum, omit)`` with -1 standing for no maximum.
+    """
+    steps = []
+    minimum, maximum = 1, 1
+    omit = False
+    for element in elements:
+        if type(element) is not int:
+            steps.append((element, minimum, maximum, omit))
+            minimum, maximum = 1, 1
+            omit = False
+        elif element < _OMIT:
+            raise pypeg2.GrammarValueError("illegal cardinality value in grammar: " + str(element))
+        elif element == _OMIT:
+            omit = True
+        elif element in (_SEPARATED, _CONTIGUOUS, _INDENT):
+            # Whitespace skipping is disabled for Smarty, nothing to do.
+            pass
+        elif element == _SOME:
+            minimum, maximum = 1, -1
+        elif element == _MAYBE_SOME:
+            minimum, maximum = 0, -1
+        elif element == _OPTIONAL:
+            minimum, maximum = 0, 1
+        else:
+            minimum, maximum = element, element
+    return steps
+
+
+class OverBudgetError(Exception):
+    """
+    Converting a template went over its time or memory budget.
+
+    *offset* is the farthest position the parser reached, if known, and
+    *size* the size of the template.
+    """
+
+    def __init__(self, reason: str, offset: int | None, size: int) -> None:
+        super().__init__(reason, offset, size)
+        self.reason = reason
+        self.offset = offset
+        self.size = size
+
+    def __str__(self) -> str:
+        if self.offset is None:
+            return "%s (template size %d)" % (self.reason, self.size)
+        return "%s at offset %d (template size %d)" % (self.reason, self.offset, self.size)
+
+
+class StackParser:
+    """
+    Parses text following a pypeg2 grammar, without recursion.
+
+    If *spans* is a dict, the source offsets ``(start, end)`` of every rule
+    node built are recorded in it under the node's id(); LineIndex turns
+    them into lines and columns. With *source_leaves*, leaf rules that
+    provide from_source() reference the text instead of copying from it.
+    A *tag_cache* (see tag_cache.TagCache) is consulted before choices.
+
+    If *interned* is a dict, structurally equal nodes are shared: each node
+    built is looked up by its intern_key() and replaced by the first equal
+    node, so the result is a DAG. The dict can be reused across parses.
+    Spans are not meaningful for shared nodes.
+
+    Past the time.monotonic() *deadline*, if given, run() raises
+    OverBudgetError.
+    """
+
+    def __init__(
+        self,
+        text: str,
+        filename: str | None = None,
+        spans: dict[int, tuple[int, int]] | None = None,
+        source_leaves: bool = False,
+        tag_cache: Any = None,
+        interned: dict[tuple, Any] | None = None,
+        deadline: float | None = None,
+    ) -> None:
+        self.text = text
+        self.filename = filename
+        self.spans = spans
+        self.source_leaves = source_leaves
+        self.tag_cache = tag_cache
+        self.interned = interned
+        self.deadline = deadline
+        self._memory: dict[int, Result] = {}
+        self._farthest = 0
+        # Carried from one run() to the next, so a text matched by many
+        # small runs is checked as often as one matched by a single run.
+        self._countdown = _DEADLINE_STEPS
+
+    def parse(self, thing: Any) -> Any:
+        """
+        Parse the whole text as *thing* and return the resulting node.
+        """
+        try:
+            result = self.run(thing, 0)
+        finally:
+            forget_terminators()
+        if result is None or result[0] != len(self.text):
+            raise self.syntax_error()
+        return result[1]
+
+    def run(self, thing: Any, pos: int) -> Result:
+        """
+        Match *thing* at *pos*, driving nested rules from an explicit stack.
+
+        Callers running several matches over the text call
+        smarty_grammar.forget_terminators() when done with it.
+        """
+        result: Any = self._start(thing, pos)
+        if not isinstance(result, GeneratorType):
+            return result
+
+        stack = [result]
+        value = None
+        deadline = self.deadline
+        progress = _progress
+        checked = deadline is not None or progress is not None
+        countdown = self._countdown
+        while True:
+            try:
+                request = stack[-1].send(value)
+            except StopIteration as stop:
+                stack.pop()
+                if not stack:
+                    self._countdown = countdown
+                    return stop.value
+                value = stop.value
+            else:
+                stack.append(request)
+                value = None
+                if checked:
+                    countdown -= 1
+                    if not countdown:
+                        countdown = _DEADLINE_STEPS
+                        if progress is not None:
+                            progress(self._farthest)
+                        if deadline is not None and time.monotonic() > deadline:
+                            raise self.over_budget("timeout")
+
+    def forget(self) -> None:
+        """
+        Drop memoised results, once parsing has moved past them for good.
+        """
+        self._memory.clear()
+
+    def syntax_error(self) -> SyntaxError:
+        """
+        Build a SyntaxError pointing at the farthest position reached.
+        """
+        pos = self._farthest
+        line_start = self.text.rfind("\n", 0, pos) + 1
+        line_end = self.text.find("\n", pos)
+        if line_end == -1:
+            line_end = len(self.text)
+        error = SyntaxError("unexpected input")
+        error.filename = self.filename
+        error.lineno = self.text.count("\n", 0, pos) + 1
+        error.offset = pos - line_start + 1
+        error.text = self.text[line_start:line_end]
+        return error
+
+    @property
+    def farthest(self) -> int:
+        """
+        The farthest position a match failed at.
+        """
+        return self._farthest
+
+    def over_budget(self, reason: str) -> OverBudgetError:
+        """
+        Build an OverBudgetError pointing at the farthest position reached.
+        """
+        return OverBudgetError(reason, self._farthest, len(self.text))
+
+    def _start(self, thing: Any, pos: int) -> Result | Parse:
+        """
+        Match a terminal directly, or return a generator for a compound rule.
+        """
+        try:
+            kind, payload, _ = _plans[id(thing)]
+        except KeyError:
+            kind, payload, _ = _plan(thing)
+
+        if kind == _LITERAL:
+            if self.text.startswith(payload, pos):
+                return pos + len(payload), None
+        elif kind == _RULE or kind == _TOKEN_RULE or kind == _FOREIGN:
+            key = pos * _RULE_LIMIT + (payload if kind == _FOREIGN else payload[0])
+            try:
+                return self._memory[key]
+            except KeyError:
+                pass
+            if kind == _RULE:
+                if self.text.startswith(payload[1], pos):
+                    return self._rule(thing, payload, pos, key)
+                result = None
+            elif kind == _TOKEN_RULE:
+                m = payload[1](self.text, pos)
+                if m is None:
+                    result = None
+                elif (
+                    self.source_leaves
+                    and payload[2] is not None
+                    and m.end() - pos >= _SOURCE_LEAF_MIN
+                ):
+                    result = m.end(), payload[2](self.text, pos, m.end())
+                else:
+                    result = m.end(), thing(m.group(0))
+                if result is not None and self.interned is not None:
+                    node = result[1]
+                    result = result[0], self.interned.setdefault(node.intern_key(), node)
+            else:
+                result = self._delegate(thing, pos)
+            if result is not None and self.spans is not None:
+                self.spans[id(result[1])] = (pos, result[0])
+            self._memory[key] = result
+            if result is not None:
+                return result
+        elif kind == _SEQUENCE:
+            if self.text.startswith(payload[0], pos):
+                return self._sequence(payload, pos)
+        elif kind == _CHOICE:
+            if self.text.startswith(payload[0], pos):
+                if self.tag_cache is not None:
+                    tag = self.tag_cache.match(self.text, pos, payload[1])
+                    if tag is not None:
+                        return self._cached_choice(payload[1], pos, tag)
+                return self._choice(payload[1], pos)
+        elif kind == _REGEX:
+            m = payload(self.text, pos)
+            if m:
+                return m.end(), m.group(0)
+        elif kind == _KEYWORD:
+            match, keyword = payload
+            m = match(self.text, pos)
+            if m and m.group(0) == keyword:
+                return pos + len(keyword), None
+        else:
+            return pos, None
+
+        if pos > self._farthest:
+            self._farthest = pos
+        return None
+
+    def _delegate(self, thing: Any, pos: int) -> Result:
+        parser = pypeg2.Parser()
+        parser.whitespace = None
+        parser.filename = self.filename
+        rest = self.text[pos:]
+        try:
+            left, value = parser.parse(rest, thing)
+        except SyntaxError:
+            return None
+        return pos + len(rest) - len(left), value
+
+    def _rule(self, thing: type, payload: tuple, pos: int, key: int) -> Parse:
+        _, _, grammar, count = payload
+        result: Any = self._start(grammar, pos)
+        if type(result) is GeneratorType:
+            result = yield result
+
+        if result is not None:
+            end, value = result
+            if isinstance(value, thing):
+                node = value
+            elif type(value) is list:
+                if not value:
+                    node = thing()
+                elif count == 0:
+                    node = None
+                elif count == 1:
+                    node = thing(value[0])
+                else:
+                    node = thing(value)
+            elif value is None:
+                node = thing()
+            else:
+                node = thing(value)
+            if node is not None and self.interned is not None:
+                node = self.interned.setdefault(node.intern_key(), node)
+            result = end, node
+            if self.spans is not None:
+                self.spans[id(node)] = (pos, end)
+
+        self._memory[key] = result
+        return result
+
+    def _choice(self, alternatives: list, pos: int) -> Parse:
+        for alternative in alternatives:
+            result: Any = self._start(alternative, pos)
+            if type(result) is GeneratorType:
+                result = yield result
+            if result is not None:
+                return result
+        return None
+
+    def _cached_choice(self, alternatives: list, pos: int, tag: str) -> Parse:
+        end = pos + len(tag)
+        node = self.tag_cache.lookup(tag)
+        if node is not None:
+            return end, node
+        result = yield from self._choice(alternatives, pos)
+        if result is not None and result[0] == end:
+            result = end, self.tag_cache.wrap(tag, result[1])
+        return result
+
+    def _sequence(self, payload: tuple, pos: int) -> Parse:
+        _, steps, many = payload
+        values: list[Any] = []
+
+        for element, minimum, maximum, omit in steps:
+            found = 0
+            while found != maximum:
+                result: Any = self._start(element, pos)
+                if type(result) is GeneratorType:
+                    result = yield result
+                if result is None:
+                    break
+                end, value = result
+                found += 1
+                if not omit and value is not None:
+                    if type(value) is list:
+                        values.extend(value)
+                    else:
+                        values.append(value)
+                if end == pos and maximum == -1:
+                    # An empty match would repeat forever.
+                    break
+                pos = end
+
+            if found < minimum:
+                return None
+
+        if many or len(values) > 1:
+            return pos, values
+        elif not values:
+            return pos, None
+        else:
+            return pos, values[0]
+
+
+def set_progress(callback: Callable[[int], None] | None) -> None:
+    """
+    Have every parser in this process pass the farthest position it
+    reached to *callback* every _DEADLINE_STEPS nested rules, as
+    conversion processes do so that a process killed mid-parse is known
+    to have got that far.
+    """
+    global _progress
+    _progress = callback
+
+
+class LineIndex:
+    """
+    Converts offsets into a text to 1-based ``(line, column)`` pairs.
+    """
+
+    def __init__(self, text: str) -> None:
+        self._line_starts = [0]
+        self._line_starts.extend(m.end() for m in re.finditer("\n", text))
+
+    def position(self, offset: int) -> tuple[int, int]:
+        line = bisect.bisect_right(self._line_starts, offset)
+        return line, offset - self._line_starts[line - 1] + 1
+
+    def span(self, start: int, end: int) -> tuple[tuple[int, int], tuple[int, int]]:
+        return self.position(start), self.position(end)
+
+
+def parse(
+    text: str,
+    thing: Any,
+    filename: str | None = None,
+    spans: dict[int, tuple[int, int]] | None = None,
+    source_leaves: bool = False,
+    tag_cache: Any = None,
+    interned: dict[tuple, Any] | None = None,
+) -> Any:
+    """
+    Parse *text* as *thing*, a drop-in replacement for pypeg2.parse()
+    with whitespace skipping disabled.
+    """
+    return StackParser(text, filename, spans, source_leaves, tag_cache, interned).parse(thing)
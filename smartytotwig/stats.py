@@ -0,0 +1,249 @@
+"""
+Per-template statistics of batch runs, as JSON lines.
+
+A StatsLog gets a line per template a run finishes: its status and size
+and, for converted templates, what TemplateStats measured while
+converting it: the tags, AST nodes and nesting depth, the milliseconds
+spent parsing, printing and writing, the peak memory allocated and the
+tag cache hits and misses.
+
+Peak memory is taken from tracemalloc, only while trace() or the caller
+has it tracing. That slows conversion down several times over, so it is
+left off unless a StatsLog asks for *memory*. With conversion threads, the
+peaks and cache counts of templates converted at the same time overlap.
+
+summarize() turns the lines into the slowest templates and percentiles of
+conversion throughput.
+"""
+
+from __future__ import annotations
+
+import json
+import threading
+import time
+import tracemalloc
+from collections.abc import Iterator
+from contextlib import contextmanager
+from typing import Any, TextIO
+
+from . import iter_parse
+from .smarty_grammar import Content, Rule, SmartyLanguageMain, UnaryRule
+from .tag_cache import CachedStatement, TagCache
+from .twig_printer import TwigPrinter
+
+# The status of templates whose output was reused, see BatchReport; the
+# others are those of journal.
+DUPLICATE = "duplicate"
+
+# Nodes counted as tags: the statements of the language, bar content.
+_TAGS = frozenset(SmartyLanguageMain.grammar[-1]) - {Content} | {CachedStatement}
+
+# Throughput percentiles reported by summarize().
+PERCENTILES = (50, 90, 99)
+
+
+class TemplateStats:
+    """
+    What converting one template took, filled in by convert().
+    """
+
+    tags: int
+    nodes: int
+    depth: int
+    parse_ms: float
+    print_ms: float
+    write_ms: float
+    # Bytes allocated at the peak of the conversion, if tracemalloc was on.
+    peak_memory: int | None
+    # Tag cache lookups, if there was a cache.
+    cache_hits: int | None
+    cache_misses: int | None
+
+    def __init__(self) -> None:
+        self.tags = 0
+        self.nodes = 0
+        self.depth = 0
+        self.parse_ms = 0.0
+        self.print_ms = 0.0
+        self.write_ms = 0.0
+        self.peak_memory = None
+        self.cache_hits = None
+        self.cache_misses = None
+
+    def convert(
+        self, text: str, tag_cache: TagCache | None = None, deadline: float | None = None
+    ) -> Iterator[str]:
+        """
+        Convert *text* like iter_convert(), timing parsing and printing.
+
+        The time the caller takes between fragments is left for it to
+        count as writing.
+        """
+        hits = misses = 0
+        if tag_cache is not None:
+            hits, misses = tag_cache.hits, tag_cache.misses
+        base = 0
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        try:
+            printer = TwigPrinter()
+            nodes = iter_parse(text, tag_cache, deadline)
+            started = time.perf_counter()
+            for node in nodes:
+                parsed = time.perf_counter()
+                output = printer.print(node)
+                printed = time.perf_counter()
+                self.parse_ms += (parsed - started) * 1000
+                self.print_ms += (printed - parsed) * 1000
+                self._count(node)
+                yield output
+                started = time.perf_counter()
+            self.parse_ms += (time.perf_counter() - started) * 1000
+        finally:
+            if tracemalloc.is_tracing():
+                self.peak_memory = tracemalloc.get_traced_memory()[1] - base
+            if tag_cache is not None:
+                self.cache_hits = tag_cache.hits - hits
+                self.cache_misses = tag_cache.misses - misses
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "tags": self.tags,
+            "nodes": self.nodes,
+            "depth": self.depth,
+            "parse_ms": round(self.parse_ms, 3),
+            "print_ms": round(self.print_ms, 3),
+            "write_ms": round(self.write_ms, 3),
+            "peak_memory": self.peak_memory,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+        }
+
+    def _count(self, statement: Any) -> None:
+        # Children of a cached tag are the tag itself, not one more.
+        stack = [(statement, 1, False)]
+        while stack:
+            node, depth, cached = stack.pop()
+            self.nodes += 1
+            self.depth = max(self.depth, depth)
+            if type(node) in _TAGS and not cached:
+                self.tags += 1
+            if isinstance(node, Rule):
+                for child in node.children:
+                    stack.append((child, depth + 1, type(node) is CachedStatement))
+            elif isinstance(node, UnaryRule):
+                stack.append((node.child, depth + 1, False))
+
+
+@contextmanager
+def trace(enabled: bool = True) -> Iterator[None]:
+    """
+    Have tracemalloc trace allocations for peak memory, if *enabled* and
+    it does not already.
+    """
+    if not enabled or tracemalloc.is_tracing():
+        yield
+        return
+    tracemalloc.start()
+    try:
+        yield
+    finally:
+        tracemalloc.stop()
+
+
+class StatsLog:
+    """
+    The JSON lines statistics of a batch run, see the module docstring.
+    """
+
+    file_name: str
+    # Whether runs trace memory to record peaks, see trace().
+    memory: bool
+
+    def __init__(self, file_name: str, memory: bool = False) -> None:
+        self.file_name = file_name
+        self.memory = memory
+        self._file: TextIO = open(file_name, "w", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def record(
+        self, source: str, status: str, size: int | None, stats: TemplateStats | None = None
+    ) -> None:
+        """
+        Append the line of a template of *size* bytes.
+        """
+        entry = {"path": source, "status": status, "bytes": size}
+        if stats is not None:
+            entry.update(stats.as_dict())
+        with self._lock:
+            self._file.write(json.dumps(entry) + "\n")
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def load(file_names: list[str]) -> list[dict[str, Any]]:
+    """
+    Read the lines of the StatsLog files *file_names*, skipping a line
+    torn by an interrupted run.
+    """
+    entries = []
+    for file_name in file_names:
+        with open(file_name, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue
+    return entries
+
+
+def summarize(entries: list[dict[str, Any]], top: int = 10) -> list[str]:
+    """
+    Describe the *top* slowest converted templates of *entries* and the
+    percentiles of conversion throughput, a line each.
+    """
+    timed = [entry for entry in entries if entry.get("parse_ms") is not None]
+    timed.sort(key=lambda entry: (-_elapsed(entry), entry["path"]))
+    lines = [
+        "%d templates, %d converted with statistics" % (len(entries), len(timed)),
+    ]
+    if not timed:
+        return lines
+
+    lines.append("Slowest:")
+    for entry in timed[:top]:
+        lines.append(
+            "%10.1fms  parse %.1f, print %.1f, write %.1f, %d bytes, %d tags, depth %d  %s"
+            % (
+                _elapsed(entry),
+                entry["parse_ms"],
+                entry["print_ms"],
+                entry["write_ms"],
+                entry["bytes"],
+                entry["tags"],
+                entry["depth"],
+                entry["path"],
+            )
+        )
+
+    rates = sorted(entry["bytes"] / max(_elapsed(entry), 0.001) for entry in timed)
+    lines.append(
+        "Throughput, KB/s: "
+        + ", ".join("p%d %.1f" % (p, _percentile(rates, p)) for p in PERCENTILES)
+    )
+    total = sum(_elapsed(entry) for entry in timed)
+    size = sum(entry["bytes"] for entry in timed)
+    lines.append("Overall %.1f KB/s, %d bytes in %.1fms" % (size / max(total, 0.001), size, total))
+    return lines
+
+
+def _elapsed(entry: dict[str, Any]) -> float:
+    return entry["parse_ms"] + entry["print_ms"] + entry["write_ms"]
+
+
+def _percentile(ordered: list[float], percent: int) -> float:
+    # The nearest rank: the smallest value at least percent% are at or below.
+    rank = max(1, -(-len(ordered) * percent // 100))
+    return ordered[rank - 1]
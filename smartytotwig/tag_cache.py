@@ -0,0 +1,151 @@
+"""
+A memo of the Twig output of self-contained Smarty tags.
+
+The same tags ({$item.title|escape}, {include file="header.tpl"}) come
+back over and over across the templates of a site. A TagCache passed to
+the parser is consulted before a tag is parsed: on a hit the tag becomes a
+CachedStatement holding its Twig output; on a miss the parsed statement is
+wrapped in a CachedStatement that stores its output when printed.
+
+Only tags whose parse cannot depend on the text that follows them are
+cached: comments and the opening and closing tags of blocks are left
+alone, and an output is only stored once the tag was parsed as one of the
+statements in CACHEABLE. Tags that are never one of those, such as
+{else} or {ldelim}, are not looked up and do not count as misses.
+"""
+
+from __future__ import annotations
+
+import json
+import re
+import threading
+from collections import OrderedDict
+from typing import Any
+
+from .smarty_grammar import (
+    AssignStatement,
+    FunctionStatement,
+    IncludeStatement,
+    PrintStatement,
+    Rule,
+    SmartyLanguage,
+    SmartyLanguageMain,
+    TranslationStatement,
+)
+
+CACHEABLE = (
+    PrintStatement,
+    IncludeStatement,
+    AssignStatement,
+    TranslationStatement,
+    FunctionStatement,
+)
+
+# A tag without nested braces, escapes or backticks that does not open a
+# comment, close a block, open one of the blocks the statement choices try
+# before the cacheable statements, or name a tag none of those can be.
+_TAG = re.compile(
+    r"\{(?![ \n\t]*+(?:\*|/|(?:if|foreach|block|capture|literal|else|elseif|foreachelse"
+    r"|ldelim|rdelim|extends|init_time|process_time)\b))[^{}`\\]*+\}"
+)
+
+# The statement choices the cache is consulted in.
+_CHOICES = frozenset(id(language.grammar[-1]) for language in (SmartyLanguage, SmartyLanguageMain))
+
+
+class CachedStatement(Rule):
+    """
+    A tag looked up in a TagCache.
+
+    On a hit output is set and there are no children; on a miss the only
+    child is the statement parsed from the tag.
+    """
+
+    tag: str
+    output: str | None
+    cache: TagCache
+
+    def __init__(
+        self, args: list[Any], tag: str, cache: TagCache, output: str | None = None
+    ) -> None:
+        super().__init__(args)
+        self.tag = tag
+        self.cache = cache
+        self.output = output
+
+
+class TagCache:
+    """
+    A least recently used map from tag text to Twig output, with hit
+    statistics. Parsers in several threads can share one.
+    """
+
+    def __init__(self, max_size: int = 100000) -> None:
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._outputs: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def match(self, text: str, pos: int, choice: Any) -> str | None:
+        """
+        Return the tag at *pos* if it may be cached where *choice* is tried.
+        """
+        if id(choice) not in _CHOICES:
+            return None
+        m = _TAG.match(text, pos)
+        return m.group(0) if m else None
+
+    def lookup(self, tag: str) -> CachedStatement | None:
+        """
+        Return a node for *tag* if its output is cached.
+        """
+        with self._lock:
+            output = self._outputs.get(tag)
+            if output is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._outputs.move_to_end(tag)
+        return CachedStatement([], tag, self, output)
+
+    def wrap(self, tag: str, node: Any) -> Any:
+        """
+        Wrap *node*, parsed from *tag*, so printing it fills the cache.
+        """
+        if isinstance(node, CACHEABLE):
+            return CachedStatement([node], tag, self)
+        return node
+
+    def put(self, tag: str, output: str) -> None:
+        with self._lock:
+            self._outputs[tag] = output
+            self._outputs.move_to_end(tag)
+            if len(self._outputs) > self.max_size:
+                self._outputs.popitem(last=False)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __len__(self) -> int:
+        return len(self._outputs)
+
+    def save(self, file_name: str) -> None:
+        """
+        Write the cached outputs to a JSON file, least recently used first.
+        """
+        with open(file_name, "w", encoding="utf-8") as f:
+            json.dump(self._outputs, f)
+
+    @classmethod
+    def load(cls, file_name: str, max_size: int = 100000) -> TagCache:
+        """
+        Read a cache written by save().
+        """
+        cache = cls(max_size)
+        with open(file_name, encoding="utf-8") as f:
+            for tag, output in json.load(f).items():
+                cache.put(tag, output)
+        return cache
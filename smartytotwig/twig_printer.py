@@ -1,3 +1,5 @@
+from typing import Any
+
 from .smarty_grammar import (
     AddOperator,
     AndOperator,
@@ -46,6 +48,7 @@ from .smarty_grammar import (
     IncludeStatement,
     IsLink,
     IsOperator,
+    LeafRule,
     LeftDelim,
     LeftDelimTag,
     LeftParen,
@@ -67,25 +70,59 @@ from .smarty_grammar import (
     PrintStatement,
     RightDelimTag,
     RightParen,
+    Rule,
     SimpleTag,
     SingleQuotedString,
     SmartyLanguage,
     SmartyLanguageMain,
     SmartyLanguageMainOrEmpty,
+    SourceLeafRule,
     String,
     SubOperator,
     Symbol,
     Text,
     TranslationStatement,
+    UnaryRule,
     Variable,
     VariableString,
 )
+from .tag_cache import CachedStatement
 from .tree_walker import make_visitor
 
 
 class TwigPrinter:
     visitor = make_visitor()
 
+    def print(self, root: Any) -> str:
+        """
+        Print the tree under *root* like root.accept(self), but without
+        recursion and visiting every node object once: the output of a
+        subtree shared by several parents, as with interned parsing, is
+        reused.
+        """
+        printed: dict[int, Any] = {}
+        # Entries are (node, children); children is None until pushed.
+        stack: list[tuple[Any, list | None]] = [(root, None)]
+        while stack:
+            node, children = stack.pop()
+            if children is not None:
+                printed[id(node)] = self.visit(node, *[printed[id(child)] for child in children])
+            elif id(node) in printed:
+                pass
+            elif isinstance(node, Rule):
+                stack.append((node, node.children))
+                stack.extend((child, None) for child in reversed(node.children))
+            elif isinstance(node, UnaryRule):
+                stack.append((node, [node.child]))
+                stack.append((node.child, None))
+            elif isinstance(node, SourceLeafRule):
+                printed[id(node)] = self.visit(node, node.body)
+            elif isinstance(node, LeafRule):
+                printed[id(node)] = self.visit(node, node.value)
+            else:
+                printed[id(node)] = self.visit(node)
+        return printed[id(root)]
+
     # pylint: disable=W0613,E0102
 
     @visitor(SmartyLanguage)
@@ -369,13 +406,20 @@ class TwigPrinter:
     def visit(self, node, child):
         return "{%% else %%}%s" % child
 
+    @visitor(CachedStatement)
+    def visit(self, node, statement=None):
+        if statement is None:
+            return node.output
+        node.cache.put(node.tag, statement)
+        return statement
+
     @visitor(CommentStatement)
     def visit(self, node, child):
-        return "{#%s#}" % child[2:-2]
+        return "{#%s#}" % child
 
     @visitor(LiteralStatement)
     def visit(self, node, child):
-        return child[9:-10]
+        return child
 
     @visitor(ForItem)
     def visit(self, node, value):
@@ -0,0 +1,83 @@
+import asyncio
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pytest
+
+from smartytotwig import aio
+from smartytotwig.aio import convert_many_async, convert_string_async
+from smartytotwig.stack_parser import OverBudgetError
+
+SLOW = "{if $a}" + "{$b|c}" * 500 + "{/if}"
+
+
+def test_convert_string():
+    async def convert():
+        with ProcessPoolExecutor(1) as executor:
+            return await asyncio.gather(
+                convert_string_async("{$a}"),
+                convert_string_async("{$b}", executor, asyncio.Semaphore(1)),
+            )
+
+    assert asyncio.run(convert()) == ["{{ a }}", "{{ b }}"]
+    with pytest.raises(OverBudgetError):
+        asyncio.run(convert_string_async(SLOW, timeout=0))
+    # Many top-level tags rather than one.
+    with pytest.raises(OverBudgetError):
+        asyncio.run(convert_string_async("{$a|b}" * 5000, timeout=0))
+
+
+def test_convert_many_backpressure():
+    taken = []
+
+    def texts():
+        for i in range(10):
+            taken.append(i)
+            yield "{$a%d}" % i
+
+    async def convert():
+        outputs = []
+        async for output in convert_many_async(texts(), concurrency=3):
+            # Only as many templates as are converting have been taken.
+            assert len(taken) <= len(outputs) + 3
+            outputs.append(output)
+        return outputs
+
+    assert asyncio.run(convert()) == ["{{ a%d }}" % i for i in range(10)]
+
+
+def test_convert_many_errors():
+    async def convert(**kwargs):
+        return [output async for output in convert_many_async(["{$a}", SLOW], **kwargs)]
+
+    first, error = asyncio.run(convert(timeout=0, return_exceptions=True))
+    assert first == "{{ a }}" and isinstance(error, OverBudgetError)
+    with pytest.raises(OverBudgetError):
+        asyncio.run(convert(timeout=0))
+
+
+def test_cancel_drops_queued(monkeypatch):
+    release = threading.Event()
+    converted = []
+
+    def convert(text, timeout):
+        release.wait(5)
+        converted.append(text)
+        return text
+
+    monkeypatch.setattr(aio, "_convert", convert)
+
+    async def cancel(executor):
+        tasks = [asyncio.create_task(convert_string_async(text, executor)) for text in "abc"]
+        await asyncio.sleep(0.1)
+        for task in tasks[1:]:
+            task.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    with ThreadPoolExecutor(1) as executor:
+        results = asyncio.run(cancel(executor))
+    assert results[0] == "a"
+    assert all(isinstance(result, asyncio.CancelledError) for result in results[1:])
+    assert converted == ["a"]
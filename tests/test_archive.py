@@ -0,0 +1,84 @@
+import io
+import tarfile
+import zipfile
+
+import pytest
+
+from smartytotwig.archive import convert_archive
+
+MEMBERS = {
+    "theme/page.tpl": b"<p>{$title}</p>\n",
+    "theme/static.tpl": b"<p>static</p>\n",
+    "theme/broken.tpl": b"{$a}\xff",
+    "theme/logo.png": b"\x89PNG{\xff\x00",
+}
+
+
+def make_tar(path):
+    with tarfile.open(path, "w:gz") as archive:
+        directory = tarfile.TarInfo("theme")
+        directory.type = tarfile.DIRTYPE
+        archive.addfile(directory)
+        for name, data in MEMBERS.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = 1700000000
+            archive.addfile(info, io.BytesIO(data))
+        link = tarfile.TarInfo("theme/index.tpl")
+        link.type = tarfile.SYMTYPE
+        link.linkname = "page.tpl"
+        archive.addfile(link)
+
+
+def test_tar(tmp_path):
+    make_tar(tmp_path / "theme.tar.gz")
+    report = convert_archive(str(tmp_path / "theme.tar.gz"), str(tmp_path / "out.tar.xz"))
+
+    assert (report.converted, report.copied) == (1, 1)
+    assert [member for member, _ in report.failed] == ["theme/broken.tpl"]
+    with tarfile.open(tmp_path / "out.tar.xz") as archive:
+        assert archive.getnames() == [
+            "theme",
+            "theme/page.twig",
+            "theme/static.twig",
+            "theme/broken.tpl",
+            "theme/logo.png",
+            "theme/index.twig",
+        ]
+        assert archive.extractfile("theme/page.twig").read() == b"<p>{{ title }}</p>\n"
+        assert archive.extractfile("theme/logo.png").read() == MEMBERS["theme/logo.png"]
+        # The template that failed is copied as it is.
+        assert archive.extractfile("theme/broken.tpl").read() == MEMBERS["theme/broken.tpl"]
+        assert archive.getmember("theme/page.twig").mtime == 1700000000
+        assert archive.getmember("theme/index.twig").linkname == "page.twig"
+
+
+def test_zip(tmp_path):
+    with zipfile.ZipFile(tmp_path / "theme.zip", "w") as archive:
+        for name, data in MEMBERS.items():
+            archive.writestr(name, data)
+
+    report = convert_archive(str(tmp_path / "theme.zip"), str(tmp_path / "out.zip"))
+    assert (report.converted, report.copied) == (1, 1)
+    assert [member for member, _ in report.failed] == ["theme/broken.tpl"]
+    with zipfile.ZipFile(tmp_path / "out.zip") as archive:
+        assert archive.namelist() == [
+            "theme/page.twig",
+            "theme/static.twig",
+            "theme/broken.tpl",
+            "theme/logo.png",
+        ]
+        assert archive.read("theme/static.twig") == MEMBERS["theme/static.tpl"]
+        assert archive.read("theme/broken.tpl") == MEMBERS["theme/broken.tpl"]
+
+
+def test_bad_archives(tmp_path):
+    make_tar(tmp_path / "theme.tar.gz")
+    with pytest.raises(ValueError):
+        convert_archive(str(tmp_path / "theme.tar.gz"), str(tmp_path / "out.rar"))
+
+    (tmp_path / "notes.txt").write_text("not an archive")
+    with pytest.raises(ValueError):
+        convert_archive(str(tmp_path / "notes.txt"), str(tmp_path / "out.tar"))
+    assert not (tmp_path / "out.tar.part").exists()
+    assert not (tmp_path / "out.tar").exists()
@@ -0,0 +1,332 @@
+import os
+
+import pytest
+
+from smartytotwig import batch, pipeline
+from smartytotwig.batch import (
+    BatchReport,
+    ChangedFileWriter,
+    convert_file,
+    convert_tree,
+    copy_template,
+    dependencies,
+    iter_templates,
+    select_shard,
+    twig_path,
+)
+from smartytotwig.journal import Journal
+from smartytotwig.mapped import convert_buffer
+
+
+@pytest.fixture
+def tree(tmp_path):
+    source = tmp_path / "src"
+    (source / "partials").mkdir(parents=True)
+    (source / "page.tpl").write_text("<p>{$title}</p>\n")
+    (source / "partials" / "icon.tpl").write_bytes(b"<svg>\xff</svg>\n")
+    (source / "partials" / "windows.tpl").write_bytes(b"a\r\nb\r\n")
+    (source / "notes.txt").write_text("{$ignored}")
+    return source
+
+
+def test_iter_templates(tree):
+    assert iter_templates(str(tree)) == [
+        "page.tpl",
+        os.path.join("partials", "icon.tpl"),
+        os.path.join("partials", "windows.tpl"),
+    ]
+
+
+def test_twig_path():
+    assert twig_path("a/b.tpl") == "a/b.twig"
+    assert twig_path("a/b.tpl.tpl") == "a/b.tpl.twig"
+
+
+def test_convert_tree(tree, tmp_path):
+    target = tmp_path / "out"
+    report = convert_tree(str(tree), str(target))
+
+    assert (report.converted, report.copied, report.failed) == (2, 1, [])
+    assert (target / "page.twig").read_text() == "<p>{{ title }}</p>\n"
+    assert (target / "partials" / "icon.twig").read_bytes() == b"<svg>\xff</svg>\n"
+    assert (target / "partials" / "windows.twig").read_bytes() == b"a\nb\n"
+    assert not (target / "notes.twig").exists()
+    assert report.summary() == "2 templates converted, 1 copied verbatim, 0 unchanged, 0 failed"
+
+
+def test_hard_link(tree, tmp_path):
+    target = tmp_path / "out"
+    report = convert_tree(str(tree), str(target), link=True)
+    assert report.copied == 1
+    assert os.path.samefile(target / "partials" / "icon.twig", tree / "partials" / "icon.tpl")
+
+    # Once the source gains tags, converting replaces the link instead of
+    # writing through it into the source.
+    (tree / "partials" / "icon.tpl").unlink()
+    (tree / "partials" / "icon.tpl").write_text("{$icon}")
+    convert_tree(str(tree), str(target), link=True)
+    assert (target / "partials" / "icon.twig").read_text() == "{{ icon }}"
+    assert (tree / "partials" / "icon.tpl").read_text() == "{$icon}"
+
+
+@pytest.mark.parametrize("link", [False, True])
+def test_copy_through_linked_partial(tmp_path, link):
+    # A side file left linked to the source by a killed --hard-link run.
+    source = tmp_path / "a.tpl"
+    source.write_text("static\n")
+    os.link(source, tmp_path / "a.twig.part")
+    assert copy_template(str(source), str(tmp_path / "a.twig"), b"static\n", link)
+    assert source.read_text() == (tmp_path / "a.twig").read_text() == "static\n"
+    assert not (tmp_path / "a.twig.part").exists()
+
+
+def test_convert_through_linked_partial(tmp_path):
+    source = tmp_path / "a.tpl"
+    source.write_text("{$foo}")
+    os.link(source, tmp_path / "a.twig.part")
+    assert convert_file(str(source), str(tmp_path / "a.twig")) == (False, True)
+    assert source.read_text() == "{$foo}"
+    assert (tmp_path / "a.twig").read_text() == "{{ foo }}"
+
+
+def test_failure(tree, tmp_path):
+    (tree / "broken.tpl").write_bytes(b"{$a}\xff")
+    report = convert_tree(str(tree), str(tmp_path / "out"))
+    assert [source for source, _ in report.failed] == [str(tree / "broken.tpl")]
+    assert "UnicodeDecodeError" in report.failed[0][1]
+    assert report.converted == 2
+
+
+def test_convert_file_keeps_target_on_error(tmp_path):
+    source = tmp_path / "a.tpl"
+    source.write_bytes(b"{$a}\xff")
+    target = tmp_path / "a.twig"
+    target.write_text("old")
+    with pytest.raises(UnicodeDecodeError):
+        convert_file(str(source), str(target))
+    assert target.read_text() == "old"
+
+
+@pytest.mark.parametrize("mapped", [False, True])
+def test_convert_file_deep_nesting(tmp_path, monkeypatch, mapped):
+    if mapped:
+        monkeypatch.setattr(batch, "MAPPED_SIZE", 1)
+    blocks = [
+        ("{if $a}", "{/if}", "{% if a %}", "{% endif %}"),
+        ("{foreach from=$b item=c}", "{/foreach}", "{% for c in b %}", "{% endfor %}"),
+        ("{block name=d}", "{/block}", "{% block d %}", "{% endblock %}"),
+        ("{capture name=e}", "{/capture}", "{% set e %}", "{% endset %}"),
+    ]
+    nested = [blocks[i % 4] for i in range(10000)]
+    source = tmp_path / "deep.tpl"
+    source.write_text(
+        "".join(block[0] + "x" for block in nested)
+        + "".join(block[1] for block in reversed(nested))
+    )
+    convert_file(str(source), str(tmp_path / "deep.twig"))
+    assert (tmp_path / "deep.twig").read_text() == (
+        "".join(block[2] + "x" for block in nested)
+        + "".join(block[3] for block in reversed(nested))
+    )
+
+
+@pytest.mark.parametrize("jobs, backend", [(1, "processes"), (2, "threads"), (2, "processes")])
+def test_convert_tree_mapped(tree, tmp_path, monkeypatch, jobs, backend):
+    convert_tree(str(tree), str(tmp_path / "read"))
+    monkeypatch.setattr(batch, "MAPPED_SIZE", 1)
+    calls = []
+
+    def spy(data, *args):
+        calls.append(type(data))
+        return convert_buffer(data, *args)
+
+    monkeypatch.setattr(batch, "convert_buffer", spy)
+    monkeypatch.setattr(pipeline, "convert_buffer", spy)
+
+    for unchanged in (0, 3):
+        report = convert_tree(str(tree), str(tmp_path / "mapped"), jobs=jobs, backend=backend)
+        assert (report.converted, report.copied, report.unchanged) == (2, 1, unchanged)
+    # Conversion processes do not see the patches.
+    if jobs == 1 or backend == "threads":
+        assert len(calls) == 4
+    for path in (tmp_path / "read").rglob("*.twig"):
+        assert (tmp_path / "mapped" / path.relative_to(tmp_path / "read")).read_bytes() == (
+            path.read_bytes()
+        )
+
+
+def test_unchanged_targets_not_written(tree, tmp_path):
+    target = tmp_path / "out"
+    convert_tree(str(tree), str(target))
+    for path in target.rglob("*.twig"):
+        os.utime(path, (0, 0))
+
+    report = convert_tree(str(tree), str(target))
+    assert report.unchanged == 3
+    assert all(path.stat().st_mtime == 0 for path in target.rglob("*.twig"))
+
+    (tree / "page.tpl").write_text("<p>{$title}</p>\n<p>more</p>\n")
+    report = convert_tree(str(tree), str(target))
+    assert report.unchanged == 2
+    assert (target / "page.twig").read_text() == "<p>{{ title }}</p>\n<p>more</p>\n"
+    assert not list(target.rglob("*.part"))
+
+
+@pytest.mark.parametrize(
+    "old, chunks",
+    [
+        (None, [b"abc"]),
+        (b"abc", [b"a", b"bc"]),
+        (b"abcd", [b"a", b"bc"]),
+        (b"ab", [b"a", b"bc"]),
+        (b"axc", [b"a", b"bc"]),
+        (b"", []),
+    ],
+)
+def test_changed_file_writer(tmp_path, old, chunks):
+    path = tmp_path / "file"
+    if old is not None:
+        path.write_bytes(old)
+    writer = ChangedFileWriter(str(path))
+    for chunk in chunks:
+        writer.write(chunk)
+    assert writer.close() == (old != b"".join(chunks))
+    assert path.read_bytes() == b"".join(chunks)
+    assert os.listdir(tmp_path) == ["file"]
+
+
+def test_changed_file_writer_abort(tmp_path):
+    path = tmp_path / "file"
+    path.write_bytes(b"abc")
+    writer = ChangedFileWriter(str(path))
+    writer.write(b"x")
+    writer.abort()
+    assert path.read_bytes() == b"abc"
+    assert os.listdir(tmp_path) == ["file"]
+
+
+def test_changed_file_writer_failure(tmp_path, monkeypatch):
+    path = tmp_path / "file"
+    path.write_bytes(b"abc")
+    writer = ChangedFileWriter(str(path))
+    writer.write(b"x")
+
+    def fail(source, target):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "replace", fail)
+    with pytest.raises(OSError):
+        writer.close()
+    assert path.read_bytes() == b"abc"
+    assert os.listdir(tmp_path) == ["file"]
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_stale_partial_removed(tree, tmp_path, jobs):
+    target = tmp_path / "out"
+    convert_tree(str(tree), str(target))
+    # As left by a run killed while writing, next to targets that are
+    # unchanged, so never written this time.
+    (target / "page.twig.part").write_text("{{ ti")
+    (target / "partials" / "windows.twig.part").write_text("a")
+    report = convert_tree(str(tree), str(target), jobs=jobs)
+    assert report.unchanged == 3
+    assert not list(target.rglob("*.part"))
+
+
+@pytest.mark.parametrize("text", ["static\n", "{$foo}"])
+def test_convert_file_removes_stale_partial(tmp_path, text):
+    source = tmp_path / "a.tpl"
+    source.write_text(text)
+    target = str(tmp_path / "a.twig")
+    convert_file(str(source), target, link=True)
+    # Left linked to the source by a killed run, next to a target that is
+    # unchanged, so never written this time.
+    os.link(source, target + ".part")
+    assert convert_file(str(source), target, link=True)[1] is False
+    assert source.read_text() == text
+    assert not os.path.exists(target + ".part")
+
+
+def test_select_shard():
+    templates = [("t%d.tpl" % i, size) for i, size in enumerate([90000, 50000] + [100] * 400)]
+    shards = [select_shard(templates, index, 3) for index in range(1, 4)]
+
+    assert sorted(sum(shards, [])) == sorted(path for path, _ in templates)
+    assert shards == [select_shard(templates[::-1], index, 3) for index in range(1, 4)]
+    sizes = dict(templates)
+    loads = [sum(sizes[path] + 4096 for path in shard) for shard in shards]
+    assert max(loads) - min(loads) <= 4096 + 100
+
+    with pytest.raises(ValueError):
+        select_shard(templates, 0, 3)
+
+
+def test_dependencies():
+    data = b"""{extends file="layout.tpl"}{include file='a/b.tpl' x=1}{include file=$c}"""
+    assert dependencies(data) == ["layout.tpl", "a/b.tpl"]
+
+
+def test_shard_reports(tree, tmp_path):
+    (tree / "partials" / "broken.tpl").write_bytes(b'{include file="page.tpl"}\xff')
+    target = tmp_path / "out"
+    for index in (1, 2):
+        report = convert_tree(str(tree), str(target), shard=(index, 2))
+        report.save(str(tmp_path / ("%d.json" % index)), str(tree))
+
+    reports = [BatchReport.load(str(tmp_path / ("%d.json" % index))) for index in (1, 2)]
+    merged = BatchReport.merge(reports)
+    assert (merged.converted, merged.copied) == (2, 1)
+    assert [source for source, _ in merged.failed] == ["partials/broken.tpl"]
+    assert merged.dependencies == {"partials/broken.tpl": ["page.tpl"]}
+    assert merged.summary() == "2 templates converted, 1 copied verbatim, 0 unchanged, 1 failed"
+
+    with pytest.raises(ValueError, match="missing shards 2/2"):
+        BatchReport.merge(reports[:1])
+    with pytest.raises(ValueError, match="duplicate"):
+        BatchReport.merge(reports + reports[:1])
+    with pytest.raises(ValueError):
+        BatchReport.merge([reports[0], BatchReport()])
+
+
+def test_resume(tree, tmp_path):
+    target = tmp_path / "out"
+    journal_file = str(tmp_path / "journal")
+    journal = Journal(journal_file)
+    convert_tree(str(tree), str(target), journal=journal)
+    journal.close()
+    # A run killed while writing an entry.
+    with open(journal_file, "a") as f:
+        f.write('{"path": "torn')
+
+    (tree / "page.tpl").write_text("<p>{$subtitle}</p>\n")
+    (target / "partials" / "icon.twig").write_text("edited")
+    journal = Journal(journal_file, resume=True)
+    report = convert_tree(str(tree), str(target), journal=journal)
+    journal.close()
+
+    assert (report.converted, report.copied, report.resumed) == (1, 1, 1)
+    assert (target / "page.twig").read_text() == "<p>{{ subtitle }}</p>\n"
+    assert (target / "partials" / "icon.twig").read_bytes() == b"<svg>\xff</svg>\n"
+    assert report.summary().endswith(", 1 done before resuming")
+
+    journal = Journal(journal_file, resume=True)
+    assert len(journal.finished) == 4
+    journal.close()
+
+
+def test_duplicates(tree, tmp_path):
+    for locale in ("de", "fr"):
+        (tree / locale).mkdir()
+        (tree / locale / "page.tpl").write_bytes((tree / "page.tpl").read_bytes())
+        (tree / locale / "broken.tpl").write_bytes(b"{$a}\xff")
+    target = tmp_path / "out"
+    report = convert_tree(str(tree), str(target))
+
+    assert (report.converted, report.duplicates) == (2, 2)
+    assert (target / "fr" / "page.twig").read_bytes() == (target / "page.twig").read_bytes()
+    assert [error for _, error in report.failed] == [report.failed[0][1]] * 2
+    assert ", 2 duplicates skipped" in report.summary()
+
+    again = convert_tree(str(tree), str(target))
+    assert (again.converted, again.duplicates, again.unchanged) == (2, 2, 5)
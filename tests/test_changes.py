@@ -0,0 +1,91 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from smartytotwig.changes import changed_templates, dependents, git_changes, git_removals
+
+pytestmark = pytest.mark.skipif(shutil.which("git") is None, reason="git is not installed")
+
+
+def git(repo, *args):
+    subprocess.run(
+        ["git", "-C", str(repo), "-c", "user.name=t", "-c", "user.email=t@t", *args],
+        check=True,
+        capture_output=True,
+    )
+
+
+@pytest.fixture
+def repo(tmp_path):
+    (tmp_path / "partials").mkdir()
+    (tmp_path / "layout.tpl").write_text("<body>{block name=body}{/block}</body>")
+    (tmp_path / "page.tpl").write_text('{extends file="layout.tpl"}')
+    (tmp_path / "partials" / "icon.tpl").write_text("<svg/>")
+    (tmp_path / "partials" / "button.tpl").write_text("{include file='./icon.tpl'}")
+    (tmp_path / "other.tpl").write_text('{include file="icon.tpl"}')
+    git(tmp_path, "init", "-q")
+    git(tmp_path, "add", ".")
+    git(tmp_path, "commit", "-q", "-m", "initial")
+    return tmp_path
+
+
+def test_git_changes(repo):
+    assert git_changes(str(repo), since="HEAD") == []
+
+    (repo / "layout.tpl").write_text("<html>{block name=body}{/block}</html>")
+    (repo / "new.tpl").write_text("new")
+    git(repo, "mv", "partials/icon.tpl", "partials/logo.tpl")
+    assert git_changes(str(repo), staged=True) == ["partials/logo.tpl"]
+    assert git_changes(str(repo), since="HEAD") == ["layout.tpl", "new.tpl", "partials/logo.tpl"]
+
+
+def test_dependents(repo):
+    assert dependents(str(repo), ["layout.tpl"]) == ["page.tpl"]
+    assert dependents(str(repo), ["partials/icon.tpl"]) == ["partials/button.tpl"]
+    assert dependents(str(repo), ["page.tpl"]) == []
+
+    # Untracked includers are found too, and only staged ones in the index.
+    (repo / "new.tpl").write_text('{extends file="page.tpl"}')
+    assert dependents(str(repo), ["page.tpl"]) == ["new.tpl"]
+    assert dependents(str(repo), ["page.tpl"], cached=True) == []
+    git(repo, "add", "new.tpl")
+    (repo / "new.tpl").write_text("new")
+    assert dependents(str(repo), ["page.tpl"]) == []
+    assert dependents(str(repo), ["page.tpl"], cached=True) == ["new.tpl"]
+
+
+def test_changed_templates(repo):
+    (repo / "partials" / "icon.tpl").write_text("<svg></svg>")
+    git(repo, "add", ".")
+    (repo / "partials" / "button.tpl").write_text(
+        "{include file='./icon.tpl'}{include file='../page.tpl'}"
+    )
+    (repo / "layout.tpl").write_text("<html>{block name=body}{/block}</html>")
+
+    assert changed_templates(str(repo), staged=True) == [
+        os.path.join("partials", "button.tpl"),
+        os.path.join("partials", "icon.tpl"),
+    ]
+    assert changed_templates(str(repo), since="HEAD") == [
+        "layout.tpl",
+        "page.tpl",
+        os.path.join("partials", "button.tpl"),
+        os.path.join("partials", "icon.tpl"),
+    ]
+
+
+def test_removals(repo):
+    git(repo, "rm", "-q", "partials/icon.tpl")
+    git(repo, "mv", "layout.tpl", "base.tpl")
+    assert git_removals(str(repo), staged=True) == ["layout.tpl", "partials/icon.tpl"]
+    assert git_changes(str(repo), staged=True) == ["base.tpl"]
+
+    # Templates including what is gone are converted again.
+    assert changed_templates(str(repo), staged=True) == [
+        "base.tpl",
+        "page.tpl",
+        os.path.join("partials", "button.tpl"),
+    ]
+    assert changed_templates(str(repo), since="HEAD") == changed_templates(str(repo), staged=True)
@@ -0,0 +1,89 @@
+from pathlib import Path
+
+import pytest
+
+from smartytotwig import parse_string
+from smartytotwig.compact_ast import CompactTree, Cursor, StringTable, parse_compact
+from smartytotwig.smarty_grammar import Content, IfStatement, Text
+from smartytotwig.tag_cache import CachedStatement, TagCache
+from smartytotwig.twig_printer import TwigPrinter
+
+EXAMPLES = Path(__file__).parent.parent / "examples"
+
+TEMPLATES = [
+    "",
+    "<p>{$foo.bar|escape:'html'}</p>",
+    '{$a|b:"x `$y` $z"}',
+    "{if $a > 1 and !$b}x{elseif $c}y{else}z{/if}",
+    "{foreach from=$items item=item name=loop}{$item@index+1}{foreachelse}none{/foreach}",
+    "{block name=content}{capture name=c}{include file='a.tpl'}{/capture}{/block}",
+    "{* comment *}{literal}{$raw}{/literal}{ldelim}{rdelim}",
+] + [path.read_text(encoding="utf-8") for path in sorted(EXAMPLES.glob("*.tpl"))]
+
+
+@pytest.mark.parametrize("text", TEMPLATES)
+def test_round_trip(text):
+    ast = parse_string(text)
+    assert repr(CompactTree.from_ast(ast).to_ast()) == repr(ast)
+
+
+@pytest.mark.parametrize("text", TEMPLATES)
+def test_cursor_prints_like_ast(text):
+    tree = parse_compact(text)
+    assert tree.root.accept(TwigPrinter()) == parse_string(text).accept(TwigPrinter())
+
+
+def test_spans():
+    text = '<p>{$a|b:"x `$y`"}</p>'
+    tree = parse_compact(text)
+    assert min(tree.starts) == 0
+    assert all(end >= start for start, end in zip(tree.starts, tree.ends, strict=True))
+
+    contents = [
+        text[tree.starts[index] : tree.ends[index]]
+        for index in range(len(tree))
+        if Cursor(tree, index).kind is Content
+    ]
+    assert contents == ["<p>", "</p>"]
+
+
+def test_text_value():
+    tree = parse_compact('{$a|b:"one $two"}')
+    (text,) = [index for index in range(len(tree)) if Cursor(tree, index).kind is Text]
+    assert Cursor(tree, text).value == ["one "]
+
+
+def test_shared_string_table():
+    strings = StringTable()
+    first = parse_compact("{$foo}{$bar}", strings=strings)
+    second = parse_compact("{$bar}{$foo}", strings=strings)
+    assert len(strings) == 2
+    assert first.strings is second.strings
+
+
+def test_subtree():
+    tree = parse_compact("a{if $b}c{/if}")
+    cursor = tree.root.child.children[1]
+    assert cursor.kind is IfStatement
+    assert cursor.parent == tree.root.child
+    assert repr(tree.to_ast(cursor.index)) == repr(parse_string("{if $b}c{/if}").child.children[0])
+
+
+def test_cached_statements():
+    text = "{$a|escape}x{$a|escape}{if $b}{$a|escape}{/if}"
+    cache = TagCache()
+    for _ in range(2):
+        # Misses, then hits with no children.
+        ast = parse_string(text, tag_cache=cache)
+        tree = CompactTree.from_ast(ast)
+        assert CachedStatement in {Cursor(tree, index).kind for index in range(len(tree))}
+        assert repr(tree.to_ast()) == repr(ast)
+        assert tree.root.accept(TwigPrinter()) == parse_string(text).accept(TwigPrinter())
+
+
+def test_deep_nesting():
+    depth = 10000
+    text = "{if $a}x" * depth + "{/if}" * depth
+    tree = parse_compact(text)
+    out = tree.root.accept(TwigPrinter())
+    assert out == "{% if a %}x" * depth + "{% endif %}" * depth
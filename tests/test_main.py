@@ -41,6 +41,91 @@ class TestMain:
         assert target_file.exists()
         assert "{{ bar }}" in target_file.read_text()
 
+    def test_main_with_tag_cache(self, tmp_path, capsys):
+        source_file = tmp_path / "test.tpl"
+        source_file.write_text("{$foo}{$foo}")
+        cache_file = tmp_path / "cache.json"
+
+        original_argv = sys.argv
+        try:
+            sys.argv = ["smartytotwig", "-s", str(source_file), "-c", str(cache_file)]
+            main()
+            main()
+        finally:
+            sys.argv = original_argv
+
+        assert (tmp_path / "test.twig").read_text() == "{{ foo }}{{ foo }}"
+        assert cache_file.exists()
+        assert "Tag cache: 2 hits, 0 misses (100.0%)" in capsys.readouterr().out
+
+    def test_main_with_source_dir(self, tmp_path, capsys):
+        source_dir = tmp_path / "src"
+        source_dir.mkdir()
+        (source_dir / "a.tpl").write_text("{$foo}")
+        (source_dir / "b.tpl").write_text("static")
+
+        original_argv = sys.argv
+        try:
+            sys.argv = ["smartytotwig", "-d", str(source_dir), "-o", str(tmp_path / "out")]
+            main()
+        finally:
+            sys.argv = original_argv
+
+        assert (tmp_path / "out" / "a.twig").read_text() == "{{ foo }}"
+        assert (tmp_path / "out" / "b.twig").read_text() == "static"
+        assert (
+            "1 templates converted, 1 copied verbatim, 0 unchanged, 0 failed"
+            in capsys.readouterr().out
+        )
+
+    def test_main_with_shards(self, tmp_path, capsys):
+        source_dir = tmp_path / "src"
+        source_dir.mkdir()
+        for name in "abcd":
+            (source_dir / ("%s.tpl" % name)).write_text("{$%s}" % name)
+
+        original_argv = sys.argv
+        try:
+            for shard in ("1/2", "2/2"):
+                sys.argv = ["smartytotwig", "-d", str(source_dir), "--shard", shard]
+                sys.argv += ["--report", str(tmp_path / ("%s.json" % shard[0]))]
+                main()
+            capsys.readouterr()
+            sys.argv = ["smartytotwig", "merge-reports", str(tmp_path / "1.json")]
+            sys.argv += [str(tmp_path / "2.json"), "--report", str(tmp_path / "all.json")]
+            main()
+        finally:
+            sys.argv = original_argv
+
+        assert sorted(path.name for path in source_dir.glob("*.twig")) == [
+            "a.twig",
+            "b.twig",
+            "c.twig",
+            "d.twig",
+        ]
+        assert "4 templates converted" in capsys.readouterr().out
+        assert (tmp_path / "all.json").exists()
+
+    def test_main_with_stats(self, tmp_path, capsys):
+        source_dir = tmp_path / "src"
+        source_dir.mkdir()
+        (source_dir / "a.tpl").write_text("{$foo}")
+        stats = str(tmp_path / "stats.jsonl")
+
+        original_argv = sys.argv
+        try:
+            sys.argv = ["smartytotwig", "-d", str(source_dir), "--stats", stats]
+            main()
+            capsys.readouterr()
+            sys.argv = ["smartytotwig", "summarize-stats", stats, "--top", "1"]
+            main()
+        finally:
+            sys.argv = original_argv
+
+        out = capsys.readouterr().out
+        assert "1 templates, 1 converted with statistics" in out
+        assert "a.tpl" in out and "Throughput" in out
+
     def test_main_without_source(self, capsys):
         # Mock sys.argv with no source
         original_argv = sys.argv
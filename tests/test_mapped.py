@@ -0,0 +1,66 @@
+from pathlib import Path
+
+import pytest
+
+from smartytotwig import batch, mapped
+from smartytotwig.batch import convert_bytes, convert_file
+from smartytotwig.mapped import convert_buffer, convert_mapped
+from smartytotwig.stack_parser import OverBudgetError
+
+EXAMPLES = Path(__file__).parent.parent / "examples"
+
+TEMPLATES = [
+    b"",
+    b"<p>{$foo.bar|escape:'html'}</p>\n",
+    b"{if $a > 1 and !$b}x{elseif $c}y{else}z{/if}",
+    b"{foreach from=$items item=item}{if $item}{$item->name}{/if}{foreachelse}-{/foreach}",
+    b"{block name=content}{capture name=c}{include file='a.tpl'}{/capture}{/block}",
+    b"{* {$a} *}{literal}{$raw}{/literal}{ldelim}{rdelim}",
+    "caf\u00e9 {$na\u00efve} \u2603\r\nline\rend\r\n".encode(),
+    # Braces in quotes, and braces starting no tag.
+    b'{$a|replace:"}":"{"}{$b|x:\'}\'}<style>p { color: red }</style>',
+    b"{ don't } {if $a}{$b}{/foreach}{/if}{if $c}",
+    # A string in a backquoted expression, and one only closed further on.
+    b'{$a|f:"x`$b|y:"}"`z"}{"{else}{$a|b:"}"}{/if}"',
+    b"{if $a}{*",
+    b"{$a",
+]
+
+
+@pytest.mark.parametrize("data", TEMPLATES)
+def test_same_output(data):
+    assert b"".join(convert_buffer(data)) == b"".join(convert_bytes(data))
+
+
+@pytest.mark.parametrize("name", ["guestbook.tpl", "guestbook_form.tpl"])
+def test_examples(name):
+    data = (EXAMPLES / name).read_bytes()
+    assert b"".join(convert_buffer(data)) == b"".join(convert_bytes(data))
+
+
+def test_content_chunks(monkeypatch):
+    monkeypatch.setattr(mapped, "_CHUNK", 3)
+    data = "a\r\nb\u00e9\u2603\r\n{$c}".encode()
+    assert b"".join(convert_buffer(data)) == b"".join(convert_bytes(data))
+    with pytest.raises(UnicodeDecodeError):
+        b"".join(convert_buffer(b"abcd\xff{$a}"))
+
+
+def test_convert_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch, "MAPPED_SIZE", 1)
+    source = tmp_path / "a.tpl"
+    source.write_bytes(TEMPLATES[6])
+    assert b"".join(convert_mapped(str(source))) == b"".join(convert_bytes(TEMPLATES[6]))
+
+    assert convert_file(str(source), str(tmp_path / "a.twig")) == (False, True)
+    assert (tmp_path / "a.twig").read_bytes() == b"".join(convert_bytes(TEMPLATES[6]))
+
+    source.write_bytes(b"no tags")
+    assert convert_file(str(source), str(tmp_path / "a.twig")) == (True, True)
+    source.write_bytes(b"")
+    assert list(convert_mapped(str(source))) == []
+
+
+def test_deadline():
+    with pytest.raises(OverBudgetError, match="timeout at offset 3"):
+        list(convert_buffer(b"ab {$a}", deadline=0))
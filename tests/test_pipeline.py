@@ -0,0 +1,352 @@
+import gc
+import heapq
+import multiprocessing
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import forkserver
+
+import pytest
+
+from smartytotwig import batch, pipeline, preload
+from smartytotwig.batch import convert_tree
+from smartytotwig.journal import Journal
+from smartytotwig.pipeline import (
+    BRACE_COST,
+    KILL_GRACE,
+    ByteBudget,
+    Pipeline,
+    convert_templates,
+    estimate_cost,
+    process_context,
+)
+from smartytotwig.stack_parser import OverBudgetError
+from smartytotwig.tag_cache import TagCache
+
+
+def make_tree(root):
+    (root / "a" / "b").mkdir(parents=True)
+    for i in range(20):
+        (root / "a" / ("%d.tpl" % i)).write_text("<p>{$item%d|escape}</p>{if $x}y{/if}\n" % i)
+    (root / "a" / "b" / "static.tpl").write_text("static\n")
+    (root / "a" / "b" / "broken.tpl").write_bytes(b"{$a}\xff")
+    return root
+
+
+def test_same_as_sequential(tmp_path):
+    source = make_tree(tmp_path / "src")
+    sequential = convert_tree(str(source), str(tmp_path / "one"))
+    pipelined = convert_tree(str(source), str(tmp_path / "many"), jobs=2)
+
+    assert (pipelined.converted, pipelined.copied) == (sequential.converted, sequential.copied)
+    assert [source for source, _ in pipelined.failed] == [str(source / "a" / "b" / "broken.tpl")]
+    for path in (tmp_path / "one").rglob("*.twig"):
+        assert (tmp_path / "many" / path.relative_to(tmp_path / "one")).read_bytes() == (
+            path.read_bytes()
+        )
+
+    again = convert_tree(str(source), str(tmp_path / "many"), jobs=2)
+    assert again.unchanged == 21
+
+
+def test_small_budget(tmp_path):
+    source = make_tree(tmp_path / "src")
+    files = [(str(path), str(path.with_suffix(".twig"))) for path in source.rglob("*.tpl")]
+    pipeline = Pipeline(2, max_bytes=10)
+    report = pipeline.run(files)
+    assert report.converted == 20
+    assert pipeline.budget.used == 0
+
+
+def test_byte_budget():
+    budget = ByteBudget(10)
+    assert budget.acquire(100) == 10
+    budget.release(10)
+
+    acquired = threading.Event()
+
+    def take():
+        budget.acquire(5)
+        acquired.set()
+
+    budget = ByteBudget(10)
+    budget.acquire(6)
+    thread = threading.Thread(target=take)
+    thread.start()
+    assert not acquired.wait(0.1)
+    budget.release(6)
+    assert acquired.wait(5)
+    thread.join()
+    assert budget.used == 5
+
+
+def test_estimate_cost():
+    assert estimate_cost(b"abc") == 3
+    assert estimate_cost(b"{$a}") == 4 + BRACE_COST
+
+
+class RecordingExecutor:
+    def __init__(self):
+        self.chunks = []
+
+    def submit(
+        self,
+        function,
+        templates,
+        timeout=None,
+        tag_cache=None,
+        targets=None,
+        measure=False,
+        slot=None,
+    ):
+        self.chunks.append(templates)
+        return Future()
+
+
+def test_dispatch_longest_first_in_chunks():
+    pipeline = Pipeline(1, chunk_cost=2 * BRACE_COST)
+    pipeline._converters = RecordingExecutor()
+    templates = [b"{a}", b"{" * 10, b"b", b"{{{", b"c"]
+    for order, data in enumerate(templates):
+        pipeline._queue.append((-estimate_cost(data), order, "s", "t", data, 0))
+    heapq.heapify(pipeline._queue)
+
+    pipeline._dispatch()
+    assert pipeline._converters.chunks == [[b"{" * 10], [b"{{{"]]
+    pipeline._converting = 0
+    pipeline._dispatch()
+    assert pipeline._converters.chunks[2:] == [[b"{a}", b"b", b"c"]]
+
+    # Recycled processes count templates, sent one per task.
+    pipeline = Pipeline(1, chunk_cost=2 * BRACE_COST, recycle=10)
+    pipeline._converters = RecordingExecutor()
+    for order, data in enumerate([b"b", b"c"]):
+        pipeline._queue.append((-estimate_cost(data), order, "s", "t", data, 0))
+    pipeline._dispatch()
+    assert pipeline._converters.chunks == [[b"b"], [b"c"]]
+
+
+def test_tail_latency(tmp_path):
+    source = make_tree(tmp_path / "src")
+    report = convert_tree(str(source), str(tmp_path / "out"), jobs=2)
+    assert report.elapsed is not None and report.tail_latency is not None
+    assert 0 <= report.tail_latency <= report.elapsed
+    assert "with idle workers" in report.summary()
+
+
+def test_convert_templates_writes(tmp_path):
+    targets = [str(tmp_path / "a.twig"), str(tmp_path / "b.twig"), str(tmp_path / "c" / "d")]
+    templates = [b"{$a}", b"{$b}\xff", b"{$c}"]
+    assert convert_templates(templates[:1], targets=targets[:1]) == [True]
+    written, error, missing = convert_templates(templates, targets=targets)
+    assert written is False
+    assert isinstance(error, UnicodeDecodeError) and isinstance(missing, OSError)
+    assert (tmp_path / "a.twig").read_bytes() == b"{{ a }}"
+    assert not (tmp_path / "b.twig").exists()
+
+
+def test_convert_templates_timeout():
+    slow = b"{if $a}" + b"{$b|c}" * 500 + b"{/if}"
+    output, error = convert_templates([b"{$a}", slow], timeout=0)
+    assert output == b"{{ a }}"
+    assert isinstance(error, OverBudgetError) and error.reason == "timeout"
+
+
+def test_broken_pool_retries_alone():
+    pipeline = Pipeline(1, chunk_cost=10 * BRACE_COST)
+    pipeline._converters = RecordingExecutor()
+    pipeline._pending = 2
+    files = [("a", "a.t", b"{a}", 0), ("b", "b.t", b"{b}", 0)]
+
+    # The templates of a pool that broke are tried again one at a time,
+    # once nothing else is converting.
+    pipeline._broken(RecordingExecutor(), files)
+    pipeline._converting = 1
+    pipeline._dispatch()
+    assert pipeline._converters.chunks == []
+    pipeline._converting = 0
+    pipeline._dispatch()
+    pipeline._dispatch()
+    assert pipeline._converters.chunks == [[b"{b}"]]
+
+    # Dying again on its own fails the template.
+    pipeline._converting = 0
+    pipeline._broken(RecordingExecutor(), [files[1]])
+    assert pipeline.report.failed == [
+        ("b", "OverBudgetError: conversion process died (template size 3)")
+    ]
+    assert pipeline._pending == 1
+    pipeline._dispatch()
+    assert pipeline._converters.chunks == [[b"{b}"], [b"{a}"]]
+
+
+def test_isolated_submit_fails():
+    pipeline = Pipeline(1)
+    pipeline._converters = RecordingExecutor()
+    pipeline._pending = 3
+    pipeline._suspects = [("a", "a.t", b"{a}", 0), ("b", "b.t", b"{b}", 0)]
+    pipeline._queue.append((-estimate_cost(b"{c}"), 0, "c", "c.t", b"{c}", 0))
+    submit = pipeline._converters.submit
+
+    def submit_or_fail(function, templates, *args):
+        if templates != [b"{c}"]:
+            raise RuntimeError("cannot send %r" % templates)
+        return submit(function, templates, *args)
+
+    # Neither suspect can be sent; the queue goes on once they failed.
+    pipeline._converters.submit = submit_or_fail
+    pipeline._dispatch()
+    assert [source for source, _ in pipeline.report.failed] == ["b", "a"]
+    assert not pipeline._isolated
+    assert pipeline._converters.chunks == [[b"{c}"]]
+
+
+def test_watchdog(tmp_path):
+    pipeline = Pipeline(1, timeout=1)
+    pipeline._converters = RecordingExecutor()
+    pipeline._slots = [0.0] * 8
+    pipeline._free_slots = [0, 1]
+    pipeline._pending = 2
+    files = [("a", str(tmp_path / "a.t"), b"{a}", 0), ("b", str(tmp_path / "b.t"), b"{b}", 0)]
+    # The killed process was writing the second.
+    (tmp_path / "b.t.part").write_text("x")
+    pipeline._submit(files)
+    (slot,) = [slot for slot in (0, 1) if slot not in pipeline._free_slots]
+
+    # A process on the second template of its task past the timeout and
+    # the grace period is killed.
+    stuck = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+    pipeline._slots[4 * slot : 4 * slot + 4] = [stuck.pid, time.time() - 1.5, 1, 7]
+    pipeline._kill_stuck()
+    assert pipeline._killed == set()
+    pipeline._slots[4 * slot + 1] = time.time() - 2 - KILL_GRACE
+    pipeline._kill_stuck()
+    assert stuck.wait(5) != 0
+
+    # That template fails with where it got to, the other is a suspect.
+    pipeline._converting = 0
+    pipeline._broken(RecordingExecutor(), files, pipeline._release(slot))
+    assert pipeline.report.failed == [
+        ("b", "OverBudgetError: timeout at offset 7 (template size 3)")
+    ]
+    assert pipeline._suspects == files[:1]
+    assert sorted(pipeline._free_slots) == [0, 1] and not pipeline._killed
+    assert not (tmp_path / "b.t.part").exists()
+
+
+def test_limits(tmp_path):
+    source = make_tree(tmp_path / "src")
+    (source / "slow.tpl").write_text("{if $a}" + "{$b|c}" * 500 + "{/if}")
+    report = convert_tree(
+        str(source), str(tmp_path / "out"), timeout=0, memory_limit=2**40, recycle=1
+    )
+    assert report.converted == 20
+    assert [source for source, _ in report.failed] == [
+        str(source / "a" / "b" / "broken.tpl"),
+        str(source / "slow.tpl"),
+    ]
+    assert "timeout at offset" in report.failed[1][1]
+
+
+def test_resume(tmp_path):
+    source = make_tree(tmp_path / "src")
+    journal = Journal(str(tmp_path / "journal"))
+    first = convert_tree(str(source), str(tmp_path / "out"), jobs=2, journal=journal)
+    journal.close()
+    assert first.resumed == 0
+
+    journal = Journal(str(tmp_path / "journal"), resume=True)
+    again = convert_tree(str(source), str(tmp_path / "out"), jobs=2, journal=journal)
+    journal.close()
+    assert (again.resumed, again.converted, len(again.failed)) == (21, 0, 1)
+
+
+def test_duplicates(tmp_path):
+    source = make_tree(tmp_path / "src")
+    (source / "c").mkdir()
+    for i in range(5):
+        (source / "c" / ("%d.tpl" % i)).write_bytes((source / "a" / "0.tpl").read_bytes())
+        (source / "c" / ("broken%d.tpl" % i)).write_bytes(b"{$a}\xff")
+    report = convert_tree(str(source), str(tmp_path / "out"), jobs=2)
+
+    assert (report.converted, report.duplicates, len(report.failed)) == (20, 5, 6)
+    assert len({error for _, error in report.failed}) == 1
+    for i in range(5):
+        assert (tmp_path / "out" / "c" / ("%d.twig" % i)).read_text() == (
+            "<p>{{ item0|escape }}</p>{% if x %}y{% endif %}\n"
+        )
+
+
+def test_cost_estimated_unlocked(tmp_path, monkeypatch):
+    # Mapped templates are scanned for their cost: not while every
+    # reading thread and the dispatcher wait on the lock.
+    monkeypatch.setattr(batch, "MAPPED_SIZE", 1)
+    source = make_tree(tmp_path / "src")
+    run = Pipeline(2, backend="threads")
+    locked = []
+
+    def estimate(data):
+        locked.append(run._lock._is_owned())
+        return estimate_cost(data)
+
+    monkeypatch.setattr(pipeline, "estimate_cost", estimate)
+    report = run.run(
+        [(str(path), str(tmp_path / "out" / path.name)) for path in source.rglob("*.tpl")]
+    )
+    assert report.converted == 20 and locked and not any(locked)
+
+
+def test_duplicate_of_unwritable_target():
+    pipeline = Pipeline(1)
+    pipeline._converters = RecordingExecutor()
+    pipeline._pending = 2
+    pipeline._digests = {"a": "d", "b": "d"}
+    pipeline._duplicates["d"] = ("a", [("b", "b.t", b"{a}", 0)])
+
+    # Failing to write a template's output converts a duplicate instead.
+    pipeline._failed("a", PermissionError("a.t"))
+    assert pipeline._duplicates == {"d": ("b", [])}
+    assert pipeline._converters.chunks == [[b"{a}"]]
+
+
+def test_threads_backend(tmp_path):
+    source = make_tree(tmp_path / "src")
+    sequential = convert_tree(str(source), str(tmp_path / "one"))
+    tag_cache = TagCache()
+    threaded = convert_tree(
+        str(source), str(tmp_path / "many"), tag_cache=tag_cache, jobs=4, backend="threads"
+    )
+
+    assert (threaded.converted, len(threaded.failed)) == (sequential.converted, 1)
+    for path in (tmp_path / "one").rglob("*.twig"):
+        assert (tmp_path / "many" / path.relative_to(tmp_path / "one")).read_bytes() == (
+            path.read_bytes()
+        )
+    assert len(tag_cache) == 20
+
+
+def test_preload():
+    # In a fresh interpreter, as warming up freezes the garbage collector.
+    check = (
+        "import gc; from smartytotwig import preload, stack_parser; "
+        "assert not gc.get_freeze_count() and not stack_parser._plans; "
+        "preload.warm(); "
+        "assert gc.get_freeze_count() and stack_parser._plans"
+    )
+    subprocess.run([sys.executable, "-c", check], check=True)
+
+
+def test_process_context():
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        pytest.skip("no fork server")
+    # Fails once CPython connects to its fork server in some way preload
+    # cannot swap its own server into, see preload._Popen.
+    assert preload._swappable
+    preloaded = forkserver._forkserver._preload_modules
+    with ProcessPoolExecutor(1, process_context()) as pool:
+        # Forked from a fork server that warmed up.
+        assert pool.submit(gc.get_freeze_count).result()
+    # That of multiprocessing is left alone.
+    assert forkserver._forkserver._preload_modules == preloaded
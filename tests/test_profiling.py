@@ -0,0 +1,55 @@
+import pstats
+
+import pytest
+
+from smartytotwig.batch import convert_tree
+from smartytotwig.pipeline import Pipeline
+from smartytotwig.profiling import Profiles, profiling, run_profiled
+
+
+def spin(n):
+    return sum(square(i) for i in range(n))
+
+
+def square(i):
+    return i * i
+
+
+def test_collapsed():
+    profiles = Profiles()
+    with profiling(profiles):
+        spin(20000)
+    result, stats = run_profiled(spin, 10000)
+    profiles.add(stats)
+    assert result == spin(10000)
+
+    # Calls of both runs are merged.
+    (square_calls,) = [entry[1] for key, entry in profiles.stats.items() if key[2] == "square"]
+    assert square_calls == 30000
+
+    stacks = profiles.collapsed()
+    frames = [stack.split(";") for stack in stacks]
+    assert any(f[0].startswith("spin (") and f[-1].startswith("square (") for f in frames)
+    # The time shared out to stacks is all the time profiled.
+    roots = [entry for entry in profiles.stats.values() if not entry[4]]
+    assert sum(stacks.values()) == pytest.approx(sum(root[3] for root in roots) * 1e6, rel=0.01)
+
+
+def test_convert_tree(tmp_path):
+    source = tmp_path / "src"
+    source.mkdir()
+    for i in range(4):
+        (source / ("%d.tpl" % i)).write_text("{if $a}{$b%d|escape}{/if}" % i)
+
+    for jobs in (1, 2):
+        profiles = Profiles()
+        convert_tree(str(source), str(tmp_path / str(jobs)), jobs=jobs, profiles=profiles)
+        profiles.save(str(tmp_path / "profile"))
+        stats = pstats.Stats(str(tmp_path / "profile"))
+        names = {name for _, _, name in stats.stats}
+        assert {"convert_bytes", "iter_parse", "print"} <= names
+        collapsed = (tmp_path / "profile.collapsed").read_text()
+        assert ";print (twig_printer.py" in collapsed
+
+    with pytest.raises(ValueError):
+        Pipeline(2, backend="threads", profiles=Profiles())
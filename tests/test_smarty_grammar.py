@@ -5,6 +5,7 @@ grammar more sane.
 """
 
 from smartytotwig import parse_string
+from smartytotwig.smarty_grammar import NeOperator, Operator
 from smartytotwig.twig_printer import TwigPrinter
 
 
@@ -544,6 +545,28 @@ def test_if_double_pipe():
     assert r == "{% if foo or bar %}x{% endif %}"
 
 
+def test_operator_nodes():
+    ast = parse_string("{if foo neq bar ne baz}x{/if}")
+    conditions = ast.child.children[0].children[0]
+    operators = [child for child in conditions.children if isinstance(child, Operator)]
+    assert [type(operator.child) for operator in operators] == [NeOperator, NeOperator]
+
+
+def test_symbol_prefix_nodes():
+    r = convert_code("{if !$foo and @$bar}x{/if}")
+    assert r == "{% if not foo and bar %}x{% endif %}"
+
+
+def test_foreach_variable_arithmetic():
+    r = convert_code(
+        "{foreach $foo as $bar}{$bar@index*2}{$bar@total/2}{$bar@iteration-1}{/foreach}"
+    )
+    assert r == (
+        "{% for bar in foo %}{{ loop.index0 * 2 }}{{ loop.length / 2 }}"
+        "{{ loop.index - 1 }}{% endfor %}"
+    )
+
+
 def test_multiline_comment():
     r = convert_code("{* hello\nworld *}")
     assert r == "{# hello\nworld #}"
@@ -554,6 +577,31 @@ def test_literal_with_js():
     assert r == "function() { return 1; }"
 
 
+def test_comment_ends_at_first_terminator():
+    r = convert_code("{* a **}{* b *}")
+    assert r == "{# a *#}{# b #}"
+
+
+def test_unterminated_comment():
+    r = convert_code("{* a {* b")
+    assert r == "{* a {* b"
+
+
+def test_literal_ends_at_first_terminator():
+    r = convert_code("{literal}a{/literal}b{/literal}")
+    assert r == "ab{/literal}"
+
+
+def test_unterminated_literal():
+    r = convert_code("{literal}{$foo}")
+    assert r == "{literal}{{ foo }}"
+
+
+def test_print_double_quoted_string_with_brace():
+    r = convert_code('{"a}b"}')
+    assert r == '{{ "a}b" }}'
+
+
 def test_assign_with_string():
     r = convert_code('{assign var=foo value="bar"}')
     assert r == '{% set foo = "bar" %}'
@@ -0,0 +1,161 @@
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pypeg2
+import pytest
+
+from smartytotwig import iter_convert, iter_parse, parse_string, smarty_grammar, stack_parser
+from smartytotwig.smarty_grammar import (
+    Content,
+    IfStatement,
+    PrintStatement,
+    SmartyLanguage,
+    SmartyLanguageMainOrEmpty,
+)
+from smartytotwig.stack_parser import LineIndex, OverBudgetError, StackParser
+from smartytotwig.twig_printer import TwigPrinter
+
+TEMPLATES = [
+    "",
+    "<p>{$foo.bar|escape:'html'}</p>",
+    "{if $a > 1 and !$b}x{elseif $c}y{else}z{/if}",
+    "{foreach from=$items item=item name=loop}{$item@index+1}{foreachelse}none{/foreach}",
+    "{foreach $items as $item}{if $item}{$item->name}{/if}{/foreach}",
+    "{block name=content}{capture name=c}{include file='a.tpl'}{/capture}{/block}",
+    '{t id="hello" quoted=true}{assign var=x value=$y}{func a=1 b=$c}',
+    "{* comment *}{literal}{$raw}{/literal}{ldelim}{rdelim}",
+    # Unclosed blocks fall back to plain delimiters and content.
+    "{if $a}{if $b}x{/if}",
+    "{foreach from=$a item=b}{$b}{/foreach",
+    "{block name=x}y",
+]
+
+
+@pytest.mark.parametrize("text", TEMPLATES)
+def test_same_tree_as_pypeg2(text):
+    expected = pypeg2.parse(text, SmartyLanguageMainOrEmpty, whitespace="")
+    assert repr(parse_string(text)) == repr(expected)
+
+
+def test_deep_nesting():
+    depth = 10000
+    ast = parse_string("{if $a}x" * depth + "{/if}" * depth)
+
+    # Walk down without recursion, __repr__ and accept() would recurse.
+    found = 0
+    node = ast.child.children[0]
+    while isinstance(node, IfStatement):
+        found += 1
+        language = node.children[1]
+        assert isinstance(language, SmartyLanguage)
+        node = language.children[-1]
+    assert found == depth
+
+
+def test_syntax_error():
+    with pytest.raises(SyntaxError) as info:
+        parse_string("{$foo\n", PrintStatement)
+    assert info.value.lineno == 2
+
+
+def test_deadline():
+    text = "{if $a}" + "{$b|c}" * 500 + "{/if}"
+    with pytest.raises(OverBudgetError) as info:
+        list(iter_parse(text, deadline=0))
+    assert info.value.reason == "timeout"
+    assert 0 < info.value.offset < len(text)
+    assert str(info.value).endswith("(template size %d)" % len(text))
+
+
+def test_deadline_across_statements():
+    # Thousands of small top-level tags, each parsed by a run() of its own.
+    text = "{$a|b}" * 5000
+    with pytest.raises(OverBudgetError) as info:
+        list(iter_parse(text, deadline=0))
+    assert 0 < info.value.offset < len(text)
+
+
+def test_run_partial_match():
+    parser = StackParser("{$foo}tail")
+    end, node = parser.run(PrintStatement, 0)
+    assert end == 6
+    assert isinstance(node, PrintStatement)
+
+
+def test_source_leaves():
+    comment = "{* %s *}" % ("x" * 100)
+    text = "<p>%s</p>%s" % ("y" * 100, comment)
+    ast = parse_string(text)
+    content, comment_node = ast.child.children
+    assert isinstance(content, Content) and content.source is text
+    assert content.value == "<p>%s</p>" % ("y" * 100)
+    assert comment_node.source is text and comment_node.body == " %s " % ("x" * 100)
+    assert repr(ast) == repr(pypeg2.parse(text, SmartyLanguageMainOrEmpty, whitespace=""))
+    assert ast.accept(TwigPrinter()).endswith("{# %s #}" % ("x" * 100))
+
+
+def test_spans():
+    text = "a\n{if $b}\n  {$c}{/if}"
+    spans = {}
+    ast = StackParser(text, spans=spans).parse(SmartyLanguageMainOrEmpty)
+    statement = ast.child.children[1]
+    print_statement = statement.children[1].children[1]
+    assert isinstance(print_statement, PrintStatement)
+    start, end = spans[id(print_statement)]
+    assert text[start:end] == "{$c}"
+    assert LineIndex(text).span(start, end) == ((3, 3), (3, 7))
+
+
+@pytest.mark.parametrize("text", TEMPLATES)
+def test_iter_parse(text):
+    ast = parse_string(text)
+    statements = ast.child.children if text else []
+    assert repr(list(iter_parse(text))) == repr(statements)
+    assert "".join(iter_convert(io.StringIO(text))) == ast.accept(TwigPrinter())
+
+
+def test_interned():
+    text = "{if $a > 1}{$b|escape}{/if}x{if $a > 1}{$b|escape}{/if}"
+    interned = {}
+    ast = parse_string(text, interned=interned)
+    first, _, second = ast.child.children
+    assert first is second
+    assert first == parse_string(text).child.children[0]
+    assert repr(ast) == repr(parse_string(text))
+    assert TwigPrinter().print(ast) == parse_string(text).accept(TwigPrinter())
+
+    again = parse_string("{$b|escape}", interned=interned)
+    assert again.child.children[0] is first.children[1].children[0]
+
+
+def test_terminators_forgotten():
+    text = "{* note *}{$a|default:'b'}"
+    for convert in (parse_string, lambda text: list(iter_convert(io.StringIO(text)))):
+        convert(text)
+        assert not hasattr(smarty_grammar._terminators, "found")
+
+
+def test_print_deep_nesting():
+    depth = 10000
+    ast = parse_string("{if $a}x" * depth + "{/if}" * depth)
+    assert TwigPrinter().print(ast) == "{% if a %}x" * depth + "{% endif %}" * depth
+
+
+def test_threads(monkeypatch):
+    # Grammar plans are made by whichever threads first need them.
+    monkeypatch.setattr(stack_parser, "_plans", {})
+    monkeypatch.setattr(stack_parser, "_rule_numbers", {})
+    texts = TEMPLATES * 20
+    barrier = threading.Barrier(8)
+
+    def convert(text):
+        barrier.wait()
+        return parse_string(text).accept(printer)
+
+    printer = TwigPrinter()
+    with ThreadPoolExecutor(8) as executor:
+        outputs = list(executor.map(convert, texts[:8]))
+        outputs += executor.map(lambda text: parse_string(text).accept(printer), texts[8:])
+    assert len(set(stack_parser._rule_numbers.values())) == len(stack_parser._rule_numbers)
+    assert outputs == ["".join(iter_convert(text)) for text in texts]
@@ -0,0 +1,77 @@
+import json
+
+from smartytotwig.batch import convert_bytes, convert_tree
+from smartytotwig.stats import StatsLog, TemplateStats, load, summarize, trace
+from smartytotwig.tag_cache import TagCache
+
+TEMPLATE = b"<p>{$a|escape}</p>{if $b}{foreach from=$c item=d}{$d}{/foreach}{/if}"
+
+
+def test_template_stats():
+    stats = TemplateStats()
+    output = b"".join(convert_bytes(TEMPLATE, stats=stats))
+    assert output == b"".join(convert_bytes(TEMPLATE))
+    # The print, if and foreach tags; the content around them is no tag.
+    assert stats.tags == 4
+    assert stats.nodes > stats.tags and stats.depth > 3
+    assert stats.parse_ms > 0 and stats.print_ms > 0
+    assert stats.peak_memory is None and stats.cache_hits is None
+
+    with trace():
+        stats = TemplateStats()
+        tag_cache = TagCache()
+        b"".join(convert_bytes(b"{$a}{$a}{$b}", tag_cache, stats=stats))
+    assert stats.peak_memory and stats.peak_memory > 0
+    assert (stats.tags, stats.cache_hits, stats.cache_misses) == (3, 1, 2)
+
+
+def test_convert_tree(tmp_path):
+    source = tmp_path / "src"
+    source.mkdir()
+    (source / "a.tpl").write_bytes(TEMPLATE)
+    (source / "b.tpl").write_bytes(TEMPLATE)
+    (source / "c.tpl").write_text("static")
+    (source / "d.tpl").write_bytes(b"{$a}\xff")
+
+    for jobs in (1, 2):
+        stats = StatsLog(str(tmp_path / ("%d.jsonl" % jobs)))
+        convert_tree(str(source), str(tmp_path / str(jobs)), jobs=jobs, stats=stats)
+        stats.close()
+        entries = {entry["path"][-5:]: entry for entry in load([stats.file_name])}
+        assert [entries[name]["status"] for name in sorted(entries)] == [
+            "converted",
+            "duplicate",
+            "copied",
+            "failed",
+        ]
+        assert entries["a.tpl"]["bytes"] == len(TEMPLATE)
+        assert entries["a.tpl"]["tags"] == 4 and entries["a.tpl"]["write_ms"] >= 0
+        assert "parse_ms" not in entries["b.tpl"]
+
+
+def test_summarize(tmp_path):
+    entries = [
+        {"path": "a", "status": "copied", "bytes": 10},
+        {"path": "b", "status": "failed", "bytes": None},
+    ]
+    for i in range(1, 5):
+        entries.append(
+            {
+                "path": "t%d" % i,
+                "status": "converted",
+                "bytes": 1000,
+                "tags": 1,
+                "depth": 2,
+                "parse_ms": i,
+                "print_ms": 0,
+                "write_ms": 0,
+            }
+        )
+    (tmp_path / "stats.jsonl").write_text("".join(json.dumps(e) + "\n" for e in entries) + "{")
+
+    lines = summarize(load([str(tmp_path / "stats.jsonl")]), top=2)
+    assert lines[0] == "6 templates, 4 converted with statistics"
+    assert lines[2].endswith("t4") and lines[3].endswith("t3")
+    # Nearest rank percentiles of 250, 333.3, 500 and 1000 bytes per ms.
+    assert lines[4] == "Throughput, KB/s: p50 333.3, p90 1000.0, p99 1000.0"
+    assert summarize([]) == ["0 templates, 0 converted with statistics"]
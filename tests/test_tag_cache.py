@@ -0,0 +1,74 @@
+import pytest
+
+from smartytotwig import parse_string
+from smartytotwig.tag_cache import CachedStatement, TagCache
+from smartytotwig.twig_printer import TwigPrinter
+
+TEMPLATES = [
+    "<p>{$foo.bar|escape:'html'}</p>{$foo.bar|escape:'html'}",
+    '{include file="header.tpl"}{assign var=x value=$y}{t id="hello"}{func a=1 b=$c}',
+    "{if $a}{$b}{else}{$b}{/if}{foreach from=$items item=item}{$item}{$item@index}{/foreach}",
+    "{* {$a} *}{literal}{$a}{/literal}{$a}",
+    # The same tag text opens a block in one place and is a function in another.
+    "{block name=x}",
+    "{block name=x}y{/block}",
+    '{$a|b:"}"}',
+]
+
+
+def convert(text, cache=None):
+    return parse_string(text, tag_cache=cache).accept(TwigPrinter())
+
+
+def test_same_output():
+    cache = TagCache()
+    for _ in range(2):
+        for text in TEMPLATES:
+            assert convert(text, cache) == convert(text)
+    assert cache.hits > 0
+
+
+def test_hit():
+    cache = TagCache()
+    ast = parse_string("{$a}{$a}{$b}", tag_cache=cache)
+    assert (cache.hits, cache.misses) == (0, 3)
+    ast.accept(TwigPrinter())
+    assert len(cache) == 2
+
+    ast = parse_string("{$a}", tag_cache=cache)
+    (statement,) = ast.child.children
+    assert isinstance(statement, CachedStatement) and not statement.children
+    assert statement.output == "{{ a }}"
+    assert cache.hits == 1
+    assert cache.hit_rate == pytest.approx(0.25)
+
+
+def test_blocks_not_looked_up():
+    cache = TagCache()
+    convert("{if $a}x{/if}{foreach from=$a item=b}{/foreach}{* x *}", cache)
+    assert cache.hits + cache.misses == 0
+
+    text = "{if $a}{$b}{else}{$b}{/if}{ldelim}{rdelim}{init_time}{extends file='a.tpl'}"
+    assert convert(text, cache) == convert(text)
+    # Only the two {$b}, outputs being stored when printed.
+    assert (cache.hits, cache.misses) == (0, 2)
+
+
+def test_lru():
+    cache = TagCache(max_size=2)
+    cache.put("{$a}", "a")
+    cache.put("{$b}", "b")
+    assert cache.lookup("{$a}") is not None
+    cache.put("{$c}", "c")
+    assert cache.lookup("{$b}") is None
+    assert len(cache) == 2
+
+
+def test_save_load(tmp_path):
+    cache = TagCache()
+    convert("{$a}{include file='b.tpl'}", cache)
+    cache.save(str(tmp_path / "cache.json"))
+
+    loaded = TagCache.load(str(tmp_path / "cache.json"))
+    assert convert("{include file='b.tpl'}{$a}", loaded) == convert("{include file='b.tpl'}{$a}")
+    assert loaded.hits == 2